@@ -1,32 +1,160 @@
-from flask import Flask, jsonify, request, session, redirect
+import lazy
+
+# before anything else is imported, so STARTUP_PROFILE sees every module
+lazy.profile_imports()
+
+from flask import (
+    Flask,
+    Response,
+    jsonify,
+    request,
+    session,
+    redirect,
+    stream_with_context,
+)
 from flask_cors import CORS
 from werkzeug.utils import secure_filename
+import hashlib
+import importlib
+import logging
+import math
 import os
-from dotenv import load_dotenv
+import time
 import requests
+from dotenv import load_dotenv
+import http_client
 import linkedin_helper
 import twitter_helper
+import twitter_async
+import jobs
+import media
+import pregen
+import publisher
+import resilience
+import telemetry
 
 load_dotenv()
+telemetry.configure_logging()
+logger = logging.getLogger("app")
 app = Flask(__name__)
+app.request_class = media.SpooledRequest
 CORS(app)
+telemetry.instrument(app)
+resilience.instrument(app)
 app.secret_key = os.getenv("SESSION_SECRET")
 
-UPLOAD_FOLDER = "./temp"
 ALLOWED_EXTENSIONS = {"png", "jpg", "jpeg"}
 
-app.config["UPLOAD_FOLDER"] = UPLOAD_FOLDER
+STREAM_MIMETYPES = {"sse": "text/event-stream", "ndjson": "application/x-ndjson"}
+
+
+# gunicorn.conf.py calls this in a preloading master, so the forked workers
+# share the imported modules, and in each worker to build its own clients
+# before the first request instead of during it
+def warmup(clients=False):
+    lazy.load_all()
+    importlib.import_module("tweepy.asynchronous")
+    if clients:
+        twitter_helper.gpt_client.get()
+        http_client.get_session()
+    lazy.report("warmup")
 
 
 def allowed_file(filename):
     return "." in filename and filename.rsplit(".", 1)[1].lower() in ALLOWED_EXTENSIONS
 
 
+# ?async=1 or "Prefer: respond-async" queues the post instead of waiting
+def wants_async():
+    if request.args.get("async") in ("1", "true"):
+        return True
+    return "respond-async" in request.headers.get("Prefer", "")
+
+
+def queue_job(kind, payload, file=None):
+    media = None
+    if file is not None:
+        payload["filename"] = secure_filename(file.filename)
+        media = file.read()
+    job = jobs.enqueue(
+        kind, payload, media, idempotency_key=request.headers.get("Idempotency-Key")
+    )
+    job["status_url"] = f"/jobs/{job['id']}"
+    return jsonify(job), 202
+
+
+# ?stream=sse|ndjson wins, otherwise the Accept header decides
+def stream_format():
+    requested = request.args.get("stream")
+    if requested in STREAM_MIMETYPES:
+        return requested
+    best = request.accept_mimetypes.best_match(
+        ["application/json", *STREAM_MIMETYPES.values()]
+    )
+    for name, mimetype in STREAM_MIMETYPES.items():
+        if best == mimetype:
+            return name
+    return None
+
+
+def stream_record(fmt, event, data):
+    if fmt == "sse":
+        return f"event: {event}\ndata: {app.json.dumps(data)}\n\n"
+    return app.json.dumps({"event": event, "data": data}) + "\n"
+
+
+def stream_replies(tweets, fmt, strategy=None):
+    # each reply has its own GPT_DEADLINE; the stream as a whole has none
+    resilience.set_deadline(None)
+    started = time.monotonic()
+    count = cached = failed = 0
+    try:
+        for reply in twitter_helper.iter_gpt_replies(tweets, strategy):
+            if "error" in reply:
+                failed += 1
+                yield stream_record(fmt, "failed", reply)
+                continue
+            count += 1
+            cached += reply["cached"]
+            yield stream_record(fmt, "reply", reply)
+    except Exception as e:
+        yield stream_record(fmt, "error", {"error": str(e)})
+    summary = {
+        "tweets": len(tweets),
+        "replies": count,
+        "cached": cached,
+        "failed": failed,
+        "elapsed_ms": round((time.monotonic() - started) * 1000),
+    }
+    yield stream_record(fmt, "summary", summary)
+
+
 @app.route("/", methods=["GET"])
 def index():
     return jsonify({"data": "Success", "status": 200}), 200
 
 
+# an upstream that is down, overloaded or too slow for the deadline is
+# reported as such, not as our own 500
+def unavailable(e):
+    response = jsonify({"error": str(e)})
+    response.status_code = resilience.status_code(e)
+    retry_after = getattr(e, "retry_after", None)
+    if retry_after:
+        response.headers["Retry-After"] = str(math.ceil(retry_after))
+    return response
+
+
+# identity answers are per token: only the caller's browser may keep them,
+# and it revalidates with If-None-Match, which costs a 304 and no upstream
+# call while the server-side cache is warm
+def conditional_json(data):
+    response = jsonify(data)
+    response.set_etag(hashlib.sha256(response.get_data()).hexdigest()[:32])
+    response.headers["Cache-Control"] = "private, no-cache"
+    return response.make_conditional(request)
+
+
 @app.route("/getme", methods=["GET"])
 def getme():
     try:
@@ -35,25 +163,57 @@ def getme():
             return jsonify({"error": "Bearer token not found in request headers"}), 401
 
         access_token = auth_header.split(" ")[1]
-        headers = {"Authorization": f"Bearer {access_token}"}
-        response = requests.get("https://api.linkedin.com/v2/userinfo", headers=headers)
-
-        if response.status_code != 200:
-            return jsonify({"error": "Failed to fetch user info"}), response.status_code
-
-        user_info = response.json()
-        return jsonify(user_info)
+        user_info = linkedin_helper.get_userinfo(access_token)
+        response = conditional_json(user_info)
+        response.vary.add("Authorization")
+        return response
+    except requests.HTTPError as e:
+        return jsonify({"error": "Failed to fetch user info"}), e.response.status_code
+    except resilience.UNAVAILABLE as e:
+        return unavailable(e)
     except Exception as e:
         return jsonify({"error": str(e)}), 500
 
 
+def collect_stats():
+    return {
+        "http_pool": http_client.pool_stats(),
+        "twitter_clients": twitter_helper.client_cache.stats(),
+        "profiles": twitter_helper.profile_cache.stats(),
+        "replies": twitter_helper.reply_cache.stats(),
+        "linkedin_image_pipeline": linkedin_helper.pipeline_stats(),
+        "media_index": media.media_index.stats(),
+        "timelines": twitter_helper.timeline_store.stats(),
+        "openai_limiter": twitter_helper.gpt_limiter.stats(),
+        "linkedin_userinfo": linkedin_helper.userinfo_stats(),
+        "twitter_me": twitter_helper.me_stats(),
+        "pregen": pregen.stats(),
+        "upstreams": resilience.stats(),
+    }
+
+
+@app.route("/stats", methods=["GET"])
+def stats():
+    return jsonify(collect_stats())
+
+
+@app.route("/metrics", methods=["GET"])
+def metrics():
+    return Response(
+        telemetry.render(collect_stats()),
+        mimetype="text/plain; version=0.0.4",
+    )
+
+
 @app.route("/twitter/me", methods=["GET"])
 def get_twitter_me():
     try:
         access_token = request.args.get("access_token")
         access_secret = request.args.get("access_secret")
         data = twitter_helper.get_me(access_token, access_secret)
-        return jsonify(data)
+        return conditional_json(data)
+    except resilience.UNAVAILABLE as e:
+        return unavailable(e)
     except Exception as e:
         return jsonify({"error": str(e)}), 500
 
@@ -63,6 +223,8 @@ def get_users():
     try:
         users = twitter_helper.get_users(["101584084", "3888491"])
         return jsonify(users)
+    except resilience.UNAVAILABLE as e:
+        return unavailable(e)
     except Exception as e:
         return jsonify({"error": str(e)}), 500
 
@@ -77,6 +239,13 @@ def makepost():
     if not all([access_token, linkedin_id, post_content]):
         return jsonify({"error": "Missing required parameters"}), 400
     try:
+        if wants_async():
+            payload = {
+                "access_token": access_token,
+                "linkedin_id": linkedin_id,
+                "content": post_content,
+            }
+            return queue_job("linkedin_post", payload)
         post_response = linkedin_helper.create_linkedin_post(
             access_token, linkedin_id, post_content
         )
@@ -89,7 +258,11 @@ def makepost():
 @app.route("/upload", methods=["POST"])
 def upload_file():
     if request.method == "POST":
+        pipeline = None
         try:
+            if not wants_async():
+                pipeline = linkedin_helper.ImagePostPipeline(accept=allowed_file)
+                request.form_watcher = pipeline
             access_token = request.form.get("access_token")
             linkedin_id = request.form.get("linkedin_id")
             post_content = request.form.get("content")
@@ -97,40 +270,113 @@ def upload_file():
             if not all([access_token, linkedin_id, post_content]):
                 return jsonify({"error": "Missing required parameters"}), 400
 
-            asset_id = None
+            file = None
             if "file" in request.files:
                 file = request.files["file"]
                 if file.filename == "":
                     return jsonify({"message": "No selected file"}), 400
-                if file and allowed_file(file.filename):
-                    filename = secure_filename(file.filename)
-                    file.save(os.path.join(app.config["UPLOAD_FOLDER"], filename))
-                else:
+                if not allowed_file(file.filename):
                     return jsonify({"message": "File type not allowed"}), 400
 
-                response = linkedin_helper.register_image(access_token, linkedin_id)
-                upload_url = response["value"]["uploadMechanism"][
-                    "com.linkedin.digitalmedia.uploading.MediaUploadHttpRequest"
-                ]["uploadUrl"]
-                asset_id = response["value"]["asset"]
-                linkedin_helper.uploadImage(
-                    upload_url,
-                    access_token,
-                    os.path.join(app.config["UPLOAD_FOLDER"], filename),
-                )
+            if wants_async():
+                payload = {
+                    "access_token": access_token,
+                    "linkedin_id": linkedin_id,
+                    "content": post_content,
+                }
+                return queue_job("linkedin_post", payload, file)
 
-            if asset_id is not None:
-                post_response = linkedin_helper.create_linkedin_post_image(
-                    access_token, linkedin_id, post_content, asset_id
+            if file is not None:
+                post_response = pipeline.run(
+                    access_token,
+                    linkedin_id,
+                    post_content,
+                    secure_filename(file.filename),
+                    file.stream,
                 )
+                response = jsonify(post_response)
+                response.headers["Server-Timing"] = pipeline.server_timing()
+                return response, 200
             else:
                 post_response = linkedin_helper.create_linkedin_post(
                     access_token, linkedin_id, post_content
                 )
-                print(post_response)
             return jsonify(post_response), 200
         except Exception as e:
-            return jsonify(e), 500
+            return jsonify({"error": str(e)}), 500
+        finally:
+            # a request turned away after the file part began
+            if pipeline is not None:
+                pipeline.abandon()
+
+
+# one post to several platforms: linkedin_access_token + linkedin_id and/or
+# twitter_access_token + twitter_access_secret (or the twitter session when
+# platforms names twitter)
+@app.route("/publish", methods=["POST"])
+def publish():
+    try:
+        form = request.form
+        content = form.get("content")
+        if not content:
+            return jsonify({"error": "Missing required parameter: content"}), 400
+
+        credentials = dict()
+        if form.get("linkedin_access_token") and form.get("linkedin_id"):
+            credentials["linkedin"] = {
+                "access_token": form.get("linkedin_access_token"),
+                "linkedin_id": form.get("linkedin_id"),
+            }
+        platforms = form.get("platforms")
+        wanted = set(platforms.split(",")) if platforms else None
+        twitter_token = form.get("twitter_access_token")
+        twitter_secret = form.get("twitter_access_secret")
+        # the session only posts when the client asked for twitter by name,
+        # never just because the browser happens to be signed in
+        if not (twitter_token and twitter_secret) and wanted and "twitter" in wanted:
+            twitter_token = session.get("access_token")
+            twitter_secret = session.get("access_secret")
+        if twitter_token and twitter_secret:
+            credentials["twitter"] = {
+                "access_token": twitter_token,
+                "access_secret": twitter_secret,
+            }
+        if wanted:
+            credentials = {p: c for p, c in credentials.items() if p in wanted}
+        if not credentials:
+            return jsonify({"error": "No platform credentials provided"}), 400
+
+        file = None
+        if "file" in request.files:
+            file = request.files["file"]
+            if file.filename == "":
+                return jsonify({"message": "No selected file"}), 400
+            if not allowed_file(file.filename):
+                return jsonify({"message": "File type not allowed"}), 400
+
+        if wants_async():
+            payload = {"content": content, "credentials": credentials}
+            return queue_job("publish", payload, file)
+
+        filename = stream = None
+        if file is not None:
+            filename = secure_filename(file.filename)
+            stream = file.stream
+        results = publisher.publish(content, credentials, filename, stream)
+        posted = [r for r in results.values() if r["status"] == "posted"]
+        if len(posted) == len(results):
+            return jsonify(results), 200
+        return jsonify(results), 207 if posted else 502
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
+
+
+@app.route("/jobs/<job_id>", methods=["GET"])
+def get_job(job_id):
+    job = jobs.get_job(job_id)
+    if job is None:
+        return jsonify({"error": "Job not found"}), 404
+    return jsonify(job), 200
 
 
 @app.route("/twitter/timeline", methods=["GET"])
@@ -161,20 +407,29 @@ def post_tweet():
         text = form_data.get("text")
         if not text:
             return jsonify({"error": "Missing required parameter: text"}), 400
-        path = None
+        file = None
         if "image" in request.files:
             file = request.files["image"]
             if file.filename == "":
                 return jsonify({"message": "No selected file"}), 400
-            if file and allowed_file(file.filename):
-                filename = secure_filename(file.filename)
-                file.save(os.path.join(app.config["UPLOAD_FOLDER"], filename))
-            else:
+            if not allowed_file(file.filename):
                 return jsonify({"message": "File type not allowed"}), 400
-            path = os.path.join(app.config["UPLOAD_FOLDER"], filename)
+
+        if wants_async():
+            payload = {
+                "text": text,
+                "access_token": session["access_token"],
+                "access_secret": session["access_secret"],
+            }
+            return queue_job("tweet", payload, file)
+
+        path = stream = None
+        if file is not None:
+            path = secure_filename(file.filename)
+            stream = file.stream
 
         data = twitter_helper.post_tweet(
-            text, session["access_token"], session["access_secret"], path
+            text, session["access_token"], session["access_secret"], path, stream
         )
         return jsonify(data), 200
     except Exception as e:
@@ -217,37 +472,38 @@ def gpt_call():
     try:
         access_token = request.args.get("access_token")
         access_secret = request.args.get("access_secret")
-        timeline = twitter_helper.get_home_timeline(access_token, access_secret)
-        author_ids = list(set([tweet.author_id for tweet in timeline]))
-        users = twitter_helper.get_users(author_ids)
-        # tweets_list = [
-        #     {
-        #         "id": tweet.id,
-        #         "text": tweet.text,
-        #         "created_at": tweet.created_at,
-        #         "author_id": tweet.author_id,
-        #     }
-        #     for tweet in timeline
-        # ]
-        tweets_list = list()
-        for tweet in timeline:
-            user = [user for user in users if str(user["id"]) == str(tweet.author_id)][
-                0
-            ]
-            temp_data = dict()
-            temp_data["id"] = str(tweet.id)
-            temp_data["text"] = tweet.text
-            temp_data["created_at"] = tweet.created_at
-            temp_data["author_id"] = tweet.author_id
-            temp_data["username"] = user["username"]
-            temp_data["profile_image_url"] = user["profile_image_url"]
-            temp_data["verified"] = user["verified"]
-            temp_data["name"] = user["name"]
-            tweets_list.append(temp_data)
-        data = twitter_helper.send_to_gpt(tweets_list)
+        pregen.touch(access_token, access_secret)
+        tweets, users = twitter_helper.get_home_timeline(access_token, access_secret)
+        tweets_list = twitter_helper.enrich_tweets(tweets, users)
+        strategy = request.args.get("strategy")
+        fmt = stream_format()
+        if fmt is not None:
+            return Response(
+                stream_with_context(stream_replies(tweets_list, fmt, strategy)),
+                mimetype=STREAM_MIMETYPES[fmt],
+                headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+            )
+        data = twitter_helper.send_to_gpt(tweets_list, strategy)
+        return jsonify(data)
+    except resilience.UNAVAILABLE as e:
+        return unavailable(e)
+    except Exception as e:
+        telemetry.log(logger, logging.ERROR, "gpt route failed", error=str(e))
+        return jsonify({"error": str(e)}), 500
+
+
+@app.route("/twitter/gpt/async", methods=["GET"])
+async def gpt_call_async():
+    try:
+        access_token = request.args.get("access_token")
+        access_secret = request.args.get("access_secret")
+        pregen.touch(access_token, access_secret)
+        data = await twitter_async.gpt_pipeline(access_token, access_secret)
         return jsonify(data)
+    except resilience.UNAVAILABLE as e:
+        return unavailable(e)
     except Exception as e:
-        print(str(e))
+        telemetry.log(logger, logging.ERROR, "gpt route failed", error=str(e))
         return jsonify({"error": str(e)}), 500
 
 
@@ -257,7 +513,9 @@ def oauth():
         data = twitter_helper.oauth()
         if "error" in data.keys():
             return jsonify(data), 500
-        session["request_token"] = data["request_token"]
+        # the secret stays in the shared store; the session only ties the
+        # callback to the browser that started the login
+        session["oauth_token"] = data["request_token"]["oauth_token"]
         return redirect(data["redirect_url"])
     except Exception as e:
         return jsonify({"error": str(e)})
@@ -265,7 +523,12 @@ def oauth():
 
 @app.route("/oauth/callback/twitter")
 def callback():
-    request_token = session.pop("request_token", None)
+    oauth_token = request.args.get("oauth_token")
+    # a callback url for a login this browser did not start, e.g. one sent
+    # by someone who authorized it with their own account, is refused
+    if not oauth_token or session.pop("oauth_token", None) != oauth_token:
+        return "Access denied: reason=login was not started in this browser."
+    request_token = twitter_helper.pop_request_token(oauth_token)
     verifier = request.args.get("oauth_verifier")
     if request_token is None or verifier is None:
         return "Access denied: reason=missing token or verifier."
@@ -275,7 +538,9 @@ def callback():
             return jsonify(data), 500
         session["access_token"] = data["access_token"]
         session["access_secret"] = data["access_secret"]
-        user_data = twitter_helper.get_me(data["access_token"], data["access_secret"])
+        user_data = twitter_helper.login_profile(
+            data["access_token"], data["access_secret"]
+        )
         username = user_data["username"]
         name = user_data["name"]
         profile_pic = user_data["profile_pic"]
@@ -297,5 +562,7 @@ def callback():
         return jsonify({"error": str(e)}), 500
 
 
+lazy.report("import")
+
 if __name__ == "__main__":
     app.run(debug=True)
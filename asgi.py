@@ -0,0 +1,106 @@
+import logging
+import math
+import time
+from urllib.parse import parse_qs
+from asgiref.wsgi import WsgiToAsgi
+from app import app, STREAM_MIMETYPES
+import pregen
+import resilience
+import telemetry
+import twitter_async
+import twitter_helper
+
+# gunicorn -k uvicorn.workers.UvicornWorker asgi:application
+# /twitter/gpt runs natively on the worker's event loop so one worker can
+# hold many timeline requests; every other route goes through the WSGI app
+flask_app = WsgiToAsgi(app)
+state = None
+logger = logging.getLogger("app")
+
+
+async def _send_json(send, data, status=200, headers=()):
+    body = app.json.dumps(data).encode()
+    await send(
+        {
+            "type": "http.response.start",
+            "status": status,
+            "headers": [
+                (b"content-type", b"application/json"),
+                (b"content-length", str(len(body)).encode()),
+                (b"access-control-allow-origin", b"*"),
+                *headers,
+            ],
+        }
+    )
+    await send({"type": "http.response.body", "body": body})
+
+
+async def _lifespan(receive, send):
+    global state
+    while True:
+        message = await receive()
+        if message["type"] == "lifespan.startup":
+            state = twitter_async.PipelineState()
+            await send({"type": "lifespan.startup.complete"})
+        elif message["type"] == "lifespan.shutdown":
+            if state is not None:
+                await state.close()
+            await send({"type": "lifespan.shutdown.complete"})
+            return
+
+
+async def gpt_call(scope, receive, send):
+    query = parse_qs(scope["query_string"].decode())
+    access_token = query.get("access_token", [None])[0]
+    access_secret = query.get("access_secret", [None])[0]
+    started = time.monotonic()
+    status = 200
+    headers = []
+    pregen.touch(access_token, access_secret)
+    try:
+        # each request runs in its own task, so the deadline stays its own
+        header = dict(scope["headers"]).get(b"x-request-timeout")
+        resilience.set_deadline(resilience.request_deadline(header))
+        data = await twitter_async.gpt_pipeline(access_token, access_secret, state)
+    except resilience.UNAVAILABLE as e:
+        # same answer as the flask routes' unavailable()
+        data = {"error": str(e)}
+        status = resilience.status_code(e)
+        retry_after = getattr(e, "retry_after", None)
+        if retry_after:
+            headers.append((b"retry-after", str(math.ceil(retry_after)).encode()))
+    except Exception as e:
+        telemetry.log(logger, logging.ERROR, "gpt route failed", error=str(e))
+        data = {"error": str(e)}
+        status = 500
+    await _send_json(send, data, status, headers)
+    # this route bypasses flask, so it is timed here
+    telemetry.request_duration.observe(
+        time.monotonic() - started, route="/twitter/gpt", method="GET", status=status
+    )
+
+
+# streaming responses and batched replies are produced by the flask view;
+# the native pipeline only fans out
+def _wants_flask(scope):
+    query = parse_qs(scope["query_string"].decode())
+    if "stream" in query:
+        return True
+    strategy = query.get("strategy", [None])[0] or twitter_helper.GPT_STRATEGY
+    if strategy == "batch":
+        return True
+    accept = dict(scope["headers"]).get(b"accept", b"").decode()
+    return any(mimetype in accept for mimetype in STREAM_MIMETYPES.values())
+
+
+async def application(scope, receive, send):
+    if scope["type"] == "lifespan":
+        return await _lifespan(receive, send)
+    if (
+        scope["type"] == "http"
+        and scope["method"] == "GET"
+        and scope["path"] == "/twitter/gpt"
+        and not _wants_flask(scope)
+    ):
+        return await gpt_call(scope, receive, send)
+    return await flask_app(scope, receive, send)
@@ -0,0 +1,366 @@
+import argparse
+import itertools
+import json
+import random
+import re
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlencode, urlsplit
+
+# stand-ins for api.linkedin.com, api.twitter.com/upload.twitter.com and the
+# OpenAI chat completions API, all on one port. point the app at them with
+# UPSTREAM_OVERRIDE=http://host:port and OPENAI_BASE_URL=http://host:port/v1
+
+# per upstream: mean latency and jitter in ms, fraction of 500s, fraction of
+# 429s, and an optional quota of `limit` requests per `window` seconds
+DEFAULTS = {
+    "linkedin": dict(latency=80, jitter=20, errors=0, ratelimit=0, limit=0, window=900),
+    "twitter": dict(latency=60, jitter=20, errors=0, ratelimit=0, limit=0, window=900),
+    "openai": dict(latency=500, jitter=150, errors=0, ratelimit=0, limit=0, window=60),
+}
+
+TIMELINE_SIZE = 20
+TIMELINE_NEW = 5
+
+_ids = itertools.count(int(time.time()) * 1000)
+_created_at = "2024-01-01T00:00:00.000Z"
+
+
+def next_id():
+    return str(next(_ids))
+
+
+def upstream_for(path):
+    if path.startswith("/v1/"):
+        return "openai"
+    if path.startswith(("/2/", "/1.1/", "/oauth/")):
+        return "twitter"
+    return "linkedin"
+
+
+class Quota:
+    def __init__(self, limit, window):
+        self.limit = limit
+        self.window = window
+        self.reset = time.time() + window
+        self.used = 0
+        self.lock = threading.Lock()
+
+    # returns (allowed, remaining, reset)
+    def take(self):
+        with self.lock:
+            now = time.time()
+            if now >= self.reset:
+                self.reset = now + self.window
+                self.used = 0
+            if self.used >= self.limit:
+                return False, 0, self.reset
+            self.used += 1
+            return True, self.limit - self.used, self.reset
+
+
+class FakeUpstreams:
+    def __init__(
+        self, profiles, timeline_size=TIMELINE_SIZE, timeline_new=TIMELINE_NEW
+    ):
+        self.profiles = profiles
+        self.timeline_size = timeline_size
+        self.timeline_new = timeline_new
+        self.quotas = {
+            name: Quota(profile["limit"], profile["window"])
+            for name, profile in profiles.items()
+            if profile["limit"]
+        }
+        self.counts = dict()
+        self.lock = threading.Lock()
+
+    def count(self, upstream, status):
+        with self.lock:
+            key = f"{upstream} {status}"
+            self.counts[key] = self.counts.get(key, 0) + 1
+
+    def snapshot(self):
+        with self.lock:
+            return dict(self.counts)
+
+    # (status, headers, body) for a fault, or None to answer normally
+    def fault(self, upstream):
+        profile = self.profiles[upstream]
+        delay = random.gauss(profile["latency"], profile["jitter"])
+        time.sleep(max(delay, 0) / 1000)
+
+        headers = dict()
+        quota = self.quotas.get(upstream)
+        if quota is not None:
+            allowed, remaining, reset = quota.take()
+            headers = {
+                "x-rate-limit-limit": str(quota.limit),
+                "x-rate-limit-remaining": str(remaining),
+                "x-rate-limit-reset": str(int(reset)),
+            }
+            if not allowed:
+                return self.too_many(upstream, headers, reset - time.time())
+        if random.random() < profile["ratelimit"]:
+            return self.too_many(upstream, headers, 1)
+        if random.random() < profile["errors"]:
+            return 500, headers, {"error": "injected failure"}
+        return None, headers, None
+
+    def too_many(self, upstream, headers, wait):
+        headers = dict(headers)
+        headers["retry-after"] = str(max(int(wait), 1))
+        headers.setdefault("x-rate-limit-remaining", "0")
+        headers.setdefault("x-rate-limit-reset", str(int(time.time() + wait)))
+        if upstream == "openai":
+            body = {"error": {"message": "Rate limit reached", "type": "requests"}}
+        else:
+            body = {"title": "Too Many Requests", "status": 429}
+        return 429, headers, body
+
+    def handle(self, method, path, query, body, host):
+        if path == "/v2/userinfo":
+            return 200, {"sub": "bench", "name": "Bench User", "email": "b@example.com"}
+        if path == "/v2/ugcPosts":
+            return 201, {"id": f"urn:li:share:{next_id()}"}
+        if path == "/v2/assets" and query.get("action") == ["registerUpload"]:
+            asset = next_id()
+            mechanism = "com.linkedin.digitalmedia.uploading.MediaUploadHttpRequest"
+            return 200, {
+                "value": {
+                    "uploadMechanism": {
+                        mechanism: {"uploadUrl": f"http://{host}/upload/{asset}"}
+                    },
+                    "asset": f"urn:li:digitalmediaAsset:{asset}",
+                }
+            }
+        if path.startswith("/upload/"):
+            return 201, {}
+
+        # oauth 1.0a answers are form-encoded, not JSON
+        if path == "/oauth/request_token":
+            token = next_id()
+            return 200, urlencode(
+                {
+                    "oauth_token": f"request-{token}",
+                    "oauth_token_secret": f"request-secret-{token}",
+                    "oauth_callback_confirmed": "true",
+                }
+            )
+        if path == "/oauth/access_token":
+            user_id = str(1000 + int(next_id()) % 50)
+            return 200, urlencode(
+                {
+                    "oauth_token": f"{user_id}-{next_id()}",
+                    "oauth_token_secret": f"access-secret-{user_id}",
+                    "user_id": user_id,
+                    "screen_name": f"user{user_id}",
+                }
+            )
+        if path == "/2/users/me":
+            return 200, {"data": user("100")}
+        if path == "/2/users":
+            ids = ",".join(query.get("ids", [""])).split(",")
+            return 200, {"data": [user(i) for i in ids if i]}
+        match = re.match(r"^/2/users/(\w+)/timelines/reverse_chronological$", path)
+        if match:
+            return 200, self.timeline(query)
+        if path == "/2/tweets" and method == "POST":
+            text = json.loads(body or b"{}").get("text", "")
+            return 201, {"data": {"id": next_id(), "text": text}}
+        if path == "/1.1/media/upload.json":
+            media_id = next_id()
+            return 200, {
+                "media_id": int(media_id),
+                "media_id_string": media_id,
+                "size": len(body),
+                "image": {"image_type": "image/jpeg", "w": 100, "h": 100},
+            }
+
+        if path == "/v1/chat/completions":
+            return 200, completion(json.loads(body))
+        return 404, {"error": f"no fake for {method} {path}"}
+
+    # the first call for a user returns a full page, later calls with
+    # since_id return a few new tweets, as a live home timeline would
+    def timeline(self, query):
+        count = self.timeline_size if "since_id" not in query else self.timeline_new
+        count = min(count, int(query.get("max_results", ["100"])[0]))
+        authors = [str(200 + i) for i in range(5)]
+        tweets = [
+            {
+                "id": next_id(),
+                "text": f"Benchmark tweet {i} about shipping faster software",
+                "author_id": authors[i % len(authors)],
+                "created_at": _created_at,
+                "edit_history_tweet_ids": [],
+            }
+            for i in range(count)
+        ]
+        tweets.reverse()
+        meta = {"result_count": len(tweets)}
+        if tweets:
+            meta.update(newest_id=tweets[0]["id"], oldest_id=tweets[-1]["id"])
+        return {
+            "data": tweets,
+            "includes": {"users": [user(a) for a in authors]},
+            "meta": meta,
+        }
+
+
+def user(user_id):
+    return {
+        "id": user_id,
+        "name": f"User {user_id}",
+        "username": f"user{user_id}",
+        "profile_image_url": f"https://pbs.example.com/{user_id}.jpg",
+        "verified": False,
+    }
+
+
+def completion(request):
+    messages = request.get("messages", [])
+    prompt = next((m["content"] for m in messages if m["role"] == "user"), "")
+    if request.get("response_format", {}).get("type") == "json_object":
+        tweets = json.loads(prompt.split("Tweets:\n", 1)[1])
+        content = json.dumps(
+            {
+                "replies": [
+                    {"id": t["id"], "reply": f"Great point, {t['id']}!"} for t in tweets
+                ]
+            }
+        )
+    else:
+        content = "Great point, thanks for sharing!"
+    prompt_tokens = len(prompt) // 4
+    completion_tokens = len(content) // 4
+    return {
+        "id": f"chatcmpl-{next_id()}",
+        "object": "chat.completion",
+        "created": int(time.time()),
+        "model": request.get("model", "gpt-4o-mini"),
+        "choices": [
+            {
+                "index": 0,
+                "message": {"role": "assistant", "content": content},
+                "finish_reason": "stop",
+            }
+        ],
+        "usage": {
+            "prompt_tokens": prompt_tokens,
+            "completion_tokens": completion_tokens,
+            "total_tokens": prompt_tokens + completion_tokens,
+        },
+    }
+
+
+def make_handler(fakes):
+    class Handler(BaseHTTPRequestHandler):
+        # keep-alive, so the app's connection pools behave as in production
+        protocol_version = "HTTP/1.1"
+
+        def log_message(self, format, *args):
+            pass
+
+        def read_body(self):
+            if self.headers.get("Transfer-Encoding", "").lower() == "chunked":
+                chunks = []
+                while True:
+                    size = int(self.rfile.readline().split(b";")[0], 16)
+                    chunk = self.rfile.read(size)
+                    self.rfile.readline()
+                    if not size:
+                        return b"".join(chunks)
+                    chunks.append(chunk)
+            return self.rfile.read(int(self.headers.get("Content-Length") or 0))
+
+        def respond(self):
+            body = self.read_body()
+            url = urlsplit(self.path)
+            if url.path == "/_stats":
+                return self.send_json(200, dict(), fakes.snapshot())
+            upstream = upstream_for(url.path)
+            status, headers, payload = fakes.fault(upstream)
+            if status is None:
+                status, payload = fakes.handle(
+                    self.command,
+                    url.path,
+                    parse_qs(url.query),
+                    body,
+                    self.headers.get("Host"),
+                )
+            fakes.count(upstream, status)
+            self.send_json(status, headers, payload)
+
+        def send_json(self, status, headers, payload):
+            if isinstance(payload, str):
+                data = payload.encode()
+                content_type = "application/x-www-form-urlencoded"
+            else:
+                data = json.dumps(payload).encode()
+                content_type = "application/json"
+            self.send_response(status)
+            for name, value in headers.items():
+                self.send_header(name, value)
+            self.send_header("Content-Type", content_type)
+            self.send_header("Content-Length", str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        do_GET = do_POST = do_PUT = respond
+
+    return Handler
+
+
+def parse_profile(spec, profiles):
+    # "openai:latency=800,ratelimit=0.05"
+    name, _, settings = spec.partition(":")
+    for setting in filter(None, settings.split(",")):
+        key, _, value = setting.partition("=")
+        if key not in profiles[name]:
+            raise ValueError(f"unknown setting {key!r} for {name}")
+        profiles[name][key] = float(value)
+
+
+def serve(host="127.0.0.1", port=9100, specs=(), **options):
+    profiles = {name: dict(profile) for name, profile in DEFAULTS.items()}
+    for spec in specs:
+        parse_profile(spec, profiles)
+    fakes = FakeUpstreams(profiles, **options)
+    server = ThreadingHTTPServer((host, port), make_handler(fakes))
+    server.daemon_threads = True
+    server.fakes = fakes
+    return server
+
+
+def main():
+    parser = argparse.ArgumentParser(description="fake LinkedIn/Twitter/OpenAI")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=9100)
+    parser.add_argument(
+        "--profile",
+        action="append",
+        default=[],
+        help="upstream:key=value,... e.g. twitter:latency=40,limit=300,window=900",
+    )
+    parser.add_argument("--timeline-size", type=int, default=TIMELINE_SIZE)
+    parser.add_argument("--timeline-new", type=int, default=TIMELINE_NEW)
+    parser.add_argument("--seed", type=int, help="repeat the same injected faults")
+    args = parser.parse_args()
+    random.seed(args.seed)
+    server = serve(
+        args.host,
+        args.port,
+        args.profile,
+        timeline_size=args.timeline_size,
+        timeline_new=args.timeline_new,
+    )
+    print(f"fake upstreams on http://{args.host}:{args.port}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
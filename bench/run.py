@@ -0,0 +1,369 @@
+import argparse
+import io
+import json
+import os
+import shutil
+import socket
+import subprocess
+import sys
+import threading
+import tempfile
+import time
+from urllib.parse import parse_qs, urlsplit
+import requests
+
+# python bench/run.py --scenario all --concurrency 16 --requests 400
+#
+# starts bench/fakes.py and the app under gunicorn, both pointed at local
+# ports only, then drives each scenario with a closed loop of `concurrency`
+# clients and reports req/s and latency percentiles. /twitter/gpt under the
+# ASGI worker still calls api.twitter.com directly, so run the sync workers.
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+SCENARIOS = ("post", "upload", "gpt", "replyall", "login", "identity")
+
+try:
+    from PIL import Image
+except ImportError:
+    Image = None
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def wait_for_port(port, process, timeout=30):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError(f"{process.args[0]} exited with {process.returncode}")
+        try:
+            socket.create_connection(("127.0.0.1", port), timeout=0.5).close()
+            return
+        except OSError:
+            time.sleep(0.1)
+    raise RuntimeError(f"nothing listening on port {port} after {timeout}s")
+
+
+def start_fakes(port, profiles, seed):
+    args = [sys.executable, os.path.join(ROOT, "bench", "fakes.py")]
+    args += ["--port", str(port), "--seed", str(seed)]
+    for profile in profiles:
+        args += ["--profile", profile]
+    process = subprocess.Popen(args, stdout=subprocess.DEVNULL)
+    wait_for_port(port, process)
+    return process
+
+
+def start_app(port, fake_url, options):
+    env = dict(os.environ)
+    env.update(
+        UPSTREAM_OVERRIDE=fake_url,
+        OPENAI_BASE_URL=fake_url + "/v1",
+        OPEN_AI_KEY="bench",
+        CONSUMER_KEY="bench",
+        CONSUMER_SECRET="bench",
+        CALLBACK_URL="http://127.0.0.1/callback",
+        bearer_token="bench",
+        SESSION_SECRET="bench",
+        FRONTEND_URL="http://127.0.0.1/frontend",
+        OAUTH_TOKEN_STORE_PATH=os.path.join(options.workdir, "oauth_tokens.db"),
+        LOG_LEVEL=options.log_level,
+    )
+    args = [
+        "gunicorn",
+        "--bind",
+        f"127.0.0.1:{port}",
+        "--workers",
+        str(options.workers),
+        "--worker-class",
+        options.worker_class,
+        "--threads",
+        str(options.threads),
+        "--timeout",
+        "120",
+        "app:app",
+    ]
+    process = subprocess.Popen(args, cwd=ROOT, env=env, stderr=subprocess.DEVNULL)
+    wait_for_port(port, process)
+    return process
+
+
+def make_image(kb):
+    if Image is None:
+        return os.urandom(kb * 1024)
+    side = max(int((kb * 1024 / 3) ** 0.5), 16)
+    image = Image.frombytes("RGB", (side, side), os.urandom(side * side * 3))
+    out = io.BytesIO()
+    image.save(out, "JPEG", quality=95)
+    return out.getvalue()
+
+
+# each scenario returns a function that sends its i-th request
+def post_scenario(options):
+    def send(session, base, i):
+        return session.post(
+            base + "/post",
+            json={
+                "access_token": "bench",
+                "linkedin_id": "bench",
+                "content": f"Benchmark post {i}",
+            },
+        )
+
+    return send
+
+
+def upload_scenario(options):
+    image = make_image(options.image_kb)
+
+    def send(session, base, i):
+        # a unique tail keeps the media index from deduplicating every upload
+        data = image + os.urandom(16) if options.unique_images else image
+        return session.post(
+            base + "/upload",
+            data={
+                "access_token": "bench",
+                "linkedin_id": "bench",
+                "content": f"Benchmark upload {i}",
+            },
+            files={"file": ("bench.jpg", data, "image/jpeg")},
+        )
+
+    return send
+
+
+def credentials(i, users):
+    # tweepy reads the user id from the access token's prefix
+    user = i % users
+    return f"{1000 + user}-bench", f"secret-{user}"
+
+
+def gpt_scenario(options):
+    def send(session, base, i):
+        access_token, access_secret = credentials(i, options.users)
+        params = {"access_token": access_token, "access_secret": access_secret}
+        if options.strategy:
+            params["strategy"] = options.strategy
+        return session.get(base + "/twitter/gpt", params=params)
+
+    return send
+
+
+def replyall_scenario(options):
+    def send(session, base, i):
+        access_token, access_secret = credentials(i, options.users)
+        replies = [
+            {"tweet_id": str(i * 1000 + n), "reply": f"Benchmark reply {n}"}
+            for n in range(options.replies)
+        ]
+        return session.post(
+            base + "/twitter/replyall",
+            json={
+                "replies": replies,
+                "access_token": access_token,
+                "access_secret": access_secret,
+            },
+        )
+
+    return send
+
+
+# the full twitter sign-in: /oauth/twitter redirects to twitter, which
+# sends the browser back to the callback with the token and a verifier
+def login_scenario(options):
+    def send(session, base, i):
+        response = session.get(base + "/oauth/twitter", allow_redirects=False)
+        if response.status_code != 302:
+            return response
+        query = parse_qs(urlsplit(response.headers["Location"]).query)
+        return session.get(
+            base + "/oauth/callback/twitter",
+            params={
+                "oauth_token": query["oauth_token"][0],
+                "oauth_verifier": f"verifier-{i}",
+            },
+            allow_redirects=False,
+        )
+
+    return send
+
+
+# the frontend's page-load calls, alternating linkedin and twitter
+def identity_scenario(options):
+    def send(session, base, i):
+        access_token, access_secret = credentials(i // 2, options.users)
+        if i % 2:
+            return session.get(
+                base + "/getme",
+                headers={"Authorization": f"Bearer {access_token}"},
+            )
+        return session.get(
+            base + "/twitter/me",
+            params={"access_token": access_token, "access_secret": access_secret},
+        )
+
+    return send
+
+
+BUILDERS = {
+    "post": post_scenario,
+    "upload": upload_scenario,
+    "gpt": gpt_scenario,
+    "replyall": replyall_scenario,
+    "login": login_scenario,
+    "identity": identity_scenario,
+}
+
+
+def percentile(values, fraction):
+    if not values:
+        return 0.0
+    index = min(int(round(fraction * (len(values) - 1))), len(values) - 1)
+    return values[index]
+
+
+def drive(send, base, total, concurrency, duration=None):
+    counter = iter(range(total))
+    lock = threading.Lock()
+    latencies = list()
+    errors = dict()
+    deadline = time.monotonic() + duration if duration else None
+
+    def client():
+        session = requests.Session()
+        while True:
+            with lock:
+                i = next(counter, None)
+            if i is None or (deadline and time.monotonic() > deadline):
+                return
+            start = time.monotonic()
+            try:
+                status = send(session, base, i).status_code
+            except requests.RequestException as e:
+                status = type(e).__name__
+            elapsed = time.monotonic() - start
+            with lock:
+                latencies.append(elapsed)
+                if status not in (200, 201, 202, 302):
+                    errors[str(status)] = errors.get(str(status), 0) + 1
+
+    threads = [threading.Thread(target=client) for _ in range(concurrency)]
+    start = time.monotonic()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    wall = time.monotonic() - start
+
+    latencies.sort()
+    return {
+        "requests": len(latencies),
+        "errors": errors,
+        "seconds": round(wall, 3),
+        "rps": round(len(latencies) / wall, 2) if wall else 0.0,
+        "p50_ms": round(percentile(latencies, 0.50) * 1000, 1),
+        "p95_ms": round(percentile(latencies, 0.95) * 1000, 1),
+        "p99_ms": round(percentile(latencies, 0.99) * 1000, 1),
+    }
+
+
+def upstream_calls(fake_url):
+    return requests.get(fake_url + "/_stats").json()
+
+
+def diff(after, before):
+    return {
+        key: after[key] - before.get(key, 0)
+        for key in after
+        if after[key] != before.get(key, 0)
+    }
+
+
+def report(results):
+    header = f"{'scenario':<10}{'reqs':>7}{'errors':>8}{'req/s':>9}"
+    header += f"{'p50 ms':>9}{'p95 ms':>9}{'p99 ms':>9}"
+    print(header)
+    print("-" * len(header))
+    for name, result in results.items():
+        print(
+            f"{name:<10}{result['requests']:>7}{sum(result['errors'].values()):>8}"
+            f"{result['rps']:>9}{result['p50_ms']:>9}{result['p95_ms']:>9}"
+            f"{result['p99_ms']:>9}"
+        )
+    for name, result in results.items():
+        calls = ", ".join(f"{k}: {v}" for k, v in sorted(result["upstream"].items()))
+        print(f"{name} upstream calls: {calls}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="offline load test")
+    parser.add_argument("--scenario", action="append", choices=SCENARIOS + ("all",))
+    parser.add_argument("--requests", type=int, default=200)
+    parser.add_argument("--duration", type=float, help="stop each scenario early")
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument("--warmup", type=int, default=5)
+    parser.add_argument("--workers", type=int, default=2)
+    parser.add_argument("--worker-class", default="gthread")
+    parser.add_argument("--threads", type=int, default=8)
+    parser.add_argument(
+        "--profile",
+        action="append",
+        default=[],
+        help="passed to fakes.py, e.g. openai:latency=800,ratelimit=0.02",
+    )
+    parser.add_argument("--users", type=int, default=20)
+    parser.add_argument("--replies", type=int, default=5)
+    parser.add_argument("--strategy", choices=("fanout", "batch"))
+    parser.add_argument("--image-kb", type=int, default=256)
+    parser.add_argument(
+        "--same-image",
+        dest="unique_images",
+        action="store_false",
+        help="upload identical bytes every time",
+    )
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--log-level", default="WARNING")
+    parser.add_argument("--json", help="also write the results to this file")
+    options = parser.parse_args()
+    # shared state files of the app under test, e.g. its oauth token store
+    options.workdir = tempfile.mkdtemp(prefix="bench-")
+
+    scenarios = options.scenario or ["all"]
+    if "all" in scenarios:
+        scenarios = SCENARIOS
+
+    fake_port, app_port = free_port(), free_port()
+    fake_url = f"http://127.0.0.1:{fake_port}"
+    base = f"http://127.0.0.1:{app_port}"
+    fakes = start_fakes(fake_port, options.profile, options.seed)
+    app = None
+    try:
+        app = start_app(app_port, fake_url, options)
+        results = dict()
+        for name in scenarios:
+            send = BUILDERS[name](options)
+            drive(send, base, options.warmup, min(options.concurrency, options.warmup))
+            before = upstream_calls(fake_url)
+            result = drive(
+                send, base, options.requests, options.concurrency, options.duration
+            )
+            result["upstream"] = diff(upstream_calls(fake_url), before)
+            results[name] = result
+    finally:
+        for process in (app, fakes):
+            if process is not None:
+                process.terminate()
+                process.wait()
+        shutil.rmtree(options.workdir, ignore_errors=True)
+
+    report(results)
+    if options.json:
+        with open(options.json, "w") as out:
+            json.dump({"options": vars(options), "results": results}, out, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,267 @@
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+
+# thread-safe LRU with per-entry expiry
+class TTLCache:
+    def __init__(self, maxsize=1024, ttl=300):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    def get(self, key, default=None):
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None:
+                self.misses += 1
+                return default
+            expires_at, value = entry
+            if expires_at <= time.monotonic():
+                del self._data[key]
+                self.expirations += 1
+                self.misses += 1
+                return default
+            self._data.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def set(self, key, value, ttl=None):
+        expires_at = time.monotonic() + (self.ttl if ttl is None else ttl)
+        with self._lock:
+            self._data[key] = (expires_at, value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+                self.evictions += 1
+
+    def delete(self, key):
+        with self._lock:
+            return self._data.pop(key, None) is not None
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def __len__(self):
+        with self._lock:
+            return len(self._data)
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "size": len(self._data),
+                "maxsize": self.maxsize,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+                "evictions": self.evictions,
+                "expirations": self.expirations,
+            }
+
+
+# same interface as TTLCache, backed by a sqlite file so several worker
+# processes can share entries; values must be JSON serialisable
+class SQLiteCache:
+    def __init__(self, path, maxsize=1024, ttl=300, table="cache"):
+        self.path = path
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.table = table
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    # the file and table are created on first use, so importing a module
+    # that declares a cache leaves nothing on disk
+    def _connect(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is None or self._local.pid != os.getpid():
+            conn = sqlite3.connect(self.path, timeout=5, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.execute(
+                f"CREATE TABLE IF NOT EXISTS {self.table} ("
+                "key TEXT PRIMARY KEY, value TEXT NOT NULL, "
+                "expires_at REAL NOT NULL, accessed_at REAL NOT NULL)"
+            )
+            self._local.conn = conn
+            self._local.pid = os.getpid()
+        return conn
+
+    def _count(self, field, amount=1):
+        with self._lock:
+            setattr(self, field, getattr(self, field) + amount)
+
+    def get(self, key, default=None):
+        key = json.dumps(key)
+        conn = self._connect()
+        row = conn.execute(
+            f"SELECT value, expires_at, accessed_at FROM {self.table} WHERE key = ?",
+            (key,),
+        ).fetchone()
+        if row is None:
+            self._count("misses")
+            return default
+        now = time.time()
+        if row[1] <= now:
+            conn.execute(f"DELETE FROM {self.table} WHERE key = ?", (key,))
+            self._count("expirations")
+            self._count("misses")
+            return default
+        # a hit is a write only once its recency has drifted by a tenth of
+        # the ttl, which is plenty for choosing what to evict
+        if now - row[2] > self.ttl / 10:
+            conn.execute(
+                f"UPDATE {self.table} SET accessed_at = ? WHERE key = ?", (now, key)
+            )
+        self._count("hits")
+        return json.loads(row[0])
+
+    def set(self, key, value, ttl=None):
+        now = time.time()
+        expires_at = now + (self.ttl if ttl is None else ttl)
+        conn = self._connect()
+        conn.execute(
+            f"INSERT OR REPLACE INTO {self.table} VALUES (?, ?, ?, ?)",
+            (json.dumps(key), json.dumps(value), expires_at, now),
+        )
+        excess = conn.execute(f"SELECT COUNT(*) FROM {self.table}").fetchone()[0]
+        excess -= self.maxsize
+        if excess > 0:
+            conn.execute(
+                f"DELETE FROM {self.table} WHERE key IN "
+                f"(SELECT key FROM {self.table} ORDER BY accessed_at LIMIT ?)",
+                (excess,),
+            )
+            self._count("evictions", excess)
+
+    def delete(self, key):
+        cursor = self._connect().execute(
+            f"DELETE FROM {self.table} WHERE key = ?", (json.dumps(key),)
+        )
+        return cursor.rowcount > 0
+
+    def clear(self):
+        self._connect().execute(f"DELETE FROM {self.table}")
+
+    def __len__(self):
+        conn = self._connect()
+        return conn.execute(f"SELECT COUNT(*) FROM {self.table}").fetchone()[0]
+
+    def stats(self):
+        size = len(self)
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "size": size,
+                "maxsize": self.maxsize,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+                "evictions": self.evictions,
+                "expirations": self.expirations,
+                "path": self.path,
+            }
+
+
+def make_cache(maxsize, ttl, path=None, table="cache"):
+    if path:
+        return SQLiteCache(path, maxsize=maxsize, ttl=ttl, table=table)
+    return TTLCache(maxsize=maxsize, ttl=ttl)
+
+
+# cache key for a credential, so tokens never sit in a cache in the clear
+def token_hash(*parts):
+    return hashlib.sha256("\0".join(map(str, parts)).encode()).hexdigest()
+
+
+class _Call:
+    def __init__(self):
+        self.done = threading.Event()
+        self.value = None
+        self.error = None
+
+
+# concurrent calls for the same key share the first caller's result, or
+# its exception, instead of each making their own
+class SingleFlight:
+    def __init__(self):
+        self._calls = dict()
+        self._lock = threading.Lock()
+        self.calls = 0
+        self.shared = 0
+
+    def do(self, key, fn):
+        call, leader = self.begin(key)
+        if not leader:
+            return self.wait(call)
+        try:
+            value = fn()
+        except BaseException as e:
+            self.finish(key, call, error=e)
+            raise
+        self.finish(key, call, value)
+        return value
+
+    # for callers that answer many keys at once: a leader must end its call
+    # with finish(), anyone else waits for it
+    def begin(self, key):
+        with self._lock:
+            call = self._calls.get(key)
+            if call is not None:
+                self.shared += 1
+                return call, False
+            call = self._calls[key] = _Call()
+            self.calls += 1
+            return call, True
+
+    def finish(self, key, call, value=None, error=None):
+        call.value = value
+        call.error = error
+        with self._lock:
+            del self._calls[key]
+        call.done.set()
+
+    def wait(self, call):
+        call.done.wait()
+        if call.error is not None:
+            raise call.error
+        return call.value
+
+    def stats(self):
+        with self._lock:
+            return {
+                "in_flight": len(self._calls),
+                "calls": self.calls,
+                "shared": self.shared,
+            }
+
+
+# a miss runs `load` once however many threads miss the same key together;
+# None is not cached, and neither is an exception
+def get_or_load(cache, flight, key, load):
+    value = cache.get(key)
+    if value is not None:
+        return value
+
+    def fill():
+        value = load()
+        if value is not None:
+            cache.set(key, value)
+        return value
+
+    return flight.do(key, fill)
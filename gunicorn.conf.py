@@ -0,0 +1,21 @@
+import os
+
+# gunicorn picks this file up from the working directory.
+# WARMUP=1 does the slow imports and client setup before traffic arrives:
+# with --preload the master imports everything once and the forked workers
+# share it, and every worker builds its clients right after booting
+WARMUP = os.getenv("WARMUP") == "1"
+
+
+def when_ready(server):
+    if WARMUP and server.cfg.preload_app:
+        import app
+
+        app.warmup()
+
+
+def post_worker_init(worker):
+    if WARMUP:
+        import app
+
+        app.warmup(clients=True)
@@ -0,0 +1,191 @@
+import os
+import threading
+import requests
+from urllib.parse import urlsplit
+from requests.adapters import HTTPAdapter
+from urllib3 import HTTPConnectionPool, HTTPSConnectionPool
+import resilience
+
+# (connect, read) in seconds; requests treats a bare number as both
+CONNECT_TIMEOUT = float(os.getenv("HTTP_CONNECT_TIMEOUT", "3.05"))
+READ_TIMEOUT = float(os.getenv("HTTP_READ_TIMEOUT", "30"))
+DEFAULT_TIMEOUT = (CONNECT_TIMEOUT, READ_TIMEOUT)
+
+DEFAULT_POOL_SIZE = int(os.getenv("HTTP_POOL_SIZE", "10"))
+POOL_SIZES = {
+    "https://api.linkedin.com": int(os.getenv("LINKEDIN_POOL_SIZE", "20")),
+    "https://api.twitter.com": int(os.getenv("TWITTER_POOL_SIZE", "20")),
+}
+
+# sends every LinkedIn/Twitter call to this base url instead, e.g. the fake
+# servers in bench/; unset in production
+UPSTREAM_OVERRIDE = os.getenv("UPSTREAM_OVERRIDE")
+UPSTREAM_PREFIXES = (
+    "https://api.linkedin.com",
+    "https://api.twitter.com",
+    "https://upload.twitter.com",
+)
+
+# hosts are reported under these names in metrics and logs
+UPSTREAMS = {
+    "api.linkedin.com": "linkedin",
+    "api.twitter.com": "twitter",
+}
+
+_lock = threading.Lock()
+_session = None
+_session_pid = None
+
+_stats_lock = threading.Lock()
+_stats = {}
+
+
+def _record(host, field):
+    with _stats_lock:
+        counters = _stats.setdefault(host, {"checkouts": 0, "misses": 0})
+        counters[field] += 1
+
+
+# every checkout that does not have to open a new socket is a pool hit
+class _CountingHTTPConnectionPool(HTTPConnectionPool):
+    def _get_conn(self, timeout=None):
+        _record(self.host, "checkouts")
+        return super()._get_conn(timeout)
+
+    def _new_conn(self):
+        _record(self.host, "misses")
+        return super()._new_conn()
+
+
+class _CountingHTTPSConnectionPool(HTTPSConnectionPool):
+    def _get_conn(self, timeout=None):
+        _record(self.host, "checkouts")
+        return super()._get_conn(timeout)
+
+    def _new_conn(self):
+        _record(self.host, "misses")
+        return super()._new_conn()
+
+
+class PooledAdapter(HTTPAdapter):
+    def init_poolmanager(self, *args, **kwargs):
+        super().init_poolmanager(*args, **kwargs)
+        self.poolmanager.pool_classes_by_scheme = {
+            "http": _CountingHTTPConnectionPool,
+            "https": _CountingHTTPSConnectionPool,
+        }
+
+    # tweepy sends without a timeout, which would wait on a hung upstream
+    # forever
+    def send(self, request, timeout=None, **kwargs):
+        if timeout is None:
+            timeout = resilience.timeout(DEFAULT_TIMEOUT)
+        try:
+            return super().send(request, timeout=timeout, **kwargs)
+        except requests.Timeout as e:
+            # cut short by our own deadline, which says nothing about the
+            # upstream's health
+            left = resilience.remaining()
+            if left is not None and left <= 0:
+                if isinstance(e, requests.ConnectTimeout):
+                    raise resilience.DeadlineExceeded(
+                        "the request deadline has passed"
+                    ) from e
+                raise resilience.DeadlineExceededAfterSend(
+                    "the request deadline passed before the response arrived"
+                ) from e
+            raise
+
+
+class RewritingAdapter(PooledAdapter):
+    def __init__(self, prefix, base, **kwargs):
+        self.prefix = prefix
+        self.base = base.rstrip("/")
+        super().__init__(**kwargs)
+
+    def send(self, request, **kwargs):
+        request.url = self.base + request.url[len(self.prefix) :]
+        return super().send(request, **kwargs)
+
+
+def _adapter(prefix, size):
+    if UPSTREAM_OVERRIDE:
+        return RewritingAdapter(
+            prefix, UPSTREAM_OVERRIDE, pool_connections=1, pool_maxsize=size
+        )
+    return PooledAdapter(pool_connections=1, pool_maxsize=size)
+
+
+def upstream_url(url):
+    for prefix in UPSTREAM_PREFIXES:
+        if UPSTREAM_OVERRIDE and url.startswith(prefix):
+            return UPSTREAM_OVERRIDE.rstrip("/") + url[len(prefix) :]
+    return url
+
+
+# for sessions owned by other libraries (tweepy): default timeouts, and
+# the UPSTREAM_OVERRIDE redirect when it is set
+def route_upstreams(session):
+    for prefix in UPSTREAM_PREFIXES:
+        session.mount(prefix, _adapter(prefix, DEFAULT_POOL_SIZE))
+
+
+def _build_session():
+    session = requests.Session()
+    default_adapter = PooledAdapter(
+        pool_connections=len(POOL_SIZES) + 4, pool_maxsize=DEFAULT_POOL_SIZE
+    )
+    session.mount("https://", default_adapter)
+    session.mount("http://", default_adapter)
+    route_upstreams(session)
+    for prefix, size in POOL_SIZES.items():
+        session.mount(prefix, _adapter(prefix, size))
+    return session
+
+
+def get_session():
+    global _session, _session_pid
+    # a session inherited through fork shares sockets with the parent
+    if _session is None or _session_pid != os.getpid():
+        with _lock:
+            if _session is None or _session_pid != os.getpid():
+                _session = _build_session()
+                _session_pid = os.getpid()
+    return _session
+
+
+# hedge=True may send the request twice; only for reads
+def request(method, url, operation=None, hedge=False, **kwargs):
+    timeout = kwargs.pop("timeout", DEFAULT_TIMEOUT)
+    host = urlsplit(url).hostname
+    upstream = UPSTREAMS.get(host, host)
+
+    def send():
+        with resilience.guarded(upstream, operation or method.lower()) as span:
+            response = get_session().request(
+                method, url, timeout=resilience.timeout(timeout), **kwargs
+            )
+            span.status = response.status_code
+        return response
+
+    if hedge:
+        return resilience.hedged(
+            upstream, send, ok=lambda response: response.status_code < 500
+        )
+    return send()
+
+
+def get(url, **kwargs):
+    return request("GET", url, **kwargs)
+
+
+def post(url, **kwargs):
+    return request("POST", url, **kwargs)
+
+
+def pool_stats():
+    with _stats_lock:
+        snapshot = {host: dict(counters) for host, counters in _stats.items()}
+    for counters in snapshot.values():
+        counters["hits"] = counters["checkouts"] - counters["misses"]
+    return snapshot
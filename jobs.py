@@ -0,0 +1,326 @@
+import io
+import json
+import os
+import sqlite3
+import threading
+import time
+import uuid
+import linkedin_helper
+import twitter_helper
+import publisher
+import resilience
+from cache import token_hash
+
+# durable local queue for publish requests: the route stores the job and
+# returns its id, worker threads make the upstream calls
+JOBS_DB_PATH = os.getenv("JOBS_DB_PATH", "./jobs.db")
+JOB_WORKERS = int(os.getenv("JOB_WORKERS", "2"))
+JOB_MAX_ATTEMPTS = int(os.getenv("JOB_MAX_ATTEMPTS", "3"))
+JOB_RETRY_DELAY = float(os.getenv("JOB_RETRY_DELAY", "5"))
+JOB_POLL_INTERVAL = 1.0
+# a job still running this long after it was claimed belongs to a worker
+# that stopped; it may or may not have been posted, so it is marked unknown
+JOB_LEASE = float(os.getenv("JOB_LEASE", "900"))
+# finished jobs are deleted after this long
+JOB_RETENTION = float(os.getenv("JOB_RETENTION", str(7 * 24 * 3600)))
+JOB_MAINTENANCE_INTERVAL = 60.0
+
+FINISHED = ("done", "failed", "unknown")
+# dropped from the payload once a job has finished
+SECRET_FIELDS = ("access_token", "access_secret")
+
+HANDLERS = dict()
+
+_local = threading.local()
+_wakeup = threading.Event()
+_workers_lock = threading.Lock()
+_workers_pid = None
+_maintenance_lock = threading.Lock()
+_last_maintenance = None
+
+
+def _connect():
+    conn = getattr(_local, "conn", None)
+    if conn is None or _local.pid != os.getpid():
+        conn = sqlite3.connect(JOBS_DB_PATH, timeout=10, isolation_level=None)
+        conn.row_factory = sqlite3.Row
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS jobs ("
+            "id TEXT PRIMARY KEY, kind TEXT NOT NULL, payload TEXT NOT NULL, "
+            "media BLOB, status TEXT NOT NULL, attempts INTEGER NOT NULL, "
+            "idempotency_key TEXT UNIQUE, result TEXT, error TEXT, "
+            "run_at REAL NOT NULL, created_at REAL NOT NULL, "
+            "updated_at REAL NOT NULL, claimed_at REAL)"
+        )
+        conn.execute("CREATE INDEX IF NOT EXISTS jobs_pending ON jobs (status, run_at)")
+        _migrate(conn)
+        _local.conn = conn
+        _local.pid = os.getpid()
+    return conn
+
+
+def _columns(conn):
+    return {row["name"] for row in conn.execute("PRAGMA table_info(jobs)")}
+
+
+# databases created before the lease was added
+def _migrate(conn):
+    if "claimed_at" in _columns(conn):
+        return
+    try:
+        conn.execute("ALTER TABLE jobs ADD COLUMN claimed_at REAL")
+    except sqlite3.OperationalError:
+        # another worker added it first
+        if "claimed_at" not in _columns(conn):
+            raise
+
+
+def handler(kind):
+    def register(fn):
+        HANDLERS[kind] = fn
+        return fn
+
+    return register
+
+
+def _public(row):
+    if row is None:
+        return None
+    return {
+        "id": row["id"],
+        "kind": row["kind"],
+        "status": row["status"],
+        "attempts": row["attempts"],
+        "result": json.loads(row["result"]) if row["result"] else None,
+        "error": row["error"],
+        "created_at": row["created_at"],
+        "updated_at": row["updated_at"],
+    }
+
+
+def get_job(job_id):
+    # queued jobs left over from a restart are picked up once anyone looks;
+    # running ones are marked unknown when their lease runs out
+    start_workers()
+    row = _connect().execute("SELECT * FROM jobs WHERE id = ?", (job_id,))
+    return _public(row.fetchone())
+
+
+def _scrub(value):
+    if isinstance(value, dict):
+        return {k: _scrub(v) for k, v in value.items() if k not in SECRET_FIELDS}
+    return value
+
+
+def _access_tokens(value):
+    if not isinstance(value, dict):
+        return []
+    tokens = [str(value["access_token"])] if value.get("access_token") else []
+    for nested in value.values():
+        tokens.extend(_access_tokens(nested))
+    return sorted(tokens)
+
+
+# an idempotency key that was already used returns the original job, so a
+# client retrying the same request cannot queue the post twice. keys are
+# scoped to the kind and the accounts posted to, so one client cannot see
+# or block another's job by guessing its key
+def enqueue(kind, payload, media=None, idempotency_key=None):
+    if kind not in HANDLERS:
+        raise ValueError(f"Unknown job kind: {kind}")
+    if idempotency_key is not None:
+        idempotency_key = token_hash(kind, *_access_tokens(payload), idempotency_key)
+    now = time.time()
+    job_id = uuid.uuid4().hex
+    conn = _connect()
+    try:
+        conn.execute(
+            "INSERT INTO jobs (id, kind, payload, media, status, attempts, "
+            "idempotency_key, run_at, created_at, updated_at) "
+            "VALUES (?, ?, ?, ?, 'queued', 0, ?, ?, ?, ?)",
+            (job_id, kind, json.dumps(payload), media, idempotency_key, now, now, now),
+        )
+    except sqlite3.IntegrityError:
+        row = conn.execute(
+            "SELECT * FROM jobs WHERE idempotency_key = ?", (idempotency_key,)
+        ).fetchone()
+        return _public(row)
+    start_workers()
+    _wakeup.set()
+    return get_job(job_id)
+
+
+def _claim():
+    conn = _connect()
+    now = time.time()
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        row = conn.execute(
+            "SELECT * FROM jobs WHERE status = 'queued' AND run_at <= ? "
+            "ORDER BY run_at LIMIT 1",
+            (now,),
+        ).fetchone()
+        if row is not None:
+            conn.execute(
+                "UPDATE jobs SET status = 'running', attempts = attempts + 1, "
+                "claimed_at = ?, updated_at = ? WHERE id = ?",
+                (now, now, row["id"]),
+            )
+        conn.execute("COMMIT")
+    except Exception:
+        conn.execute("ROLLBACK")
+        raise
+    return row
+
+
+def _finish(row, status, result=None, error=None, run_at=None):
+    now = time.time()
+    conn = _connect()
+    if status in FINISHED:
+        # credentials and the image are only kept while the job may still run
+        payload = json.dumps(_scrub(json.loads(row["payload"])))
+        conn.execute(
+            "UPDATE jobs SET status = ?, payload = ?, media = NULL, result = ?, "
+            "error = ?, updated_at = ? WHERE id = ?",
+            (status, payload, result, error, now, row["id"]),
+        )
+        return
+    # a job whose lease already ran out stays unknown
+    conn.execute(
+        "UPDATE jobs SET status = ?, error = ?, run_at = ?, updated_at = ? "
+        "WHERE id = ? AND status = 'running'",
+        (status, error, run_at, now, row["id"]),
+    )
+
+
+def _run(row):
+    try:
+        result = HANDLERS[row["kind"]](json.loads(row["payload"]), row["media"])
+    except Exception as e:
+        attempts = row["attempts"] + 1
+        # anything that may have reached the platform is not run again
+        if attempts >= JOB_MAX_ATTEMPTS or not resilience.safe_to_retry(e):
+            _finish(row, "failed", error=str(e))
+        else:
+            delay = JOB_RETRY_DELAY * 2 ** (attempts - 1)
+            _finish(row, "queued", error=str(e), run_at=time.time() + delay)
+        return
+    _finish(row, "done", result=json.dumps(result, default=str))
+
+
+def _expire_leases(conn, now):
+    rows = conn.execute(
+        "SELECT * FROM jobs WHERE status = 'running' "
+        "AND COALESCE(claimed_at, updated_at) < ?",
+        (now - JOB_LEASE,),
+    ).fetchall()
+    for row in rows:
+        conn.execute(
+            "UPDATE jobs SET status = 'unknown', payload = ?, media = NULL, "
+            "error = ?, updated_at = ? WHERE id = ? AND status = 'running'",
+            (
+                json.dumps(_scrub(json.loads(row["payload"]))),
+                "The worker stopped before the job finished; it may have been posted",
+                now,
+                row["id"],
+            ),
+        )
+
+
+def _purge(conn, now):
+    conn.execute(
+        f"DELETE FROM jobs WHERE status IN ({', '.join('?' * len(FINISHED))}) "
+        "AND updated_at < ?",
+        (*FINISHED, now - JOB_RETENTION),
+    )
+
+
+def _maintain():
+    global _last_maintenance
+    started = time.monotonic()
+    with _maintenance_lock:
+        if (
+            _last_maintenance is not None
+            and started - _last_maintenance < JOB_MAINTENANCE_INTERVAL
+        ):
+            return
+        _last_maintenance = started
+    conn = _connect()
+    now = time.time()
+    _expire_leases(conn, now)
+    _purge(conn, now)
+
+
+def _worker():
+    while True:
+        try:
+            _maintain()
+            row = _claim()
+        except sqlite3.OperationalError:
+            row = None
+        if row is None:
+            _wakeup.wait(JOB_POLL_INTERVAL)
+            _wakeup.clear()
+            continue
+        _run(row)
+
+
+def start_workers():
+    global _workers_pid
+    if _workers_pid == os.getpid():
+        return
+    with _workers_lock:
+        if _workers_pid == os.getpid():
+            return
+        for _ in range(JOB_WORKERS):
+            threading.Thread(target=_worker, daemon=True).start()
+        _workers_pid = os.getpid()
+
+
+def _media_stream(media):
+    return None if media is None else io.BytesIO(media)
+
+
+@handler("linkedin_post")
+def _linkedin_post(payload, media):
+    if media is None:
+        return linkedin_helper.create_linkedin_post(
+            payload["access_token"], payload["linkedin_id"], payload["content"]
+        )
+    return linkedin_helper.post_image(
+        payload["access_token"],
+        payload["linkedin_id"],
+        payload["content"],
+        payload["filename"],
+        _media_stream(media),
+    )
+
+
+@handler("tweet")
+def _tweet(payload, media):
+    data = twitter_helper.post_tweet(
+        payload["text"],
+        payload["access_token"],
+        payload["access_secret"],
+        payload.get("filename"),
+        _media_stream(media),
+    )
+    return data.data
+
+
+@handler("publish")
+def _publish(payload, media):
+    results = publisher.publish(
+        payload["content"],
+        payload["credentials"],
+        payload.get("filename"),
+        _media_stream(media),
+    )
+    # retry the whole job only if no platform can have the post, so none is
+    # posted to twice
+    if all(result["status"] == "error" for result in results.values()):
+        if all(result["retryable"] for result in results.values()):
+            raise resilience.NotPublished(results)
+        raise Exception(results)
+    return results
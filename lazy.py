@@ -0,0 +1,154 @@
+import importlib
+import importlib.util
+import logging
+import os
+import sys
+import threading
+import time
+import types
+import telemetry
+
+# STARTUP_PROFILE=1 logs how long each module took to import and each lazy
+# client took to build
+STARTUP_PROFILE = os.getenv("STARTUP_PROFILE") == "1"
+REPORT_SIZE = 30
+
+logger = logging.getLogger("startup")
+
+_lazy_modules = list()
+_singletons = list()
+_timings = dict()
+_started = time.perf_counter()
+
+
+def record(name, seconds):
+    _timings[name] = _timings.get(name, 0.0) + seconds
+
+
+# stands in for a module until one of its attributes is used. unlike
+# importlib's LazyLoader, which lets other threads see the module while it
+# is still executing on python < 3.12, the real import goes through
+# import_module and its per-module lock
+class LazyModule(types.ModuleType):
+    def __getattr__(self, attribute):
+        return getattr(self.load(), attribute)
+
+    def load(self):
+        return importlib.import_module(self.__name__)
+
+
+# workers that never use the module never pay for importing it. returns
+# None when the module is not installed, like a guarded import
+def lazy_import(name):
+    if name in sys.modules:
+        return sys.modules[name]
+    try:
+        if importlib.util.find_spec(name) is None:
+            return None
+    except ModuleNotFoundError:
+        return None
+    module = LazyModule(name)
+    _lazy_modules.append(module)
+    return module
+
+
+# forces every lazy module to load, e.g. in a preloading master so the
+# workers it forks share them
+def load_all():
+    for module in _lazy_modules:
+        module.load()
+
+
+# built on first use and again in a forked child, whose copy would share
+# the parent's sockets
+class ForkSafe:
+    def __init__(self, name, factory):
+        self.name = name
+        self.factory = factory
+        self._value = None
+        self._lock = threading.Lock()
+        _singletons.append(self)
+
+    def get(self):
+        value = self._value
+        if value is None:
+            with self._lock:
+                if self._value is None:
+                    started = time.perf_counter()
+                    self._value = self.factory()
+                    record(f"init:{self.name}", time.perf_counter() - started)
+                value = self._value
+        return value
+
+    def _after_fork(self):
+        self._value = None
+        self._lock = threading.Lock()
+
+
+def _reset_singletons():
+    for singleton in _singletons:
+        singleton._after_fork()
+
+
+os.register_at_fork(after_in_child=_reset_singletons)
+
+
+class _TimedLoader:
+    def __init__(self, loader, name):
+        self._loader = loader
+        self._name = name
+
+    def __getattr__(self, attribute):
+        return getattr(self._loader, attribute)
+
+    def create_module(self, spec):
+        return self._loader.create_module(spec)
+
+    def exec_module(self, module):
+        started = time.perf_counter()
+        try:
+            self._loader.exec_module(module)
+        finally:
+            # cumulative: a package's time includes what it imports
+            record(f"import:{self._name}", time.perf_counter() - started)
+
+
+class _TimingFinder:
+    @classmethod
+    def find_spec(cls, name, path=None, target=None):
+        # only top-level packages and the app's own modules, to keep the
+        # report short
+        if "." in name:
+            return None
+        for finder in sys.meta_path:
+            if finder is cls or not hasattr(finder, "find_spec"):
+                continue
+            spec = finder.find_spec(name, path, target)
+            if spec is not None:
+                if spec.loader is not None and hasattr(spec.loader, "exec_module"):
+                    spec.loader = _TimedLoader(spec.loader, name)
+                return spec
+        return None
+
+
+def profile_imports():
+    if STARTUP_PROFILE and _TimingFinder not in sys.meta_path:
+        sys.meta_path.insert(0, _TimingFinder)
+
+
+def report(stage):
+    if not STARTUP_PROFILE:
+        return
+    slowest = sorted(_timings.items(), key=lambda item: -item[1])
+    timings = {
+        name: round(seconds * 1000, 1) for name, seconds in slowest[:REPORT_SIZE]
+    }
+    telemetry.log(
+        logger,
+        logging.INFO,
+        "startup profile",
+        stage=stage,
+        pid=os.getpid(),
+        since_start_ms=round((time.perf_counter() - _started) * 1000, 1),
+        timings_ms=timings,
+    )
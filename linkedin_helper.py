@@ -1,6 +1,86 @@
+import logging
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
 import requests
+import http_client
+import media
 import json
 from mimetypes import guess_type
+import resilience
+import telemetry
+from cache import SingleFlight, get_or_load, make_cache, token_hash
+
+logger = logging.getLogger("linkedin")
+
+_pipeline_executor = ThreadPoolExecutor(
+    max_workers=int(os.getenv("LINKEDIN_PIPELINE_WORKERS", "8"))
+)
+_timings_lock = threading.Lock()
+pipeline_timings = {
+    "runs": 0,
+    "media_cache_hits": 0,
+    "receive": 0.0,
+    "prepare": 0.0,
+    "register": 0.0,
+    "register_wait": 0.0,
+    "upload": 0.0,
+    "post": 0.0,
+    "saved": 0.0,
+    "wasted_registrations": 0,
+}
+
+# the signed-in member's userinfo by token hash; the frontend asks for it on
+# nearly every page load. set IDENTITY_CACHE_PATH to share it across workers
+userinfo_cache = make_cache(
+    maxsize=int(os.getenv("IDENTITY_CACHE_SIZE", "10000")),
+    ttl=float(os.getenv("IDENTITY_CACHE_TTL", "60")),
+    path=os.getenv("IDENTITY_CACHE_PATH"),
+    table="linkedin_userinfo",
+)
+_userinfo_flight = SingleFlight()
+
+
+# gateways answer 5xx with html
+def _body(response):
+    try:
+        return response.json()
+    except ValueError:
+        return response.text
+
+
+# a 429 was refused outright, and registerUpload and the upload come before
+# the post; either can be run again without publishing twice
+def _api_error(message, response, before_post=False):
+    status = response.status_code
+    if status == 429 or (before_post and resilience.retryable_status(status)):
+        return resilience.NotPublished(message)
+    return Exception(message)
+
+
+# raises requests.HTTPError for anything but a 200, which is not cached
+def get_userinfo(access_token):
+    def fetch():
+        response = http_client.get(
+            "https://api.linkedin.com/v2/userinfo",
+            operation="userinfo",
+            hedge=True,
+            headers={"Authorization": f"Bearer {access_token}"},
+        )
+        if response.status_code != 200:
+            raise requests.HTTPError(
+                f"LinkedIn userinfo returned {response.status_code}",
+                response=response,
+            )
+        return response.json()
+
+    key = token_hash(access_token)
+    return get_or_load(userinfo_cache, _userinfo_flight, key, fetch)
+
+
+def userinfo_stats():
+    return {**userinfo_cache.stats(), "flight": _userinfo_flight.stats()}
 
 
 def create_linkedin_post(access_token, linkedin_id, content):
@@ -22,15 +102,17 @@ def create_linkedin_post(access_token, linkedin_id, content):
         "visibility": {"com.linkedin.ugc.MemberNetworkVisibility": "PUBLIC"},
     }
 
-    response = requests.post(
+    response = http_client.post(
         "https://api.linkedin.com/v2/ugcPosts",
+        operation="ugcPosts",
         headers=headers,
         json=post_data,
-        timeout=10000,
     )
     if response.status_code != 201:
-        raise Exception(f"LinkedIn API Error: {response.json()}")
-    print(response.json())
+        raise _api_error(f"LinkedIn API Error: {_body(response)}", response)
+    telemetry.log(
+        logger, logging.INFO, "post created", post_id=response.json().get("id")
+    )
     return response.json()
 
 
@@ -54,46 +136,51 @@ def register_image(access_token, linkedin_id):
         }
     }
 
-    response = requests.post(
+    response = http_client.post(
         "https://api.linkedin.com/v2/assets?action=registerUpload",
+        operation="registerUpload",
         headers=headers,
         json=body,
-        timeout=10000,
     )
 
     if response.status_code != 200:
-        raise Exception(f"LinkedIn Image Register API Error: {response.json()}")
+        raise _api_error(
+            f"LinkedIn Image Register API Error: {_body(response)}",
+            response,
+            before_post=True,
+        )
 
     return response.json()
 
 
-def uploadImage(upload_url, access_token, path):
+def uploadImage(upload_url, access_token, path, stream=None):
     headers = {
         "X-Restli-Protocol-Version": "2.0.0",
         "Authorization": f"Bearer {access_token}",
+        "Content-Type": guess_type(path)[0] or "application/octet-stream",
     }
 
-    content_type = guess_type(path)[0]
-    with open(path, "rb") as image:
-        files = {"file": (path, image, content_type)}
-        response = requests.post(
-            upload_url, headers=headers, files=files, timeout=10000
+    # the image goes out as the raw request body, read in small blocks from
+    # the upload stream rather than assembled into a multipart body
+    if stream is None:
+        with open(path, "rb") as image:
+            return uploadImage(upload_url, access_token, path, image)
+    response = http_client.post(
+        upload_url,
+        operation="upload",
+        headers=headers,
+        data=media.SizedStream(stream),
+    )
+    if response.status_code != 201:
+        raise _api_error(
+            f"LinkedIn Image Upload API Error: {response.status_code}",
+            response,
+            before_post=True,
         )
-        if response.status_code != 201:
-            raise Exception(
-                f"LinkedIn Image Register API Error: {response.status_code()}"
-            )
-        print(response.status_code)
 
 
-def create_linkedin_post_image(access_token, linkedin_id, content, asset_id):
-    headers = {
-        "Authorization": f"Bearer {access_token}",
-        "X-Restli-Protocol-Version": "2.0.0",
-        "Content-Type": "application/json",
-    }
-
-    post_data = {
+def image_post_data(linkedin_id, content, asset_id):
+    return {
         "author": f"urn:li:person:{linkedin_id}",
         "lifecycleState": "PUBLISHED",
         "specificContent": {
@@ -113,16 +200,194 @@ def create_linkedin_post_image(access_token, linkedin_id, content, asset_id):
         "visibility": {"com.linkedin.ugc.MemberNetworkVisibility": "PUBLIC"},
     }
 
-    response = requests.post(
+
+def publish_image_post(access_token, post_data):
+    headers = {
+        "Authorization": f"Bearer {access_token}",
+        "X-Restli-Protocol-Version": "2.0.0",
+        "Content-Type": "application/json",
+    }
+
+    response = http_client.post(
         "https://api.linkedin.com/v2/ugcPosts",
+        operation="ugcPosts",
         headers=headers,
         json=post_data,
-        timeout=10000,
     )
     if response.status_code != 201:
-        raise Exception(f"LinkedIn API Error: {response.json()}")
+        raise _api_error(f"LinkedIn API Error: {_body(response)}", response)
 
     posted_url = {
         "url": f'https://www.linkedin.com/feed/update/{response.json()["id"]}'
     }
     return posted_url
+
+
+def create_linkedin_post_image(access_token, linkedin_id, content, asset_id):
+    post_data = image_post_data(linkedin_id, content, asset_id)
+    return publish_image_post(access_token, post_data)
+
+
+def register_upload(access_token, linkedin_id):
+    response = register_image(access_token, linkedin_id)
+    upload_url = response["value"]["uploadMechanism"][
+        "com.linkedin.digitalmedia.uploading.MediaUploadHttpRequest"
+    ]["uploadUrl"]
+    return upload_url, response["value"]["asset"]
+
+
+def post_image(access_token, linkedin_id, content, path, stream=None):
+    if stream is None:
+        with open(path, "rb") as image:
+            return post_image(access_token, linkedin_id, content, path, image)
+    pipeline = ImagePostPipeline()
+    return pipeline.run(access_token, linkedin_id, content, path, stream)
+
+
+# registerUpload does not need the image, so it is started as soon as the
+# credentials have been parsed and a file part begins, while the rest of
+# the request body is still arriving. only a part named `field` whose
+# filename passes `accept` starts it
+class ImagePostPipeline:
+    def __init__(self, field="file", accept=None):
+        self.started = time.monotonic()
+        self.field = field
+        self.accept = accept
+        self.fields = dict()
+        self.file_started = False
+        self.registration = None
+        self.registration_used = False
+        self.cache_hit = False
+        self.timings = dict()
+
+    def on_field(self, name, value):
+        self.fields[name] = value
+        self._maybe_register()
+
+    def on_file(self, name, filename):
+        if name != self.field or not filename:
+            return
+        if self.accept is not None and not self.accept(filename):
+            return
+        self.file_started = True
+        self._maybe_register()
+
+    def _maybe_register(self):
+        access_token = self.fields.get("access_token")
+        linkedin_id = self.fields.get("linkedin_id")
+        if self.registration is None and self.file_started:
+            if access_token and linkedin_id:
+                self._start_registration(access_token, linkedin_id)
+
+    def _start_registration(self, access_token, linkedin_id):
+        self.registration = resilience.submit(
+            _pipeline_executor, self._register, access_token, linkedin_id
+        )
+
+    # the request ended without using the registration: cancel it, or count
+    # it as wasted once it has finished
+    def abandon(self):
+        if self.registration is None or self.registration_used:
+            return
+        self.registration_used = True
+        if not self.registration.cancel():
+            self.registration.add_done_callback(_wasted_registration)
+
+    # runs on the executor, so it hands its duration back with the result
+    # instead of writing self.timings while the request thread reads it
+    @staticmethod
+    def _register(access_token, linkedin_id):
+        start = time.monotonic()
+        registration = register_upload(access_token, linkedin_id)
+        return registration, time.monotonic() - start
+
+    def run(self, access_token, linkedin_id, content, path, stream):
+        self.timings["receive"] = time.monotonic() - self.started
+
+        # an image this member already uploaded is reused as is
+        start = time.monotonic()
+        media_key = ("linkedin", linkedin_id, media.content_hash(stream))
+        asset_id = media.media_index.get(media_key)
+        self.timings["prepare"] = time.monotonic() - start
+        if asset_id is not None:
+            self.cache_hit = True
+            self.abandon()
+            return self._publish(access_token, linkedin_id, content, asset_id)
+
+        if self.registration is None:
+            self._start_registration(access_token, linkedin_id)
+        start = time.monotonic()
+        stream, path = media.prepare_image(stream, path)
+        self.timings["prepare"] += time.monotonic() - start
+
+        start = time.monotonic()
+        self.registration_used = True
+        registration, self.timings["register"] = self.registration.result()
+        upload_url, asset_id = registration
+        self.timings["register_wait"] = time.monotonic() - start
+        post_data = image_post_data(linkedin_id, content, asset_id)
+
+        start = time.monotonic()
+        uploadImage(upload_url, access_token, path, stream)
+        self.timings["upload"] = time.monotonic() - start
+        media.media_index.set(media_key, asset_id, ttl=media.LINKEDIN_ASSET_TTL)
+        return self._publish(access_token, linkedin_id, content, asset_id, post_data)
+
+    def _publish(self, access_token, linkedin_id, content, asset_id, post_data=None):
+        if post_data is None:
+            post_data = image_post_data(linkedin_id, content, asset_id)
+        start = time.monotonic()
+        result = publish_image_post(access_token, post_data)
+        self.timings["post"] = time.monotonic() - start
+        self._record()
+        return result
+
+    # registration time that was hidden behind receiving the upload
+    def saved(self):
+        if "register" not in self.timings or "register_wait" not in self.timings:
+            return 0
+        return max(self.timings["register"] - self.timings["register_wait"], 0)
+
+    def _record(self):
+        with _timings_lock:
+            pipeline_timings["runs"] += 1
+            pipeline_timings["media_cache_hits"] += self.cache_hit
+            for stage, seconds in self.timings.items():
+                pipeline_timings[stage] += seconds
+            pipeline_timings["saved"] += self.saved()
+
+    def server_timing(self):
+        stages = dict(self.timings)
+        stages["saved"] = self.saved()
+        metrics = [
+            f"{stage};dur={seconds * 1000:.1f}" for stage, seconds in stages.items()
+        ]
+        metrics.append(f'media-cache;desc="{"hit" if self.cache_hit else "miss"}"')
+        return ", ".join(metrics)
+
+
+def _wasted_registration(registration):
+    error = registration.exception()
+    if error is not None:
+        telemetry.log(
+            logger, logging.WARNING, "unused registerUpload failed", error=str(error)
+        )
+    with _timings_lock:
+        pipeline_timings["wasted_registrations"] += 1
+
+
+def pipeline_stats():
+    with _timings_lock:
+        stats = dict(pipeline_timings)
+    runs = stats.pop("runs")
+    hits = stats.pop("media_cache_hits")
+    wasted = stats.pop("wasted_registrations")
+    averages = {
+        f"{stage}_ms": v * 1000 / runs if runs else 0 for stage, v in stats.items()
+    }
+    return {
+        "runs": runs,
+        "media_cache_hits": hits,
+        "wasted_registrations": wasted,
+        **averages,
+    }
@@ -0,0 +1,169 @@
+import hashlib
+import os
+import tempfile
+from flask import Request
+from werkzeug.formparser import FormDataParser
+from werkzeug.sansio.multipart import (
+    Data,
+    Epilogue,
+    Field,
+    File,
+    MultipartDecoder,
+    NeedData,
+)
+import lazy
+from cache import make_cache
+
+# None when Pillow is not installed
+Image = lazy.lazy_import("PIL.Image")
+ImageOps = lazy.lazy_import("PIL.ImageOps")
+
+# uploads up to this size stay in memory; larger ones roll over to an
+# anonymous temp file that is unlinked as soon as it is created
+MEDIA_SPOOL_MAX = int(os.getenv("MEDIA_SPOOL_MAX", str(8 * 1024 * 1024)))
+
+# images above either limit are downscaled/recompressed before upload
+MEDIA_MAX_BYTES = int(os.getenv("MEDIA_MAX_BYTES", str(5 * 1024 * 1024)))
+MEDIA_MAX_DIMENSION = int(os.getenv("MEDIA_MAX_DIMENSION", "4096"))
+MEDIA_JPEG_QUALITY = int(os.getenv("MEDIA_JPEG_QUALITY", "85"))
+
+# content hash -> already uploaded linkedin asset urn / twitter media id.
+# twitter media ids expire 24 hours after upload
+LINKEDIN_ASSET_TTL = float(os.getenv("LINKEDIN_ASSET_TTL", str(30 * 86400)))
+TWITTER_MEDIA_TTL = float(os.getenv("TWITTER_MEDIA_TTL", str(23 * 3600)))
+media_index = make_cache(
+    maxsize=int(os.getenv("MEDIA_INDEX_SIZE", "10000")),
+    ttl=LINKEDIN_ASSET_TTL,
+    path=os.getenv("MEDIA_INDEX_PATH"),
+    table="media",
+)
+
+
+# sits between the request body and werkzeug's multipart parser and tells
+# the watcher about each form field and file part as soon as it has been
+# read, instead of after the whole body has been parsed
+class FieldWatcher:
+    def __init__(self, stream, boundary, watcher):
+        self.stream = stream
+        self.decoder = MultipartDecoder(boundary)
+        self.watcher = watcher
+        self.field = None
+        self.buffer = []
+        self.done = False
+
+    def read(self, size=-1):
+        data = self.stream.read(size)
+        if not self.done:
+            try:
+                self._feed(data)
+            except ValueError:
+                # werkzeug's own parser reports malformed bodies
+                self.done = True
+        return data
+
+    def _feed(self, data):
+        self.decoder.receive_data(data or None)
+        event = self.decoder.next_event()
+        while not isinstance(event, (NeedData, Epilogue)):
+            if isinstance(event, Field):
+                self.field = event.name
+                self.buffer = []
+            elif isinstance(event, File):
+                self.field = None
+                self.watcher.on_file(event.name, event.filename)
+            elif isinstance(event, Data) and self.field is not None:
+                self.buffer.append(event.data)
+                if not event.more_data:
+                    value = b"".join(self.buffer).decode("utf-8", "replace")
+                    self.watcher.on_field(self.field, value)
+                    self.field = None
+            event = self.decoder.next_event()
+        if isinstance(event, Epilogue) or not data:
+            self.done = True
+
+
+class WatchingFormDataParser(FormDataParser):
+    watcher = None
+
+    def _parse_multipart(self, stream, mimetype, content_length, options):
+        boundary = options.get("boundary", "").encode("ascii")
+        if self.watcher is not None and boundary:
+            stream = FieldWatcher(stream, boundary, self.watcher)
+        return super()._parse_multipart(stream, mimetype, content_length, options)
+
+
+class SpooledRequest(Request):
+    form_data_parser_class = WatchingFormDataParser
+    # set before the form is first accessed to observe it while it streams in
+    form_watcher = None
+
+    def _get_file_stream(
+        self, total_content_length, content_type, filename=None, content_length=None
+    ):
+        return tempfile.SpooledTemporaryFile(max_size=MEDIA_SPOOL_MAX, mode="rb+")
+
+    def make_form_data_parser(self):
+        parser = super().make_form_data_parser()
+        parser.watcher = self.form_watcher
+        return parser
+
+
+# requests sizes a body with fileno() when it has no len(), and calling
+# fileno() on a SpooledTemporaryFile forces it onto disk
+class SizedStream:
+    def __init__(self, stream):
+        self.stream = stream
+        start = stream.tell()
+        stream.seek(0, os.SEEK_END)
+        self.length = stream.tell() - start
+        stream.seek(start)
+
+    def __len__(self):
+        return self.length
+
+    def read(self, size=-1):
+        return self.stream.read(size)
+
+
+def content_hash(stream):
+    start = stream.tell()
+    digest = hashlib.sha256()
+    for block in iter(lambda: stream.read(64 * 1024), b""):
+        digest.update(block)
+    stream.seek(start)
+    return digest.hexdigest()
+
+
+# returns (stream, filename); small images pass through untouched
+def prepare_image(stream, filename):
+    if Image is None:
+        return stream, filename
+    size = len(SizedStream(stream))
+    start = stream.tell()
+    try:
+        image = Image.open(stream)
+        oversized = max(image.size) > MEDIA_MAX_DIMENSION
+        if size <= MEDIA_MAX_BYTES and not oversized:
+            stream.seek(start)
+            return stream, filename
+        image.load()
+    except OSError:
+        stream.seek(start)
+        return stream, filename
+
+    source_format = image.format
+    # re-encoding drops the EXIF orientation tag, so rotate the pixels first
+    image = ImageOps.exif_transpose(image)
+    image.thumbnail((MEDIA_MAX_DIMENSION, MEDIA_MAX_DIMENSION))
+    out = tempfile.SpooledTemporaryFile(max_size=MEDIA_SPOOL_MAX, mode="rb+")
+    base = filename.rsplit(".", 1)[0]
+    if source_format == "PNG" and image.mode in ("RGBA", "LA", "P"):
+        image.save(out, "PNG", optimize=True)
+        filename = base + ".png"
+    else:
+        image.convert("RGB").save(
+            out, "JPEG", quality=MEDIA_JPEG_QUALITY, optimize=True
+        )
+        filename = base + ".jpg"
+    out.seek(0)
+    return out, filename
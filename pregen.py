@@ -0,0 +1,192 @@
+import logging
+import os
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, as_completed
+import lazy
+import telemetry
+import twitter_helper
+
+tweepy = lazy.lazy_import("tweepy")
+
+# opt-in background pre-generation. users who called /twitter/gpt recently
+# get their timeline fetched and replies generated every PREGEN_INTERVAL
+# seconds, so their next request only has to answer the tweets that arrived
+# since. every worker refreshes the users it has served; set
+# REPLY_CACHE_PATH so the workers share what they generate
+PREGEN = os.getenv("PREGEN") == "1"
+PREGEN_INTERVAL = float(os.getenv("PREGEN_INTERVAL", "300"))
+# a user is dropped this long after their last request
+PREGEN_ACTIVE_TTL = float(os.getenv("PREGEN_ACTIVE_TTL", "1800"))
+PREGEN_MAX_USERS = int(os.getenv("PREGEN_MAX_USERS", "200"))
+# users refreshed at once, and tweets sent to GPT per pass across all of them
+PREGEN_CONCURRENCY = int(os.getenv("PREGEN_CONCURRENCY", "2"))
+PREGEN_BUDGET = int(os.getenv("PREGEN_BUDGET", "500"))
+# nobody waits on these replies, so they go in the cheaper batches
+PREGEN_STRATEGY = os.getenv("PREGEN_STRATEGY", "batch")
+
+logger = logging.getLogger("pregen")
+
+
+# credentials of recently active users, most recent last. they stay in
+# memory only, like the client cache that already holds them
+class ActiveUsers:
+    def __init__(self, maxsize, ttl):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._users = OrderedDict()
+        self._lock = threading.Lock()
+
+    def touch(self, access_token, access_secret):
+        key = twitter_helper.client_key(access_token, access_secret)
+        with self._lock:
+            self._users.pop(key, None)
+            self._users[key] = (access_token, access_secret, time.monotonic())
+            while len(self._users) > self.maxsize:
+                self._users.popitem(last=False)
+
+    def remove(self, key):
+        with self._lock:
+            self._users.pop(key, None)
+
+    # (key, access_token, access_secret), most recently active first
+    def snapshot(self):
+        cutoff = time.monotonic() - self.ttl
+        with self._lock:
+            for key in [k for k, user in self._users.items() if user[2] < cutoff]:
+                del self._users[key]
+            users = [(key, user[0], user[1]) for key, user in self._users.items()]
+        users.reverse()
+        return users
+
+    def __len__(self):
+        with self._lock:
+            return len(self._users)
+
+
+# tweets a pass may still send to GPT, shared by the users it refreshes
+class Budget:
+    def __init__(self, total):
+        self.remaining = total
+        self._lock = threading.Lock()
+
+    def take(self, wanted):
+        with self._lock:
+            granted = min(wanted, self.remaining)
+            self.remaining -= granted
+            return granted
+
+
+active_users = ActiveUsers(PREGEN_MAX_USERS, PREGEN_ACTIVE_TTL)
+
+_stats_lock = threading.Lock()
+pass_stats = {
+    "passes": 0,
+    "users": 0,
+    "generated": 0,
+    "failed": 0,
+    "over_budget": 0,
+    "errors": 0,
+    "last_pass_seconds": 0.0,
+}
+_scheduler_lock = threading.Lock()
+_scheduler_pid = None
+
+
+def touch(access_token, access_secret):
+    if not PREGEN or not access_token or not access_secret:
+        return
+    active_users.touch(access_token, access_secret)
+    start()
+
+
+def start():
+    global _scheduler_pid
+    if _scheduler_pid == os.getpid():
+        return
+    with _scheduler_lock:
+        if _scheduler_pid == os.getpid():
+            return
+        threading.Thread(target=_scheduler, name="pregen", daemon=True).start()
+        _scheduler_pid = os.getpid()
+
+
+def _scheduler():
+    while True:
+        time.sleep(PREGEN_INTERVAL)
+        try:
+            run_once()
+        except Exception as e:
+            telemetry.log(logger, logging.ERROR, "pregen pass failed", error=str(e))
+
+
+# the same pipeline as /twitter/gpt. the timeline buffer and the reply
+# cache keep the results, so the live request's since_id fetch only sees
+# tweets newer than this pass and every older one is a cache hit
+def refresh_user(access_token, access_secret, budget):
+    if budget.remaining <= 0:
+        return {"over_budget": 0, "skipped": True}
+    tweets, users = twitter_helper.get_home_timeline(access_token, access_secret)
+    records = twitter_helper.enrich_tweets(tweets, users)
+    _, pending = twitter_helper.split_cached_replies(records)
+    # newest first, so the tweets the user sees first are answered first
+    granted = budget.take(len(pending))
+    result = {"generated": 0, "failed": 0, "over_budget": len(pending) - granted}
+    if granted:
+        for reply in twitter_helper.generate_replies(
+            pending[:granted], PREGEN_STRATEGY
+        ):
+            result["failed" if "error" in reply else "generated"] += 1
+    return result
+
+
+def run_once():
+    started = time.monotonic()
+    users = active_users.snapshot()
+    budget = Budget(PREGEN_BUDGET)
+    totals = {"users": 0, "generated": 0, "failed": 0, "over_budget": 0, "errors": 0}
+    with ThreadPoolExecutor(max_workers=PREGEN_CONCURRENCY) as executor:
+        futures = {
+            executor.submit(refresh_user, access_token, access_secret, budget): key
+            for key, access_token, access_secret in users
+        }
+        for future in as_completed(futures):
+            try:
+                result = future.result()
+            except tweepy.Unauthorized:
+                # revoked; clients_for has already dropped the clients
+                active_users.remove(futures[future])
+                totals["errors"] += 1
+                continue
+            except Exception as e:
+                telemetry.log(logger, logging.WARNING, "pregen failed", error=str(e))
+                totals["errors"] += 1
+                continue
+            if result.pop("skipped", False):
+                continue
+            totals["users"] += 1
+            for field, value in result.items():
+                totals[field] += value
+    elapsed = time.monotonic() - started
+    with _stats_lock:
+        pass_stats["passes"] += 1
+        for field, value in totals.items():
+            pass_stats[field] += value
+        pass_stats["last_pass_seconds"] = round(elapsed, 3)
+    telemetry.log(
+        logger,
+        logging.INFO,
+        "pregen pass",
+        active=len(users),
+        seconds=round(elapsed, 3),
+        **totals,
+    )
+    return totals
+
+
+def stats():
+    with _stats_lock:
+        summary = dict(pass_stats)
+    summary.update(enabled=PREGEN, active_users=len(active_users))
+    return summary
@@ -0,0 +1,159 @@
+import html
+import json
+import os
+import re
+import threading
+import lazy
+
+tiktoken = lazy.lazy_import("tiktoken")
+
+# bump whenever the prompts or the compaction rules change so cached replies
+# are not reused
+PROMPT_VERSION = "3"
+
+REPLY_MAX_CHARS = 200
+# tweets longer than this are cut before they are sent; replies rarely
+# depend on the tail of a thread-length tweet
+TWEET_MAX_TOKENS = int(os.getenv("TWEET_MAX_TOKENS", "120"))
+
+# the old user and system prompts said the same things twice in ~250
+# tokens; this keeps every instruction in one system message
+SYSTEM_PROMPT = (
+    "You reply to tweets. Write like a thoughtful person: conversational, "
+    "informal, with a clear point of view and the tweet's own tone. Use wit "
+    "sparingly. Be informative when the tweet asks for it. Avoid filler like "
+    "'wow', 'amazing' or 'incredible'. Answer with the reply text only, no "
+    f"label or quotes, at most {REPLY_MAX_CHARS} characters."
+)
+
+BATCH_FORMAT_PROMPT = (
+    'You get a JSON list of tweets with "id" and "text". Answer only with '
+    '{"replies": [{"id": "<tweet id>", "reply": "<reply>"}]}, one per tweet.'
+)
+
+SYSTEM_MESSAGE = {"role": "system", "content": SYSTEM_PROMPT}
+BATCH_SYSTEM_MESSAGE = {
+    "role": "system",
+    "content": f"{SYSTEM_PROMPT}\n\n{BATCH_FORMAT_PROMPT}",
+}
+
+URL_RE = re.compile(r"https?://\S+")
+REPLY_PREFIX_RE = re.compile(r"^(?:reply|response|tweet)\s*[:\-–]\s*", re.I)
+SENTENCE_END_RE = re.compile(r"[.!?…](?=\s|$)")
+QUOTES = {'"': '"', "'": "'", "“": "”"}
+
+# chat messages cost a few tokens each on top of their content
+MESSAGE_OVERHEAD = 4
+REPLY_OVERHEAD = 3
+
+# tiktoken fetches its vocabulary on first use; without it (or offline)
+# tokens are estimated from the length
+TOKENIZER_MODEL = os.getenv("GPT_MODEL", "gpt-3.5-turbo")
+_encoding = None
+_encoding_loaded = False
+_encoding_lock = threading.Lock()
+
+
+def encoding():
+    global _encoding, _encoding_loaded
+    if tiktoken is None:
+        return None
+    if not _encoding_loaded:
+        with _encoding_lock:
+            if not _encoding_loaded:
+                try:
+                    _encoding = tiktoken.encoding_for_model(TOKENIZER_MODEL)
+                except KeyError:
+                    _encoding = tiktoken.get_encoding("cl100k_base")
+                except Exception:
+                    _encoding = None
+                _encoding_loaded = True
+    return _encoding
+
+
+def count_tokens(text):
+    enc = encoding()
+    if enc is None:
+        return len(text) // 4 + 1
+    return len(enc.encode(text, disallowed_special=()))
+
+
+def count_message_tokens(messages):
+    content = sum(count_tokens(m["content"]) + MESSAGE_OVERHEAD for m in messages)
+    return content + REPLY_OVERHEAD
+
+
+def truncate_tokens(text, max_tokens):
+    if count_tokens(text) <= max_tokens:
+        return text
+    enc = encoding()
+    if enc is None:
+        text = text[: max_tokens * 4]
+    else:
+        text = enc.decode(enc.encode(text, disallowed_special=())[:max_tokens])
+    # cut back to a whole word
+    head, _, _ = text.rpartition(" ")
+    return (head or text).rstrip() + "…"
+
+
+# links are t.co redirects the model cannot open; they only cost tokens
+def compact_tweet(text):
+    text = html.unescape(text)
+    text = URL_RE.sub("[link]", text)
+    text = " ".join(text.split())
+    return truncate_tokens(text, TWEET_MAX_TOKENS)
+
+
+def messages_for(tweet):
+    return [SYSTEM_MESSAGE, {"role": "user", "content": compact_tweet(tweet["text"])}]
+
+
+# one request for many tweets; the model answers with a JSON object so the
+# replies can be matched back to their tweet ids
+def batch_messages_for(tweets):
+    items = [{"id": t["id"], "text": compact_tweet(t["text"])} for t in tweets]
+    return [
+        BATCH_SYSTEM_MESSAGE,
+        {
+            "role": "user",
+            "content": f"Tweets:\n{json.dumps(items, ensure_ascii=False)}",
+        },
+    ]
+
+
+# what one tweet adds to a batch request, its reply included
+def batch_item_tokens(tweet, reply_tokens):
+    item = {"id": tweet["id"], "text": compact_tweet(tweet["text"])}
+    return count_tokens(json.dumps(item, ensure_ascii=False)) + reply_tokens
+
+
+def batch_base_tokens():
+    return count_message_tokens(
+        [BATCH_SYSTEM_MESSAGE, {"role": "user", "content": "Tweets:\n[]"}]
+    )
+
+
+def _shorten(text, limit):
+    window = text[:limit]
+    ends = [m.end() for m in SENTENCE_END_RE.finditer(window)]
+    # a reply cut off by max_tokens, or one over the limit, ends at its
+    # last complete sentence when that keeps most of it
+    if ends and ends[-1] >= len(window) // 2:
+        return window[: ends[-1]]
+    if len(text) <= limit:
+        return text
+    head, _, _ = text[: limit - 1].rpartition(" ")
+    return (head or text[: limit - 1]).rstrip(" ,;:-") + "…"
+
+
+# returns the reply as it can be posted, or None when nothing usable is left
+def clean_reply(text, truncated=False):
+    if not isinstance(text, str):
+        return None
+    text = text.strip()
+    text = REPLY_PREFIX_RE.sub("", text).strip()
+    if len(text) >= 2 and QUOTES.get(text[0]) == text[-1]:
+        text = text[1:-1].strip()
+    if truncated or len(text) > REPLY_MAX_CHARS:
+        text = _shorten(text, REPLY_MAX_CHARS)
+    return text or None
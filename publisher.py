@@ -0,0 +1,70 @@
+import io
+import os
+from concurrent.futures import ThreadPoolExecutor
+import linkedin_helper
+import twitter_helper
+import media
+import resilience
+
+_executor = ThreadPoolExecutor(max_workers=int(os.getenv("PUBLISH_WORKERS", "8")))
+
+
+def _linkedin(credentials, content, filename, data):
+    if data is None:
+        return linkedin_helper.create_linkedin_post(
+            credentials["access_token"], credentials["linkedin_id"], content
+        )
+    return linkedin_helper.post_image(
+        credentials["access_token"],
+        credentials["linkedin_id"],
+        content,
+        filename,
+        io.BytesIO(data),
+    )
+
+
+def _twitter(credentials, content, filename, data):
+    response = twitter_helper.post_tweet(
+        content,
+        credentials["access_token"],
+        credentials["access_secret"],
+        filename if data is not None else None,
+        io.BytesIO(data) if data is not None else None,
+    )
+    return response.data
+
+
+PLATFORMS = {"linkedin": _linkedin, "twitter": _twitter}
+
+
+# posts the same content to every platform in `credentials` at once; the
+# image is prepared a single time and each platform reads its own copy
+def publish(content, credentials, filename=None, stream=None):
+    data = None
+    if stream is not None:
+        stream, filename = media.prepare_image(stream, filename)
+        data = stream.read()
+
+    futures = {
+        platform: resilience.submit(
+            _executor,
+            PLATFORMS[platform],
+            platform_credentials,
+            content,
+            filename,
+            data,
+        )
+        for platform, platform_credentials in credentials.items()
+    }
+    results = dict()
+    for platform, future in futures.items():
+        try:
+            results[platform] = {"status": "posted", "result": future.result()}
+        except Exception as e:
+            # retryable: the platform certainly has not published it
+            results[platform] = {
+                "status": "error",
+                "error": str(e),
+                "retryable": resilience.safe_to_retry(e),
+            }
+    return results
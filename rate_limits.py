@@ -0,0 +1,227 @@
+import asyncio
+import threading
+import time
+from urllib.parse import urlsplit
+
+
+# twitter's windows are per endpoint: a spent timeline window says nothing
+# about posting
+def endpoint(key, method, url):
+    return (key, method.upper(), urlsplit(url).path.rstrip("/"))
+
+
+# twitter reports its per-endpoint window on every response through the
+# x-rate-limit-* headers; one tracker entry per access token and endpoint
+class RateLimitTracker:
+    def __init__(self):
+        self._state = dict()
+        self._lock = threading.Lock()
+
+    def update(self, key, headers):
+        remaining = headers.get("x-rate-limit-remaining")
+        reset = headers.get("x-rate-limit-reset")
+        if remaining is None or reset is None:
+            return
+        with self._lock:
+            self._state[key] = {"remaining": int(remaining), "reset": float(reset)}
+
+    def hook(self, key):
+        def record(response, *args, **kwargs):
+            request = response.request
+            self.update(endpoint(key, request.method, request.url), response.headers)
+            return response
+
+        return record
+
+    # claims one request from an endpoint's window, see endpoint(); returns
+    # how long to wait first
+    def reserve(self, key):
+        now = time.time()
+        with self._lock:
+            state = self._state.get(key)
+            if state is None or state["reset"] <= now:
+                return 0
+            if state["remaining"] > 0:
+                state["remaining"] -= 1
+                return 0
+            return state["reset"] - now
+
+    def state(self, key):
+        with self._lock:
+            return dict(self._state.get(key, {}))
+
+
+twitter = RateLimitTracker()
+
+
+class DeadlineExceeded(Exception):
+    pass
+
+
+# refills `per_minute` units evenly over a minute. reserve() takes its
+# units and may leave the bucket in debt; callers wait out the debt, which
+# keeps concurrent callers in arrival order. a caller that could not wait
+# that long takes nothing
+class TokenBucket:
+    def __init__(self, per_minute):
+        self.capacity = float(per_minute)
+        self.rate = per_minute / 60.0
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _refill(self, now):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    # returns the wait; when it is over max_wait nothing is taken
+    def reserve(self, amount, max_wait=None):
+        with self._lock:
+            now = time.monotonic()
+            self._refill(now)
+            wait = max((amount - self.tokens) / self.rate, 0.0)
+            if max_wait is None or wait <= max_wait:
+                self.tokens -= amount
+            return wait
+
+    # corrects an estimate once the real usage is known
+    def adjust(self, amount):
+        with self._lock:
+            self.tokens -= amount
+
+    def drain(self, seconds):
+        with self._lock:
+            self._refill(time.monotonic())
+            self.tokens = min(self.tokens, -seconds * self.rate)
+
+
+# additive increase / multiplicative decrease: one more slot after a full
+# window of fast successes, half the slots on a 429, a tenth fewer when
+# responses get slower than the target. decreases are spaced so one burst
+# of failures counts once
+class AdaptiveConcurrency:
+    def __init__(self, initial, minimum, maximum, latency_target):
+        self.limit = float(initial)
+        self.minimum = minimum
+        self.maximum = maximum
+        self.latency_target = latency_target
+        self.in_flight = 0
+        self.last_decrease = 0.0
+        self._cond = threading.Condition()
+
+    def try_acquire(self):
+        with self._cond:
+            if self.in_flight < int(self.limit):
+                self.in_flight += 1
+                return True
+            return False
+
+    def acquire(self, timeout=None):
+        with self._cond:
+            if not self._cond.wait_for(
+                lambda: self.in_flight < int(self.limit), timeout
+            ):
+                return False
+            self.in_flight += 1
+            return True
+
+    def release(self, outcome, latency=0.0):
+        with self._cond:
+            self.in_flight -= 1
+            now = time.monotonic()
+            if outcome == "throttled":
+                self._decrease(now, 0.5)
+            elif outcome == "ok" and latency > self.latency_target:
+                self._decrease(now, 0.9)
+            elif outcome == "ok":
+                self.limit = min(self.limit + 1 / self.limit, self.maximum)
+            self._cond.notify_all()
+
+    def _decrease(self, now, factor):
+        if now - self.last_decrease < 1.0:
+            return
+        self.limit = max(self.limit * factor, self.minimum)
+        self.last_decrease = now
+
+
+# openai enforces requests-per-minute and tokens-per-minute per key, so
+# every caller in the process shares one of these
+class OpenAILimiter:
+    def __init__(self, rpm, tpm, concurrency):
+        self.requests = TokenBucket(rpm)
+        self.tokens = TokenBucket(tpm)
+        self.concurrency = concurrency
+        self.counts = {
+            "ok": 0,
+            "throttled": 0,
+            "error": 0,
+            "deadline": 0,
+            "cancelled": 0,
+        }
+        self._lock = threading.Lock()
+
+    # returns how long to wait before sending a request of `tokens`. a wait
+    # over max_wait reserves nothing, so callers that give up do not leave
+    # debt behind for the ones after them
+    def reserve(self, tokens, max_wait=None):
+        request_wait = self.requests.reserve(1, max_wait)
+        if max_wait is not None and request_wait > max_wait:
+            return request_wait
+        token_wait = self.tokens.reserve(tokens, max_wait)
+        if max_wait is not None and token_wait > max_wait:
+            self.requests.adjust(-1)
+        return max(request_wait, token_wait)
+
+    def acquire(self, tokens, deadline):
+        if not self.concurrency.acquire(timeout=max(deadline - time.monotonic(), 0)):
+            self.record("deadline")
+            raise DeadlineExceeded("no free openai slot before the deadline")
+        max_wait = deadline - time.monotonic()
+        wait = self.reserve(tokens, max_wait)
+        if wait > max_wait:
+            self.concurrency.release("error")
+            self.record("deadline")
+            raise DeadlineExceeded(f"openai rate limit frees up in {wait:.1f}s")
+        time.sleep(wait)
+
+    # the same for event loop callers, which must not block on the condition
+    async def acquire_async(self, tokens, deadline, poll=0.02):
+        while not self.concurrency.try_acquire():
+            if time.monotonic() >= deadline:
+                self.record("deadline")
+                raise DeadlineExceeded("no free openai slot before the deadline")
+            await asyncio.sleep(poll)
+        max_wait = deadline - time.monotonic()
+        wait = self.reserve(tokens, max_wait)
+        if wait > max_wait:
+            self.concurrency.release("error")
+            self.record("deadline")
+            raise DeadlineExceeded(f"openai rate limit frees up in {wait:.1f}s")
+        try:
+            await asyncio.sleep(wait)
+        except asyncio.CancelledError:
+            # nothing was sent, so the reservation goes back too
+            self.requests.adjust(-1)
+            self.tokens.adjust(-tokens)
+            self.release("cancelled")
+            raise
+
+    def release(self, outcome, latency=0.0, retry_after=None):
+        if outcome == "throttled":
+            # the server knows better than the buckets; stop everyone
+            self.requests.drain(retry_after or 1.0)
+        self.concurrency.release(outcome, latency)
+        self.record(outcome)
+
+    def record(self, outcome):
+        with self._lock:
+            self.counts[outcome] += 1
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self.counts)
+        stats.update(
+            concurrency_limit=round(self.concurrency.limit, 2),
+            in_flight=self.concurrency.in_flight,
+        )
+        return stats
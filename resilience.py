@@ -0,0 +1,462 @@
+import contextvars
+import logging
+import os
+import threading
+import time
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from contextlib import contextmanager
+import requests
+from urllib3.exceptions import NewConnectionError
+import telemetry
+from rate_limits import DeadlineExceeded
+
+# one breaker and one bulkhead per upstream, so a slow or failing
+# dependency fails fast instead of holding every worker thread
+
+# a breaker opens when, over the last BREAKER_WINDOW seconds and at least
+# BREAKER_MIN_CALLS calls, the share of failed or of slow calls reaches its
+# rate. after BREAKER_COOLDOWN seconds one probe call decides whether it
+# closes again
+BREAKER_WINDOW = int(os.getenv("BREAKER_WINDOW", "30"))
+BREAKER_MIN_CALLS = int(os.getenv("BREAKER_MIN_CALLS", "20"))
+BREAKER_ERROR_RATE = float(os.getenv("BREAKER_ERROR_RATE", "0.5"))
+BREAKER_SLOW_RATE = float(os.getenv("BREAKER_SLOW_RATE", "0.8"))
+BREAKER_COOLDOWN = float(os.getenv("BREAKER_COOLDOWN", "15"))
+
+# calls slower than this count against the breaker, and at most `bulkhead`
+# calls run at once (0 for no limit; openai already has gpt_limiter)
+UPSTREAM_LIMITS = {
+    "linkedin": dict(
+        slow_call=float(os.getenv("LINKEDIN_SLOW_CALL", "5")),
+        bulkhead=int(os.getenv("LINKEDIN_BULKHEAD", "16")),
+    ),
+    "twitter": dict(
+        slow_call=float(os.getenv("TWITTER_SLOW_CALL", "5")),
+        bulkhead=int(os.getenv("TWITTER_BULKHEAD", "16")),
+    ),
+    "openai": dict(
+        slow_call=float(os.getenv("OPENAI_SLOW_CALL", "20")),
+        bulkhead=0,
+    ),
+}
+DEFAULT_LIMITS = dict(slow_call=5.0, bulkhead=int(os.getenv("DEFAULT_BULKHEAD", "8")))
+# how long a call may wait for a bulkhead slot
+BULKHEAD_WAIT = float(os.getenv("BULKHEAD_WAIT", "1"))
+
+# an idempotent read still unanswered after HEDGE_AFTER seconds is sent a
+# second time and the first answer wins; 0 turns hedging off
+HEDGE_AFTER = float(os.getenv("HEDGE_AFTER", "0"))
+HEDGE_WORKERS = int(os.getenv("HEDGE_WORKERS", "16"))
+
+# time a request may spend on upstream calls
+REQUEST_DEADLINE = float(os.getenv("REQUEST_DEADLINE", "30"))
+
+CLOSED, HALF_OPEN, OPEN = "closed", "half_open", "open"
+STATE_CODES = {CLOSED: 0, HALF_OPEN: 1, OPEN: 2}
+
+logger = logging.getLogger("resilience")
+
+_deadline = contextvars.ContextVar("deadline", default=None)
+_hedge_executor = ThreadPoolExecutor(max_workers=HEDGE_WORKERS)
+
+
+class Unavailable(Exception):
+    def __init__(self, message, retry_after=None):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+class CircuitOpen(Unavailable):
+    pass
+
+
+class BulkheadFull(Unavailable):
+    pass
+
+
+# the deadline ran out while waiting for the answer to a request that had
+# already been sent, so the upstream may have acted on it
+class DeadlineExceededAfterSend(DeadlineExceeded):
+    pass
+
+
+# what a route reports when it gave up on an upstream
+UNAVAILABLE = (Unavailable, DeadlineExceeded)
+
+
+def status_code(error):
+    return 504 if isinstance(error, DeadlineExceeded) else 503
+
+
+# a failure known to have happened before anything was published, so the
+# whole operation can run again without posting twice
+class NotPublished(Exception):
+    pass
+
+
+def http_status(error):
+    status = getattr(error, "status_code", None)
+    response = getattr(error, "response", None)
+    if status is None:
+        status = getattr(response, "status_code", None)
+    if status is None:
+        # aiohttp responses, e.g. from tweepy's async client
+        status = getattr(response, "status", None)
+    return status
+
+
+# statuses after which a step that comes before the post itself can be
+# run again
+def retryable_status(status):
+    return status is not None and (status == 429 or status >= 500)
+
+
+# whether a failed publish may be retried: it was refused before it was
+# sent, or the connection was never made. a read timeout or a 5xx from the
+# post itself may still have published
+def safe_to_retry(error):
+    if isinstance(error, DeadlineExceededAfterSend):
+        return False
+    if isinstance(error, (NotPublished,) + UNAVAILABLE):
+        return True
+    if isinstance(error, requests.ConnectTimeout):
+        return True
+    if isinstance(error, requests.ConnectionError):
+        reason = error.args[0] if error.args else None
+        return isinstance(getattr(reason, "reason", reason), NewConnectionError)
+    return http_status(error) == 429
+
+
+# calls, failures and slow calls per second over the window
+class CircuitBreaker:
+    def __init__(self, upstream, slow_call):
+        self.upstream = upstream
+        self.slow_call = slow_call
+        self.state = CLOSED
+        self.opened_at = 0.0
+        self.opens = 0
+        self.rejected = 0
+        self._probing = False
+        self._buckets = deque()
+        self._lock = threading.Lock()
+        telemetry.circuit_state.set(0, upstream=upstream)
+
+    def allow(self):
+        with self._lock:
+            if self.state == OPEN:
+                if time.monotonic() - self.opened_at < BREAKER_COOLDOWN:
+                    self.rejected += 1
+                    return False
+                self._set_state(HALF_OPEN)
+            if self.state == HALF_OPEN:
+                if self._probing:
+                    self.rejected += 1
+                    return False
+                self._probing = True
+            return True
+
+    def retry_after(self):
+        return max(self.opened_at + BREAKER_COOLDOWN - time.monotonic(), 0)
+
+    # outcome is "ok", "failure", or "ignored" for calls that never got an
+    # answer through no fault of the upstream
+    def record(self, outcome, elapsed=0.0):
+        slow = outcome == "ok" and elapsed >= self.slow_call
+        now = time.monotonic()
+        with self._lock:
+            if self.state == HALF_OPEN:
+                self._probing = False
+                if outcome == "failure" or slow:
+                    self._open(now)
+                elif outcome == "ok":
+                    self._buckets.clear()
+                    self._set_state(CLOSED)
+                return
+            if outcome == "ignored":
+                return
+            second = int(now)
+            if not self._buckets or self._buckets[-1][0] != second:
+                self._buckets.append([second, 0, 0, 0])
+            bucket = self._buckets[-1]
+            bucket[1] += 1
+            bucket[2] += outcome == "failure"
+            bucket[3] += slow
+            while self._buckets[0][0] <= second - BREAKER_WINDOW:
+                self._buckets.popleft()
+            if self.state == CLOSED:
+                calls, failures, slow_calls = self._totals()
+                if calls >= BREAKER_MIN_CALLS and (
+                    failures / calls >= BREAKER_ERROR_RATE
+                    or slow_calls / calls >= BREAKER_SLOW_RATE
+                ):
+                    self._open(now)
+
+    def _totals(self):
+        return tuple(sum(bucket[i] for bucket in self._buckets) for i in (1, 2, 3))
+
+    def _open(self, now):
+        self.opened_at = now
+        self.opens += 1
+        self._buckets.clear()
+        self._set_state(OPEN)
+
+    def _set_state(self, state):
+        self.state = state
+        telemetry.circuit_state.set(STATE_CODES[state], upstream=self.upstream)
+        telemetry.log(
+            logger, logging.WARNING, "circuit " + state, upstream=self.upstream
+        )
+
+    def stats(self):
+        with self._lock:
+            calls, failures, slow_calls = self._totals()
+            return {
+                "state": self.state,
+                "state_code": STATE_CODES[self.state],
+                "calls": calls,
+                "failures": failures,
+                "slow": slow_calls,
+                "opens": self.opens,
+                "rejected": self.rejected,
+            }
+
+
+class Bulkhead:
+    def __init__(self, size):
+        self.size = size
+        self.in_flight = 0
+        self.rejected = 0
+        self._slots = threading.BoundedSemaphore(size) if size else None
+        self._lock = threading.Lock()
+
+    def acquire(self, timeout):
+        if self._slots is not None and not self._slots.acquire(timeout=timeout):
+            with self._lock:
+                self.rejected += 1
+            return False
+        with self._lock:
+            self.in_flight += 1
+        return True
+
+    def release(self):
+        with self._lock:
+            self.in_flight -= 1
+        if self._slots is not None:
+            self._slots.release()
+
+    def stats(self):
+        with self._lock:
+            return {
+                "size": self.size,
+                "in_flight": self.in_flight,
+                "rejected": self.rejected,
+            }
+
+
+class Upstream:
+    def __init__(self, name, slow_call, bulkhead):
+        self.name = name
+        self.breaker = CircuitBreaker(name, slow_call)
+        self.bulkhead = Bulkhead(bulkhead)
+
+
+_upstreams = dict()
+_upstreams_lock = threading.Lock()
+
+
+def upstream(name):
+    found = _upstreams.get(name)
+    if found is None:
+        with _upstreams_lock:
+            found = _upstreams.get(name)
+            if found is None:
+                found = Upstream(name, **UPSTREAM_LIMITS.get(name, DEFAULT_LIMITS))
+                _upstreams[name] = found
+    return found
+
+
+def remaining():
+    deadline = _deadline.get()
+    return None if deadline is None else deadline - time.monotonic()
+
+
+def earliest(deadline):
+    current = _deadline.get()
+    return deadline if current is None else min(deadline, current)
+
+
+# seconds=None lifts the deadline, e.g. for a long-lived stream
+def set_deadline(seconds):
+    return _deadline.set(None if seconds is None else time.monotonic() + seconds)
+
+
+@contextmanager
+def deadline(seconds):
+    token = set_deadline(seconds)
+    try:
+        yield
+    finally:
+        _deadline.reset(token)
+
+
+# a (connect, read) timeout cut down to what is left of the deadline
+def timeout(default):
+    left = remaining()
+    if left is None:
+        return default
+    if left <= 0:
+        raise DeadlineExceeded("the request deadline has passed")
+    if isinstance(default, tuple):
+        return tuple(min(part, left) for part in default)
+    return min(default, left)
+
+
+# worker threads do not inherit context variables; this carries the
+# deadline over
+def submit(executor, fn, *args):
+    return executor.submit(contextvars.copy_context().run, fn, *args)
+
+
+class Call:
+    def __init__(self):
+        self.status = None
+
+
+def _outcome(status):
+    # 429s and other client errors say nothing about the upstream's health
+    if isinstance(status, int):
+        return "failure" if status >= 500 else "ok"
+    return "ok"
+
+
+def _error_outcome(error):
+    # cancelled tasks and interrupts were abandoned by us, not failed by it
+    if isinstance(error, UNAVAILABLE) or not isinstance(error, Exception):
+        return "ignored"
+    status = http_status(error)
+    # no answer at all: a timeout or a connection error
+    return "failure" if status is None else _outcome(status)
+
+
+# admits a call through the upstream's breaker and bulkhead and records how
+# it went; set call.status to the HTTP status when no exception says it.
+# event loop callers pass bulkhead=False: they hold no thread while they
+# wait, and must not block on a slot
+@contextmanager
+def guard(name, bulkhead=True):
+    target = upstream(name)
+    left = remaining()
+    if left is not None and left <= 0:
+        telemetry.circuit_rejections.inc(upstream=name, reason="deadline")
+        raise DeadlineExceeded("the request deadline has passed")
+    if not target.breaker.allow():
+        telemetry.circuit_rejections.inc(upstream=name, reason="open")
+        raise CircuitOpen(
+            f"{name} is unavailable", retry_after=target.breaker.retry_after()
+        )
+    slots = target.bulkhead if bulkhead else None
+    wait_for = BULKHEAD_WAIT if left is None else min(BULKHEAD_WAIT, left)
+    if slots is not None and not slots.acquire(wait_for):
+        target.breaker.record("ignored")
+        telemetry.circuit_rejections.inc(upstream=name, reason="bulkhead")
+        raise BulkheadFull(f"too many calls to {name} in flight", retry_after=1)
+    call = Call()
+    started = time.monotonic()
+    try:
+        yield call
+    except BaseException as e:
+        target.breaker.record(_error_outcome(e))
+        raise
+    else:
+        target.breaker.record(_outcome(call.status), time.monotonic() - started)
+    finally:
+        if slots is not None:
+            slots.release()
+
+
+# guard plus telemetry.span; set span.status as usual
+@contextmanager
+def guarded(name, operation, bulkhead=True):
+    with guard(name, bulkhead) as call:
+        with telemetry.span(name, operation) as span:
+            yield span
+        call.status = span.status
+
+
+# runs fn, and once more if the first has not returned within `after`
+# seconds; the first result that `ok` accepts wins. only for reads that
+# are safe to send twice
+def hedged(name, fn, ok=lambda result: True, after=None):
+    after = HEDGE_AFTER if after is None else after
+    if after <= 0:
+        return fn()
+    first = submit(_hedge_executor, fn)
+    done, _ = wait([first], timeout=timeout(after))
+    # no second attempt against a struggling upstream or past the deadline
+    left = remaining()
+    if (
+        done
+        or upstream(name).breaker.state != CLOSED
+        or (left is not None and left <= 0)
+    ):
+        return first.result()
+    second = submit(_hedge_executor, fn)
+    winners = {first: "first", second: "second"}
+    pending = {first, second}
+    result = None
+    error = None
+    while pending:
+        left = remaining()
+        done, pending = wait(
+            pending,
+            timeout=None if left is None else max(left, 0),
+            return_when=FIRST_COMPLETED,
+        )
+        if not done:
+            raise DeadlineExceeded("the request deadline has passed")
+        for future in done:
+            if future.exception() is not None:
+                error = future.exception()
+                continue
+            result = future.result()
+            if ok(result):
+                telemetry.upstream_hedges.inc(upstream=name, winner=winners[future])
+                return result
+    telemetry.upstream_hedges.inc(upstream=name, winner="none")
+    if result is not None:
+        return result
+    raise error
+
+
+# seconds a request may take: REQUEST_DEADLINE, or less when the client
+# asks for less in X-Request-Timeout
+def request_deadline(header):
+    try:
+        return min(float(header), REQUEST_DEADLINE)
+    except (TypeError, ValueError):
+        return REQUEST_DEADLINE
+
+
+def instrument(app):
+    from flask import g, request
+
+    @app.before_request
+    def _set_deadline():
+        header = request.headers.get("X-Request-Timeout")
+        g.deadline_token = set_deadline(request_deadline(header))
+
+    @app.teardown_request
+    def _reset_deadline(error=None):
+        token = g.pop("deadline_token", None)
+        if token is not None:
+            _deadline.reset(token)
+
+
+def stats():
+    with _upstreams_lock:
+        upstreams = dict(_upstreams)
+    return {
+        name: {**target.breaker.stats(), "bulkhead": target.bulkhead.stats()}
+        for name, target in upstreams.items()
+    }
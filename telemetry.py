@@ -0,0 +1,259 @@
+import json
+import logging
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+
+class JsonFormatter(logging.Formatter):
+    def format(self, record):
+        entry = {
+            "ts": round(record.created, 3),
+            "level": record.levelname.lower(),
+            "logger": record.name,
+            "msg": record.getMessage(),
+        }
+        entry.update(getattr(record, "fields", {}))
+        if record.exc_info:
+            entry["exc"] = self.formatException(record.exc_info)
+        return json.dumps(entry, default=str)
+
+
+def configure_logging():
+    handler = logging.StreamHandler()
+    handler.setFormatter(JsonFormatter())
+    root = logging.getLogger()
+    root.handlers = [handler]
+    root.setLevel(os.getenv("LOG_LEVEL", "INFO"))
+
+
+def log(logger, level, msg, **fields):
+    logger.log(level, msg, extra={"fields": fields})
+
+
+class Histogram:
+    def __init__(self, name, help, labels):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self._series = dict()
+        self._lock = threading.Lock()
+
+    def observe(self, value, **labels):
+        key = tuple(str(labels.get(label, "")) for label in self.labels)
+        with self._lock:
+            series = self._series.get(key)
+            if series is None:
+                series = self._series[key] = [[0] * len(BUCKETS), 0.0, 0]
+            for i, bound in enumerate(BUCKETS):
+                if value <= bound:
+                    series[0][i] += 1
+            series[1] += value
+            series[2] += 1
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            series = {key: (list(b), s, c) for key, (b, s, c) in self._series.items()}
+        for key, (buckets, total, count) in sorted(series.items()):
+            base = _labels(zip(self.labels, key))
+            for bound, observed in zip(BUCKETS, buckets):
+                lines.append(
+                    f"{self.name}_bucket{_labels(zip(self.labels, key), le=bound)} "
+                    f"{observed}"
+                )
+            lines.append(
+                f"{self.name}_bucket{_labels(zip(self.labels, key), le='+Inf')} {count}"
+            )
+            lines.append(f"{self.name}_sum{base} {total}")
+            lines.append(f"{self.name}_count{base} {count}")
+        return lines
+
+
+class Counter:
+    kind = "counter"
+
+    def __init__(self, name, help, labels):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self._values = dict()
+        self._lock = threading.Lock()
+
+    def inc(self, amount=1, **labels):
+        key = tuple(str(labels.get(label, "")) for label in self.labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"]
+        with self._lock:
+            values = dict(self._values)
+        for key, value in sorted(values.items()):
+            lines.append(f"{self.name}{_labels(zip(self.labels, key))} {value}")
+        return lines
+
+
+class Gauge(Counter):
+    kind = "gauge"
+
+    def set(self, value, **labels):
+        key = tuple(str(labels.get(label, "")) for label in self.labels)
+        with self._lock:
+            self._values[key] = value
+
+
+def _labels(pairs, **extra):
+    pairs = list(pairs) + list(extra.items())
+    if not pairs:
+        return ""
+    escaped = (
+        (name, str(value).replace("\\", "\\\\").replace('"', '\\"'))
+        for name, value in pairs
+    )
+    return "{" + ",".join(f'{name}="{value}"' for name, value in escaped) + "}"
+
+
+request_duration = Histogram(
+    "http_request_duration_seconds",
+    "Time spent serving each route.",
+    ("route", "method", "status"),
+)
+upstream_duration = Histogram(
+    "upstream_request_duration_seconds",
+    "Time spent in each call to LinkedIn, Twitter or OpenAI.",
+    ("upstream", "operation", "status"),
+)
+upstream_retries = Counter(
+    "upstream_retries_total",
+    "Retries made against each upstream operation.",
+    ("upstream", "operation"),
+)
+
+circuit_state = Gauge(
+    "upstream_circuit_state",
+    "Circuit breaker per upstream: 0 closed, 1 half-open, 2 open.",
+    ("upstream",),
+)
+circuit_rejections = Counter(
+    "upstream_rejections_total",
+    "Upstream calls refused before they were sent, by reason.",
+    ("upstream", "reason"),
+)
+upstream_hedges = Counter(
+    "upstream_hedges_total",
+    "Second attempts sent for slow idempotent reads, by which one answered.",
+    ("upstream", "winner"),
+)
+
+METRICS = [
+    request_duration,
+    upstream_duration,
+    upstream_retries,
+    circuit_state,
+    circuit_rejections,
+    upstream_hedges,
+]
+
+logger = logging.getLogger("upstream")
+
+
+class Span:
+    def __init__(self, upstream, operation):
+        self.upstream = upstream
+        self.operation = operation
+        self.status = "ok"
+        self.retries = 0
+
+
+# times one upstream call; set span.status/span.retries inside the block,
+# exceptions are recorded with the HTTP status they carry when there is one
+@contextmanager
+def span(upstream, operation):
+    current = Span(upstream, operation)
+    start = time.monotonic()
+    try:
+        yield current
+    except Exception as e:
+        response = getattr(e, "response", None)
+        current.status = getattr(response, "status_code", None) or type(e).__name__
+        raise
+    finally:
+        elapsed = time.monotonic() - start
+        upstream_duration.observe(
+            elapsed, upstream=upstream, operation=operation, status=current.status
+        )
+        if current.retries:
+            upstream_retries.inc(
+                current.retries, upstream=upstream, operation=operation
+            )
+        log(
+            logger,
+            logging.INFO,
+            "upstream call",
+            upstream=upstream,
+            operation=operation,
+            status=current.status,
+            retries=current.retries,
+            duration_ms=round(elapsed * 1000, 1),
+        )
+
+
+def _flatten(prefix, value, out):
+    if isinstance(value, dict):
+        for key, inner in value.items():
+            _flatten(prefix + (str(key),), inner, out)
+    elif isinstance(value, (int, float)) and not isinstance(value, bool):
+        out.append((prefix, value))
+
+
+# the /stats counters (pools, caches, pipelines) become gauges
+def render(stats=None):
+    lines = list()
+    for metric in METRICS:
+        lines.extend(metric.render())
+    if stats:
+        flattened = list()
+        _flatten((), stats, flattened)
+        lines.append("# HELP app_stat Internal counters also shown at /stats.")
+        lines.append("# TYPE app_stat gauge")
+        for path, value in flattened:
+            section, field = path[0], ".".join(path[1:])
+            lines.append(
+                f"app_stat{_labels([('section', section), ('field', field)])} {value}"
+            )
+    return "\n".join(lines) + "\n"
+
+
+def instrument(app):
+    from flask import g, request
+
+    route_logger = logging.getLogger("route")
+
+    @app.before_request
+    def _start_timer():
+        g.request_started = time.monotonic()
+
+    @app.after_request
+    def _record(response):
+        started = g.pop("request_started", None)
+        if started is None:
+            return response
+        elapsed = time.monotonic() - started
+        route = request.url_rule.rule if request.url_rule else "unmatched"
+        request_duration.observe(
+            elapsed, route=route, method=request.method, status=response.status_code
+        )
+        log(
+            route_logger,
+            logging.INFO,
+            "request",
+            route=route,
+            method=request.method,
+            status=response.status_code,
+            duration_ms=round(elapsed * 1000, 1),
+        )
+        return response
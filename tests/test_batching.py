@@ -0,0 +1,73 @@
+import json
+import pytest
+import prompts
+import twitter_helper
+
+
+@pytest.fixture(autouse=True)
+def estimated_tokens(monkeypatch):
+    # length-based estimates, so no vocabulary download
+    monkeypatch.setattr(prompts, "encoding", lambda: None)
+
+
+def tweet(id, text="a short tweet"):
+    return {"id": str(id), "text": text}
+
+
+def test_plan_batches_caps_tweets_per_batch(monkeypatch):
+    monkeypatch.setattr(twitter_helper, "GPT_BATCH_MAX_TWEETS", 3)
+    monkeypatch.setattr(twitter_helper, "GPT_BATCH_TOKEN_BUDGET", 100000)
+    batches = twitter_helper.plan_batches([tweet(i) for i in range(7)])
+    assert [len(batch) for batch in batches] == [3, 3, 1]
+
+
+def test_plan_batches_keeps_to_the_token_budget(monkeypatch):
+    monkeypatch.setattr(twitter_helper, "GPT_BATCH_MAX_TWEETS", 100)
+    base = prompts.batch_base_tokens()
+    cost = prompts.batch_item_tokens(tweet(0), twitter_helper.GPT_MAX_TOKENS)
+    monkeypatch.setattr(twitter_helper, "GPT_BATCH_TOKEN_BUDGET", base + 2 * cost)
+    batches = twitter_helper.plan_batches([tweet(i) for i in range(5)])
+    assert [len(batch) for batch in batches] == [2, 2, 1]
+    # every tweet goes out exactly once, in order
+    assert [t["id"] for b in batches for t in b] == [str(i) for i in range(5)]
+
+
+def test_plan_batches_sends_an_oversized_tweet_alone(monkeypatch):
+    monkeypatch.setattr(twitter_helper, "GPT_BATCH_TOKEN_BUDGET", 1)
+    batches = twitter_helper.plan_batches([tweet(1), tweet(2)])
+    assert [len(batch) for batch in batches] == [1, 1]
+
+
+def test_plan_batches_empty():
+    assert twitter_helper.plan_batches([]) == []
+
+
+def test_parse_batch_replies_matches_ids():
+    content = json.dumps(
+        {"replies": [{"id": 1, "reply": "Reply: nice one"}, {"id": "2", "reply": "ok"}]}
+    )
+    replies = twitter_helper.parse_batch_replies(content, [tweet(1), tweet(2)])
+    assert replies == {"1": "nice one", "2": "ok"}
+
+
+def test_parse_batch_replies_drops_unknown_ids_and_bad_items():
+    content = json.dumps(
+        {
+            "replies": [
+                {"id": "9", "reply": "not asked for"},
+                "just a string",
+                {"id": "1", "reply": ""},
+                {"id": "2"},
+                {"id": "3", "reply": "fine"},
+            ]
+        }
+    )
+    tweets = [tweet(1), tweet(2), tweet(3)]
+    assert twitter_helper.parse_batch_replies(content, tweets) == {"3": "fine"}
+
+
+@pytest.mark.parametrize(
+    "content", ["not json", "[]", '{"replies": {"1": "x"}}', '{"other": []}', "null"]
+)
+def test_parse_batch_replies_survives_malformed_output(content):
+    assert twitter_helper.parse_batch_replies(content, [tweet(1)]) == {}
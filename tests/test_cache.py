@@ -0,0 +1,108 @@
+import threading
+import time
+import pytest
+from cache import SingleFlight, TTLCache, get_or_load, token_hash
+
+
+def run_together(flight, key, fn, followers=3):
+    results = []
+    started = threading.Event()
+    release = threading.Event()
+
+    def leader():
+        started.set()
+        release.wait()
+        return fn()
+
+    def call(load):
+        try:
+            results.append(("value", flight.do(key, load)))
+        except Exception as e:
+            results.append(("error", e))
+
+    threads = [threading.Thread(target=call, args=(leader,))]
+    threads[0].start()
+    started.wait()
+    for _ in range(followers):
+        thread = threading.Thread(target=call, args=(fn,))
+        thread.start()
+        threads.append(thread)
+    while flight.stats()["shared"] < followers:
+        time.sleep(0.001)
+    release.set()
+    for thread in threads:
+        thread.join()
+    return results
+
+
+def test_shares_result():
+    flight = SingleFlight()
+    calls = []
+
+    def load():
+        calls.append(1)
+        return {"reply": "hi"}
+
+    results = run_together(flight, "k", load)
+    assert len(calls) == 1
+    assert len(results) == 4
+    assert all(result == ("value", {"reply": "hi"}) for result in results)
+    assert flight.stats() == {"in_flight": 0, "calls": 1, "shared": 3}
+
+
+def test_shares_exception():
+    flight = SingleFlight()
+    error = RuntimeError("upstream down")
+
+    def load():
+        raise error
+
+    results = run_together(flight, "k", load)
+    assert results == [("error", error)] * 4
+    assert flight.stats()["in_flight"] == 0
+
+
+def test_next_call_runs_again():
+    flight = SingleFlight()
+    with pytest.raises(RuntimeError):
+        flight.do("k", lambda: (_ for _ in ()).throw(RuntimeError()))
+    assert flight.do("k", lambda: 2) == 2
+    assert flight.stats()["calls"] == 2
+
+
+def test_begin_and_finish():
+    flight = SingleFlight()
+    call, leader = flight.begin("k")
+    other, follower_leads = flight.begin("k")
+    assert leader and not follower_leads and other is call
+    flight.finish("k", call, "value")
+    assert flight.wait(other) == "value"
+    assert flight.begin("k")[1]
+
+
+def test_get_or_load_caches_values():
+    cache = TTLCache(maxsize=10, ttl=60)
+    flight = SingleFlight()
+    calls = []
+
+    def load():
+        calls.append(1)
+        return {"name": "a"}
+
+    assert get_or_load(cache, flight, "k", load) == {"name": "a"}
+    assert get_or_load(cache, flight, "k", load) == {"name": "a"}
+    assert len(calls) == 1
+
+
+def test_get_or_load_does_not_cache_none_or_errors():
+    cache = TTLCache(maxsize=10, ttl=60)
+    flight = SingleFlight()
+    assert get_or_load(cache, flight, "k", lambda: None) is None
+    with pytest.raises(ValueError):
+        get_or_load(cache, flight, "k", lambda: (_ for _ in ()).throw(ValueError()))
+    assert get_or_load(cache, flight, "k", lambda: 1) == 1
+
+
+def test_token_hash_keeps_parts_apart():
+    assert token_hash("ab", "c") != token_hash("a", "bc")
+    assert token_hash("a", "b") == token_hash("a", "b")
@@ -0,0 +1,108 @@
+import json
+import threading
+import pytest
+import requests
+from urllib3.exceptions import MaxRetryError, NewConnectionError
+import jobs
+import resilience
+from rate_limits import DeadlineExceeded
+
+
+@pytest.fixture
+def queue(tmp_path, monkeypatch):
+    monkeypatch.setattr(jobs, "JOBS_DB_PATH", str(tmp_path / "jobs.db"))
+    monkeypatch.setattr(jobs, "_local", threading.local())
+    monkeypatch.setattr(jobs, "start_workers", lambda: None)
+    monkeypatch.setattr(jobs, "JOB_RETRY_DELAY", 0)
+    monkeypatch.setattr(jobs, "_last_maintenance", None)
+    monkeypatch.setattr(jobs, "HANDLERS", dict(jobs.HANDLERS))
+    return jobs
+
+
+def connection_refused():
+    reason = NewConnectionError(None, "Connection refused")
+    return requests.ConnectionError(MaxRetryError(None, "/", reason))
+
+
+@pytest.mark.parametrize(
+    "error",
+    [
+        resilience.NotPublished("registerUpload returned 503"),
+        resilience.CircuitOpen("open"),
+        resilience.BulkheadFull("full"),
+        DeadlineExceeded("no free openai slot"),
+        requests.ConnectTimeout(),
+        connection_refused(),
+        requests.HTTPError(response=type("R", (), {"status_code": 429})()),
+    ],
+)
+def test_safe_to_retry(error):
+    assert resilience.safe_to_retry(error)
+
+
+@pytest.mark.parametrize(
+    "error",
+    [
+        resilience.DeadlineExceededAfterSend("cut short"),
+        requests.ReadTimeout(),
+        requests.ConnectionError("connection reset"),
+        requests.HTTPError(response=type("R", (), {"status_code": 503})()),
+        Exception("LinkedIn API Error"),
+    ],
+)
+def test_not_safe_to_retry(error):
+    assert not resilience.safe_to_retry(error)
+
+
+def run(queue, error, payload=None):
+    def fail(payload, media):
+        raise error
+
+    queue.HANDLERS["tweet"] = fail
+    payload = payload or {"text": "hi", "access_token": "a", "access_secret": "s"}
+    job = queue.enqueue("tweet", payload)
+    queue._run(queue._claim())
+    row = queue._connect().execute("SELECT * FROM jobs WHERE id = ?", (job["id"],))
+    return row.fetchone()
+
+
+def test_retries_what_was_not_sent(queue):
+    row = run(queue, resilience.NotPublished("503"))
+    assert row["status"] == "queued"
+    assert json.loads(row["payload"])["access_token"] == "a"
+
+
+def test_fails_what_may_have_posted(queue):
+    row = run(queue, requests.ReadTimeout("read timed out"))
+    assert row["status"] == "failed"
+    assert json.loads(row["payload"]) == {"text": "hi"}
+    assert row["media"] is None
+
+
+def test_gives_up_after_max_attempts(queue, monkeypatch):
+    monkeypatch.setattr(queue, "JOB_MAX_ATTEMPTS", 2)
+    row = run(queue, resilience.NotPublished("503"))
+    assert row["status"] == "queued"
+    queue._run(queue._claim())
+    row = queue._connect().execute("SELECT * FROM jobs").fetchone()
+    assert row["status"] == "failed"
+    assert row["attempts"] == 2
+
+
+def test_expired_lease_is_unknown(queue, monkeypatch):
+    queue.HANDLERS["tweet"] = lambda payload, media: {"id": "1"}
+    job = queue.enqueue("tweet", {"text": "hi", "access_token": "a"})
+    queue._claim()
+    monkeypatch.setattr(queue, "JOB_LEASE", -1)
+    queue._maintain()
+    assert queue.get_job(job["id"])["status"] == "unknown"
+    assert queue._claim() is None
+
+
+def test_idempotency_key_is_scoped_to_account(queue):
+    queue.HANDLERS["tweet"] = lambda payload, media: None
+    first = queue.enqueue("tweet", {"access_token": "a"}, idempotency_key="k")
+    again = queue.enqueue("tweet", {"access_token": "a"}, idempotency_key="k")
+    other = queue.enqueue("tweet", {"access_token": "b"}, idempotency_key="k")
+    assert again["id"] == first["id"]
+    assert other["id"] != first["id"]
@@ -0,0 +1,94 @@
+import itertools
+import pytest
+import app as app_module
+import twitter_helper
+from cache import TTLCache
+
+DENIED = "Access denied: reason=login was not started in this browser."
+
+
+@pytest.fixture
+def twitter(monkeypatch):
+    monkeypatch.setattr(app_module.app, "secret_key", "test")
+    monkeypatch.setenv("FRONTEND_URL", "https://frontend.example")
+    monkeypatch.setattr(twitter_helper, "oauth_tokens", TTLCache(maxsize=10, ttl=60))
+    ids = itertools.count()
+
+    def oauth():
+        token = {"oauth_token": f"token-{next(ids)}", "oauth_token_secret": "s"}
+        twitter_helper.oauth_tokens.set(token["oauth_token"], token)
+        return {
+            "redirect_url": "https://twitter.example/authorize",
+            "request_token": token,
+        }
+
+    def callback(request_token, verifier):
+        return {
+            "access_token": "at-" + request_token["oauth_token"],
+            "access_secret": "as",
+        }
+
+    monkeypatch.setattr(twitter_helper, "oauth", oauth)
+    monkeypatch.setattr(twitter_helper, "callback", callback)
+    monkeypatch.setattr(
+        twitter_helper,
+        "login_profile",
+        lambda token, secret: {"username": "u", "name": "n", "profile_pic": "p"},
+    )
+
+
+def start_login(client):
+    assert client.get("/oauth/twitter").status_code == 302
+    with client.session_transaction() as session:
+        return session["oauth_token"]
+
+
+def finish_login(client, token):
+    return client.get(
+        "/oauth/callback/twitter",
+        query_string={"oauth_token": token, "oauth_verifier": "v"},
+    )
+
+
+def test_login_completes_in_the_browser_that_started_it(twitter):
+    client = app_module.app.test_client()
+    token = start_login(client)
+    response = finish_login(client, token)
+    assert response.status_code == 302
+    assert response.location.startswith("https://frontend.example/save?")
+    with client.session_transaction() as session:
+        assert session["access_token"] == "at-" + token
+        assert "oauth_token" not in session
+
+
+def test_callback_from_another_browser_is_refused(twitter):
+    attacker = app_module.app.test_client()
+    victim = app_module.app.test_client()
+    token = start_login(attacker)
+    response = finish_login(victim, token)
+    assert response.get_data(as_text=True) == DENIED
+    with victim.session_transaction() as session:
+        assert "access_token" not in session
+
+
+def test_callback_for_another_login_is_refused(twitter):
+    attacker = app_module.app.test_client()
+    victim = app_module.app.test_client()
+    attacker_token = start_login(attacker)
+    start_login(victim)
+    response = finish_login(victim, attacker_token)
+    assert response.get_data(as_text=True) == DENIED
+
+
+def test_callback_cannot_be_replayed(twitter):
+    client = app_module.app.test_client()
+    token = start_login(client)
+    assert finish_login(client, token).status_code == 302
+    assert finish_login(client, token).get_data(as_text=True) == DENIED
+
+
+def test_callback_without_token_is_refused(twitter):
+    client = app_module.app.test_client()
+    start_login(client)
+    response = client.get("/oauth/callback/twitter")
+    assert response.get_data(as_text=True) == DENIED
@@ -0,0 +1,73 @@
+import pytest
+import prompts
+from prompts import REPLY_MAX_CHARS, clean_reply
+
+
+@pytest.fixture(autouse=True)
+def estimated_tokens(monkeypatch):
+    monkeypatch.setattr(prompts, "encoding", lambda: None)
+
+
+@pytest.mark.parametrize("text", [None, 42, "", "   ", '""', "Reply: "])
+def test_clean_reply_rejects_empty(text):
+    assert clean_reply(text) is None
+
+
+@pytest.mark.parametrize(
+    "text, expected",
+    [
+        ("  Totally agree.  ", "Totally agree."),
+        ("Reply: Totally agree.", "Totally agree."),
+        ("response - Totally agree.", "Totally agree."),
+        ('"Totally agree."', "Totally agree."),
+        ("“Totally agree.”", "Totally agree."),
+        ('Reply: "Totally agree."', "Totally agree."),
+    ],
+)
+def test_clean_reply_strips_labels_and_quotes(text, expected):
+    assert clean_reply(text) == expected
+
+
+def test_truncated_reply_ends_at_last_sentence():
+    full = "This is a complete and fairly long sentence about it."
+    assert clean_reply(full + " And this was cut", truncated=True) == full
+
+
+def test_truncated_reply_keeps_most_of_the_text():
+    # the only sentence end is too early to be worth cutting back to
+    text = "Hi. This is a much longer part that was cut off by max tokens"
+    assert clean_reply(text, truncated=True) == text
+
+
+def test_long_reply_ends_at_a_sentence_within_the_limit():
+    first = "A" * 120 + "."
+    reply = clean_reply(first + " " + "b" * 150)
+    assert reply == first
+
+
+def test_long_reply_without_sentences_is_cut_at_a_word():
+    reply = clean_reply("word " * 100)
+    assert len(reply) <= REPLY_MAX_CHARS
+    assert reply.endswith("word…")
+
+
+def test_long_reply_without_spaces_is_cut_hard():
+    reply = clean_reply("x" * 500)
+    assert reply == "x" * (REPLY_MAX_CHARS - 1) + "…"
+
+
+def test_short_reply_is_untouched():
+    text = "No sentence end here but short"
+    assert clean_reply(text) == text
+
+
+def test_compact_tweet_drops_links_and_whitespace():
+    text = "Read  this&amp;that\n https://t.co/abc123 now"
+    assert prompts.compact_tweet(text) == "Read this&that [link] now"
+
+
+def test_compact_tweet_caps_tokens(monkeypatch):
+    monkeypatch.setattr(prompts, "TWEET_MAX_TOKENS", 10)
+    compacted = prompts.compact_tweet("word " * 200)
+    assert compacted.endswith("…")
+    assert len(compacted) <= 10 * 4 + 1
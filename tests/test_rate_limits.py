@@ -0,0 +1,75 @@
+import asyncio
+import time
+import pytest
+from rate_limits import (
+    AdaptiveConcurrency,
+    DeadlineExceeded,
+    OpenAILimiter,
+    TokenBucket,
+)
+
+
+def limiter(rpm=60, tpm=1000):
+    return OpenAILimiter(rpm, tpm, AdaptiveConcurrency(2, 1, 4, 10))
+
+
+def test_reserve_over_max_wait_takes_nothing():
+    bucket = TokenBucket(60)
+    before = bucket.tokens
+    assert bucket.reserve(120, max_wait=1) > 1
+    assert bucket.tokens == pytest.approx(before, abs=0.1)
+
+
+def test_reserve_within_max_wait_goes_into_debt():
+    bucket = TokenBucket(60)
+    assert bucket.reserve(61, max_wait=5) == pytest.approx(1, abs=0.1)
+    assert bucket.tokens < 0
+
+
+def test_token_rejection_refunds_request():
+    gpt = limiter()
+    requests = gpt.requests.tokens
+    assert gpt.reserve(5000, max_wait=1) > 1
+    assert gpt.requests.tokens == pytest.approx(requests, abs=0.1)
+    assert gpt.tokens.tokens == pytest.approx(1000, abs=0.1)
+
+
+def test_deadline_rejection_leaves_no_debt():
+    gpt = limiter()
+    for _ in range(50):
+        with pytest.raises(DeadlineExceeded):
+            gpt.acquire(5000, time.monotonic() + 0.5)
+    assert gpt.requests.tokens == pytest.approx(60, abs=0.1)
+    assert gpt.tokens.tokens == pytest.approx(1000, abs=0.1)
+    assert gpt.concurrency.in_flight == 0
+    assert gpt.stats()["deadline"] == 50
+    # a caller that fits is not held back by the ones that gave up
+    gpt.acquire(100, time.monotonic() + 0.5)
+    assert gpt.concurrency.in_flight == 1
+
+
+def test_async_deadline_rejection_leaves_no_debt():
+    gpt = limiter()
+    with pytest.raises(DeadlineExceeded):
+        asyncio.run(gpt.acquire_async(5000, time.monotonic() + 0.5))
+    assert gpt.tokens.tokens == pytest.approx(1000, abs=0.1)
+    assert gpt.concurrency.in_flight == 0
+
+
+def test_cancelled_wait_gives_back_slot_and_reservation():
+    gpt = limiter()
+    gpt.tokens.reserve(1000)
+
+    async def cancel():
+        task = asyncio.ensure_future(gpt.acquire_async(30, time.monotonic() + 10))
+        await asyncio.sleep(0.05)
+        assert gpt.concurrency.in_flight == 1
+        task.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await task
+
+    asyncio.run(cancel())
+    assert gpt.concurrency.in_flight == 0
+    assert gpt.requests.tokens == pytest.approx(60, abs=0.1)
+    assert gpt.tokens.tokens == pytest.approx(0, abs=1)
+    assert gpt.stats()["cancelled"] == 1
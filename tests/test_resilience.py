@@ -0,0 +1,114 @@
+import asyncio
+import pytest
+import resilience
+from resilience import CLOSED, HALF_OPEN, OPEN, CircuitBreaker
+
+
+@pytest.fixture(autouse=True)
+def breaker_settings(monkeypatch):
+    monkeypatch.setattr(resilience, "BREAKER_MIN_CALLS", 4)
+    monkeypatch.setattr(resilience, "BREAKER_ERROR_RATE", 0.5)
+    monkeypatch.setattr(resilience, "BREAKER_SLOW_RATE", 0.8)
+    monkeypatch.setattr(resilience, "BREAKER_COOLDOWN", 60)
+
+
+def opened(breaker):
+    for _ in range(4):
+        breaker.record("failure")
+    return breaker
+
+
+def test_opens_at_error_rate():
+    breaker = CircuitBreaker("test", slow_call=5)
+    for outcome in ("ok", "ok", "failure"):
+        breaker.record(outcome)
+    assert breaker.state == CLOSED
+    breaker.record("failure")
+    assert breaker.state == OPEN
+    assert not breaker.allow()
+    assert breaker.stats()["rejected"] == 1
+
+
+def test_waits_for_min_calls():
+    breaker = CircuitBreaker("test", slow_call=5)
+    for _ in range(3):
+        breaker.record("failure")
+    assert breaker.state == CLOSED
+
+
+def test_opens_on_slow_calls():
+    breaker = CircuitBreaker("test", slow_call=1)
+    for _ in range(4):
+        breaker.record("ok", elapsed=2)
+    assert breaker.state == OPEN
+
+
+def test_ignored_calls_do_not_count():
+    breaker = CircuitBreaker("test", slow_call=5)
+    for _ in range(10):
+        breaker.record("ignored")
+    assert breaker.stats()["calls"] == 0
+    assert breaker.state == CLOSED
+
+
+def test_half_open_admits_one_probe(monkeypatch):
+    breaker = opened(CircuitBreaker("test", slow_call=5))
+    monkeypatch.setattr(resilience, "BREAKER_COOLDOWN", 0)
+    assert breaker.allow()
+    assert breaker.state == HALF_OPEN
+    assert not breaker.allow()
+
+
+def test_probe_success_closes(monkeypatch):
+    breaker = opened(CircuitBreaker("test", slow_call=5))
+    monkeypatch.setattr(resilience, "BREAKER_COOLDOWN", 0)
+    breaker.allow()
+    breaker.record("ok")
+    assert breaker.state == CLOSED
+    assert breaker.stats()["calls"] == 0
+    assert breaker.allow()
+
+
+def test_probe_failure_reopens(monkeypatch):
+    breaker = opened(CircuitBreaker("test", slow_call=5))
+    monkeypatch.setattr(resilience, "BREAKER_COOLDOWN", 0)
+    breaker.allow()
+    breaker.record("failure")
+    assert breaker.state == OPEN
+    assert breaker.stats()["opens"] == 2
+
+
+def test_ignored_probe_frees_the_slot(monkeypatch):
+    breaker = opened(CircuitBreaker("test", slow_call=5))
+    monkeypatch.setattr(resilience, "BREAKER_COOLDOWN", 0)
+    breaker.allow()
+    breaker.record("ignored")
+    assert breaker.state == HALF_OPEN
+    assert breaker.allow()
+
+
+class Response:
+    def __init__(self, **fields):
+        self.__dict__.update(fields)
+
+
+class Error(Exception):
+    def __init__(self, response):
+        super().__init__("upstream error")
+        self.response = response
+
+
+@pytest.mark.parametrize(
+    "response", [Response(status_code=401), Response(status=401)], ids=["sync", "async"]
+)
+def test_client_errors_do_not_count_against_the_breaker(response):
+    assert resilience.http_status(Error(response)) == 401
+    assert resilience._error_outcome(Error(response)) == "ok"
+
+
+def test_no_answer_is_a_failure():
+    assert resilience._error_outcome(Exception("connection reset")) == "failure"
+
+
+def test_cancelled_calls_are_ignored():
+    assert resilience._error_outcome(asyncio.CancelledError()) == "ignored"
@@ -0,0 +1,103 @@
+import threading
+import time
+from types import SimpleNamespace
+from timeline_store import Timeline, TimelineStore
+
+
+def tweets(*ids):
+    return [SimpleNamespace(id=i) for i in ids]
+
+
+def ids(timeline):
+    return [tweet.id for tweet in timeline]
+
+
+def test_merge_orders_newest_first():
+    timeline = Timeline(10)
+    merged, fresh = timeline.merge(tweets(2, 3, 1))
+    assert ids(merged) == [3, 2, 1]
+    assert ids(fresh) == [1, 2, 3]
+    assert timeline.newest_id == "3"
+
+
+def test_merge_skips_known_tweets():
+    timeline = Timeline(10)
+    timeline.merge(tweets(1, 2))
+    merged, fresh = timeline.merge(tweets(2, 3))
+    assert ids(merged) == [3, 2, 1]
+    assert ids(fresh) == [3]
+
+
+def test_merge_evicts_oldest():
+    timeline = Timeline(3)
+    timeline.merge(tweets(1, 2, 3))
+    merged, _ = timeline.merge(tweets(4, 5))
+    assert ids(merged) == [5, 4, 3]
+    assert timeline.ids == {"3", "4", "5"}
+    assert timeline.newest_id == "5"
+
+
+def test_merge_older_tweet_keeps_order_and_newest_id():
+    timeline = Timeline(4)
+    timeline.merge(tweets(1, 5))
+    merged, fresh = timeline.merge(tweets(3))
+    assert ids(merged) == [5, 3, 1]
+    assert ids(fresh) == [3]
+    assert timeline.newest_id == "5"
+    # one older than a full buffer falls straight off the end
+    timeline.merge(tweets(6))
+    merged, _ = timeline.merge(tweets(0))
+    assert ids(merged) == [6, 5, 3, 1]
+    assert timeline.newest_id == "6"
+
+
+def test_merge_dedupes_within_a_page():
+    timeline = Timeline(5)
+    merged, fresh = timeline.merge(tweets(2, 2, 1))
+    assert ids(merged) == [2, 1]
+    assert ids(fresh) == [1, 2]
+
+
+# hands the GIL over on every id lookup, so merges interleave
+class SlowTweet:
+    def __init__(self, id):
+        self._id = id
+
+    @property
+    def id(self):
+        time.sleep(0)
+        return self._id
+
+
+def test_concurrent_merges_of_the_same_page_do_not_duplicate():
+    timeline = Timeline(500)
+    timeline.merge(tweets(1))
+    page = [SlowTweet(i) for i in range(2, 200)]
+    barrier = threading.Barrier(8)
+
+    def merge():
+        barrier.wait()
+        timeline.merge(page)
+
+    threads = [threading.Thread(target=merge) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert ids(timeline.tweets) == list(range(199, 0, -1))
+
+
+def test_merge_nothing_keeps_newest_id():
+    timeline = Timeline(3)
+    assert timeline.merge([]) == ([], [])
+    assert timeline.newest_id is None
+    timeline.merge(tweets(7))
+    timeline.merge([])
+    assert timeline.newest_id == "7"
+
+
+def test_store_keeps_timeline_per_user():
+    store = TimelineStore(maxusers=2, ttl=60, maxlen=5)
+    store.get("a").merge(tweets(1))
+    assert store.get("a").newest_id == "1"
+    assert store.get("b").newest_id is None
@@ -0,0 +1,33 @@
+import asyncio
+from types import SimpleNamespace
+import pytest
+import twitter_async
+import twitter_helper
+from rate_limits import AdaptiveConcurrency, OpenAILimiter
+
+
+def test_cancelled_completion_releases_its_slot(monkeypatch):
+    gpt = OpenAILimiter(600, 100000, AdaptiveConcurrency(2, 1, 4, 10))
+    monkeypatch.setattr(twitter_helper, "gpt_limiter", gpt)
+
+    async def create(**kwargs):
+        await asyncio.sleep(10)
+
+    completions = SimpleNamespace(create=create)
+    state = SimpleNamespace(
+        gpt_client=SimpleNamespace(chat=SimpleNamespace(completions=completions))
+    )
+
+    async def cancel():
+        messages = [{"role": "user", "content": "hi"}]
+        task = asyncio.ensure_future(twitter_async._complete(state, messages, 50))
+        await asyncio.sleep(0.05)
+        assert gpt.concurrency.in_flight == 1
+        task.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await task
+
+    asyncio.run(cancel())
+    assert gpt.concurrency.in_flight == 0
+    assert gpt.concurrency.limit == 2
+    assert gpt.stats()["cancelled"] == 1
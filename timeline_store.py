@@ -0,0 +1,62 @@
+import threading
+from collections import deque
+from cache import TTLCache
+
+
+# newest-first ring buffer of one user's home timeline
+class Timeline:
+    def __init__(self, maxlen):
+        self.tweets = deque(maxlen=maxlen)
+        self.ids = set()
+        self.newest_id = None
+        self.lock = threading.Lock()
+
+    # the buffer stays sorted newest first, so a late older tweet never
+    # moves newest_id (the next since_id) backwards
+    def merge(self, tweets):
+        with self.lock:
+            fresh = dict()
+            for tweet in tweets:
+                if str(tweet.id) not in self.ids:
+                    fresh[str(tweet.id)] = tweet
+            fresh = sorted(fresh.values(), key=lambda tweet: int(tweet.id))
+            if not fresh:
+                pass
+            elif not self.tweets or int(fresh[0].id) > int(self.tweets[0].id):
+                # the usual since_id page: everything is newer than the head
+                for tweet in fresh:
+                    if len(self.tweets) == self.tweets.maxlen:
+                        self.ids.discard(str(self.tweets[-1].id))
+                    self.tweets.appendleft(tweet)
+                    self.ids.add(str(tweet.id))
+            else:
+                merged = sorted(
+                    [*self.tweets, *fresh],
+                    key=lambda tweet: int(tweet.id),
+                    reverse=True,
+                )
+                self.tweets.clear()
+                self.tweets.extend(merged[: self.tweets.maxlen])
+                self.ids = {str(tweet.id) for tweet in self.tweets}
+            if self.tweets:
+                self.newest_id = str(self.tweets[0].id)
+            return list(self.tweets), fresh
+
+
+class TimelineStore:
+    def __init__(self, maxusers, ttl, maxlen):
+        self.maxlen = maxlen
+        self._timelines = TTLCache(maxsize=maxusers, ttl=ttl)
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            timeline = self._timelines.get(key)
+            if timeline is None:
+                timeline = Timeline(self.maxlen)
+            # re-setting refreshes the idle expiry of active users
+            self._timelines.set(key, timeline)
+            return timeline
+
+    def stats(self):
+        return self._timelines.stats()
@@ -0,0 +1,223 @@
+import asyncio
+import logging
+import os
+import time
+import http_client
+import lazy
+import prompts
+import resilience
+import telemetry
+import twitter_helper
+
+aiohttp = lazy.lazy_import("aiohttp")
+openai = lazy.lazy_import("openai")
+
+logger = logging.getLogger("twitter")
+
+
+# connections live for as long as the event loop that owns them: one per
+# worker under ASGI, one per request in flask views. GPT concurrency is
+# governed by twitter_helper.gpt_limiter, shared with the threaded path
+class PipelineState:
+    def __init__(self):
+        self.session = aiohttp.ClientSession(
+            timeout=aiohttp.ClientTimeout(
+                sock_connect=http_client.CONNECT_TIMEOUT,
+                sock_read=http_client.READ_TIMEOUT,
+            )
+        )
+        self.gpt_client = openai.AsyncOpenAI(
+            api_key=os.getenv("OPEN_AI_KEY"), max_retries=0
+        )
+
+    async def close(self):
+        await self.session.close()
+        await self.gpt_client.close()
+
+
+async def get_home_timeline(state, access_token, access_token_secret):
+    from tweepy.asynchronous import AsyncClient
+
+    client = AsyncClient(
+        consumer_key=twitter_helper.consumer_key,
+        consumer_secret=twitter_helper.consumer_secret,
+        access_token=access_token,
+        access_token_secret=access_token_secret,
+    )
+    client.session = state.session
+    key = twitter_helper.client_key(access_token, access_token_secret)
+    timeline = twitter_helper.timeline_store.get(key)
+    since_id = timeline.newest_id
+    fetched = list()
+    users = list()
+    pagination_token = None
+    for _ in range(twitter_helper.TIMELINE_MAX_PAGES):
+        with resilience.guarded("twitter", "get_home_timeline", bulkhead=False):
+            response = await client.get_home_timeline(
+                **twitter_helper.timeline_params(since_id, pagination_token)
+            )
+        fetched.extend(response.data or [])
+        users.extend(response.includes.get("users", []))
+        pagination_token = response.meta.get("next_token")
+        if not pagination_token:
+            break
+    twitter_helper.cache_users(users)
+    tweets, _ = timeline.merge(fetched)
+    return tweets, users
+
+
+async def _fetch_users(state, user_ids):
+    headers = {"Authorization": f"Bearer {os.getenv('bearer_token')}"}
+    url = twitter_helper.api_url + ",".join(user_ids)
+    try:
+        with resilience.guarded("twitter", "users", bulkhead=False) as span:
+            async with state.session.get(url, headers=headers) as response:
+                span.status = response.status
+                if response.status != 200:
+                    return {"error": await response.text()}
+                data = await response.json()
+    except resilience.UNAVAILABLE + (aiohttp.ClientError, asyncio.TimeoutError) as e:
+        return {"error": str(e)}
+    return data.get("data", [])
+
+
+async def get_users(state, user_ids):
+    users, chunks = twitter_helper.split_cached_users(user_ids)
+    if not chunks:
+        return users
+    results = await asyncio.gather(*(_fetch_users(state, c) for c in chunks))
+    return twitter_helper.merge_user_results(users, results)
+
+
+# mirrors twitter_helper._complete on the event loop
+async def _complete(state, messages, max_tokens):
+    limiter = twitter_helper.gpt_limiter
+    deadline = resilience.earliest(time.monotonic() + twitter_helper.GPT_DEADLINE)
+    tokens = twitter_helper.request_tokens(messages, max_tokens)
+    with telemetry.span("openai", "chat") as span:
+        for attempt in range(twitter_helper.GPT_MAX_ATTEMPTS):
+            span.retries = attempt
+            await limiter.acquire_async(tokens, deadline)
+            started = time.monotonic()
+            try:
+                with resilience.guard("openai", bulkhead=False):
+                    response = await state.gpt_client.chat.completions.create(
+                        **twitter_helper.completion_kwargs(
+                            messages, max_tokens, deadline
+                        )
+                    )
+            except asyncio.CancelledError:
+                # a cancelled task must still hand its slot back
+                limiter.release("cancelled")
+                raise
+            except Exception as e:
+                wait = twitter_helper.completion_failed(e, attempt, deadline)
+                if wait is None:
+                    raise
+                await asyncio.sleep(wait)
+                continue
+            twitter_helper.completion_succeeded(response, started, tokens)
+            return response
+
+
+# returns the reply; failures are raised for gpt_pipeline to report
+async def send_request(state, tweet):
+    try:
+        response = await _complete(
+            state, prompts.messages_for(tweet), twitter_helper.GPT_MAX_TOKENS
+        )
+    except Exception as e:
+        telemetry.log(
+            logger,
+            logging.WARNING,
+            "gpt call failed",
+            tweet_id=tweet["id"],
+            error=str(e),
+        )
+        raise
+    reply = twitter_helper.reply_text(response)
+    if reply is None:
+        raise ValueError("the model returned no usable reply")
+    twitter_helper.reply_cache.set(twitter_helper.reply_key(tweet), reply)
+    return reply
+
+
+# claims the tweet in twitter_helper.reply_flight, so a tweet already being
+# answered by another request or a pregen pass is waited for, not asked again
+async def generate_reply(state, tweet, poll=0.02):
+    flight = twitter_helper.reply_flight
+    key = twitter_helper.reply_key(tweet)
+    call, leader = flight.begin(key)
+    if not leader:
+        # the call settles on another thread or task; polling keeps the
+        # event loop free
+        while not call.done.is_set():
+            await asyncio.sleep(poll)
+        result = flight.wait(call)
+        if "error" in result:
+            raise ValueError(result["error"])
+        return result["reply"]
+    try:
+        reply = await send_request(state, tweet)
+    except BaseException as e:
+        # cancelled too: whoever waits on the claim must not wait forever
+        flight.finish(key, call, twitter_helper.format_failure(tweet, str(e)))
+        raise
+    flight.finish(key, call, twitter_helper.format_reply(tweet, reply))
+    return reply
+
+
+async def gpt_pipeline(access_token, access_secret, state=None):
+    if state is None:
+        state = PipelineState()
+        try:
+            return await gpt_pipeline(access_token, access_secret, state)
+        finally:
+            await state.close()
+
+    tweets, users = await get_home_timeline(state, access_token, access_secret)
+    index = twitter_helper.index_users(users)
+    missing = twitter_helper.missing_authors(tweets, index)
+    # profile lookup only matters for formatting, so it overlaps the GPT calls
+    profiles = asyncio.ensure_future(get_users(state, missing)) if missing else None
+
+    records = [
+        twitter_helper.tweet_record(tweet, index.get(str(tweet.author_id), {}))
+        for tweet in tweets
+    ]
+    cached = [
+        twitter_helper.reply_cache.get(twitter_helper.reply_key(record))
+        for record in records
+    ]
+    fresh = await asyncio.gather(
+        *(
+            generate_reply(state, record)
+            for record, reply in zip(records, cached)
+            if reply is None
+        ),
+        return_exceptions=True,
+    )
+
+    if profiles is not None:
+        # the replies are already paid for; a failed lookup only costs names
+        try:
+            index.update(twitter_helper.index_users(await profiles))
+        except Exception as e:
+            telemetry.log(logger, logging.WARNING, "user lookup failed", error=str(e))
+        records = [
+            twitter_helper.tweet_record(tweet, index.get(str(tweet.author_id), {}))
+            for tweet in tweets
+        ]
+
+    fresh = iter(fresh)
+    replies = list()
+    for record, reply in zip(records, cached):
+        if reply is not None:
+            replies.append(twitter_helper.format_reply(record, reply, cached=True))
+            continue
+        reply = next(fresh)
+        if isinstance(reply, BaseException):
+            replies.append(twitter_helper.format_failure(record, str(reply)))
+        else:
+            replies.append(twitter_helper.format_reply(record, reply))
+    return replies
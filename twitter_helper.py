@@ -1,30 +1,154 @@
-import tweepy
+import logging
 import os
-from openai import OpenAI
+import hashlib
+import json
+import random
+import time
+from contextlib import contextmanager
 from concurrent.futures import ThreadPoolExecutor, as_completed
 from dotenv import load_dotenv
 import requests
+import http_client
+import lazy
+import media
+import prompts
+import rate_limits
+import resilience
+import telemetry
+from cache import SingleFlight, TTLCache, get_or_load, make_cache, token_hash
+from timeline_store import TimelineStore
 
 load_dotenv()
 
+# both take most of a worker's import time; LinkedIn-only workers never
+# load them
+tweepy = lazy.lazy_import("tweepy")
+openai = lazy.lazy_import("openai")
+
+logger = logging.getLogger("twitter")
+
 consumer_key = os.getenv("CONSUMER_KEY")
 consumer_secret = os.getenv("CONSUMER_SECRET")
 
-gpt_client = OpenAI(api_key=os.getenv("OPEN_AI_KEY"))
+# retries are done by _complete so they go through the shared limiter
+gpt_client = lazy.ForkSafe(
+    "openai_client",
+    lambda: openai.OpenAI(api_key=os.getenv("OPEN_AI_KEY"), max_retries=0),
+)
 
-authenticator = tweepy.OAuthHandler(
-    consumer_key,
-    consumer_secret,
-    callback=os.getenv("CALLBACK_URL"),
+# request tokens between /oauth/twitter and its callback, by oauth_token.
+# the callback may land on another worker, so they live in a SQLite file
+# unless OAUTH_TOKEN_STORE_PATH is set to "" for a single process
+oauth_tokens = make_cache(
+    maxsize=int(os.getenv("OAUTH_TOKEN_STORE_SIZE", "10000")),
+    ttl=float(os.getenv("OAUTH_TOKEN_TTL", "900")),
+    path=os.getenv("OAUTH_TOKEN_STORE_PATH", "./oauth_tokens.db"),
+    table="oauth_request_tokens",
 )
 
 api_url = "https://api.twitter.com/2/users?user.fields=profile_image_url,verified&ids="
 
+# (api, client) pairs per credential so tweepy's sessions stay warm
+client_cache = TTLCache(
+    maxsize=int(os.getenv("TWITTER_CLIENT_CACHE_SIZE", "256")),
+    ttl=float(os.getenv("TWITTER_CLIENT_CACHE_TTL", "1800")),
+)
+
+# user profiles by id; set PROFILE_CACHE_PATH to share them across workers
+profile_cache = make_cache(
+    maxsize=int(os.getenv("PROFILE_CACHE_SIZE", "5000")),
+    ttl=float(os.getenv("PROFILE_CACHE_TTL", "3600")),
+    path=os.getenv("PROFILE_CACHE_PATH"),
+    table="profiles",
+)
+
+# /twitter/me answers by credential hash, so a page load does not build
+# clients and call twitter each time
+me_cache = make_cache(
+    maxsize=int(os.getenv("IDENTITY_CACHE_SIZE", "10000")),
+    ttl=float(os.getenv("IDENTITY_CACHE_TTL", "60")),
+    path=os.getenv("IDENTITY_CACHE_PATH"),
+    table="twitter_me",
+)
+_me_flight = SingleFlight()
+
+GPT_MODEL = os.getenv("GPT_MODEL", "gpt-3.5-turbo")
+GPT_TEMPERATURE = 0.7
+# 200 characters are about 50 tokens; the headroom keeps replies from being
+# cut off mid-sentence, prompts.clean_reply enforces the length
+GPT_MAX_TOKENS = 90
+
+# "fanout" sends one request per tweet, "batch" packs several tweets into
+# each request under a token budget
+GPT_STRATEGY = os.getenv("GPT_STRATEGY", "fanout")
+GPT_BATCH_TOKEN_BUDGET = int(os.getenv("GPT_BATCH_TOKEN_BUDGET", "3000"))
+GPT_BATCH_MAX_TWEETS = int(os.getenv("GPT_BATCH_MAX_TWEETS", "20"))
+GPT_BATCH_RETRIES = int(os.getenv("GPT_BATCH_RETRIES", "1"))
+
+# shared by every GPT call in the process: the account's requests and
+# tokens per minute, and a concurrency limit that grows while calls succeed
+# and shrinks on 429s or slow responses
+GPT_CONCURRENCY = int(os.getenv("GPT_CONCURRENCY", "10"))
+GPT_CONCURRENCY_MIN = int(os.getenv("GPT_CONCURRENCY_MIN", "2"))
+GPT_CONCURRENCY_MAX = int(os.getenv("GPT_CONCURRENCY_MAX", "64"))
+GPT_LATENCY_TARGET = float(os.getenv("GPT_LATENCY_TARGET", "8"))
+gpt_limiter = rate_limits.OpenAILimiter(
+    rpm=int(os.getenv("OPENAI_RPM", "500")),
+    tpm=int(os.getenv("OPENAI_TPM", "200000")),
+    concurrency=rate_limits.AdaptiveConcurrency(
+        GPT_CONCURRENCY, GPT_CONCURRENCY_MIN, GPT_CONCURRENCY_MAX, GPT_LATENCY_TARGET
+    ),
+)
+# a reply that cannot be produced within this many seconds, retries
+# included, is reported as failed
+GPT_DEADLINE = float(os.getenv("GPT_DEADLINE", "30"))
+GPT_MAX_ATTEMPTS = int(os.getenv("GPT_MAX_ATTEMPTS", "4"))
+
+reply_cache = make_cache(
+    maxsize=int(os.getenv("REPLY_CACHE_SIZE", "10000")),
+    ttl=float(os.getenv("REPLY_CACHE_TTL", "86400")),
+    path=os.getenv("REPLY_CACHE_PATH"),
+    table="replies",
+)
+
+reply_flight = SingleFlight()
+
+REPLY_WORKERS = int(os.getenv("REPLY_WORKERS", "4"))
+# replies that would have to wait longer than this for the rate limit
+# window to reset are reported as deferred instead of blocking the request
+REPLY_MAX_WAIT = float(os.getenv("REPLY_MAX_WAIT", "30"))
+REPLY_MAX_ATTEMPTS = 3
+# the window replies are paced against
+CREATE_TWEET_URL = "https://api.twitter.com/2/tweets"
+
+# per-user timeline buffers for incremental since_id refreshes
+TIMELINE_PAGE_SIZE = int(os.getenv("TIMELINE_PAGE_SIZE", "100"))
+TIMELINE_MAX_PAGES = int(os.getenv("TIMELINE_MAX_PAGES", "1"))
+timeline_store = TimelineStore(
+    maxusers=int(os.getenv("TIMELINE_STORE_USERS", "1000")),
+    ttl=float(os.getenv("TIMELINE_STORE_TTL", "3600")),
+    maxlen=int(os.getenv("TIMELINE_BUFFER_SIZE", "200")),
+)
+
+# the users lookup endpoint accepts at most 100 ids per call
+USERS_LOOKUP_CHUNK = 100
+USERS_LOOKUP_WORKERS = int(os.getenv("USERS_LOOKUP_WORKERS", "4"))
+
 # access_token = os.getenv("access_token")
 # access_token_secret = os.getenv("access_secret")
 
 
+def client_key(access_token, access_token_secret):
+    secret_hash = hashlib.sha256(str(access_token_secret).encode()).hexdigest()
+    return (access_token, secret_hash)
+
+
 def init(access_token, access_token_secret):
+    key = client_key(access_token, access_token_secret)
+    clients = client_cache.get(key)
+    if clients is not None:
+        return clients
+
     auth = tweepy.OAuth1UserHandler(
         consumer_key, consumer_secret, access_token, access_token_secret
     )
@@ -38,146 +162,729 @@ def init(access_token, access_token_secret):
         access_token_secret=access_token_secret,
     )
 
-    return api, client
+    client.session.hooks["response"].append(rate_limits.twitter.hook(key))
+    http_client.route_upstreams(client.session)
+    http_client.route_upstreams(api.session)
+
+    clients = (api, client)
+    client_cache.set(key, clients)
+    return clients
+
+
+def invalidate_clients(access_token, access_token_secret):
+    return client_cache.delete(client_key(access_token, access_token_secret))
+
+
+# drops the cached clients when twitter reports the token as revoked
+@contextmanager
+def clients_for(access_token, access_token_secret):
+    try:
+        yield init(access_token, access_token_secret)
+    except tweepy.Unauthorized:
+        invalidate_clients(access_token, access_token_secret)
+        raise
 
 
 def get_home_timeline_through_api_call(Bearer):
     api_url = "https://api.twitter.com/2/tweets/search/recent?query=from:twitterdev"
 
 
-def get_home_timeline(access_token, access_token_secret):
-    api, client = init(access_token, access_token_secret)
-    response = client.get_home_timeline(
+def timeline_params(since_id=None, pagination_token=None):
+    params = dict(
         exclude=["replies", "retweets"],
+        expansions=["author_id"],
         tweet_fields=["created_at", "author_id"],
         user_fields=["username", "profile_image_url", "verified"],
+        max_results=TIMELINE_PAGE_SIZE,
     )
-    return response.data
+    if since_id:
+        params["since_id"] = since_id
+    if pagination_token:
+        params["pagination_token"] = pagination_token
+    return params
 
 
-def get_users(user_ids):
+# only tweets newer than the last one seen are requested; they are merged
+# into the user's buffered timeline, so a refresh with nothing new is a
+# single empty call
+def get_home_timeline(access_token, access_token_secret):
+    key = client_key(access_token, access_token_secret)
+    timeline = timeline_store.get(key)
+    since_id = timeline.newest_id
+    fetched = list()
+    users = list()
+    pagination_token = None
+    with clients_for(access_token, access_token_secret) as (api, client):
+        for _ in range(TIMELINE_MAX_PAGES):
+            with resilience.guarded("twitter", "get_home_timeline"):
+                response = client.get_home_timeline(
+                    **timeline_params(since_id, pagination_token)
+                )
+            fetched.extend(response.data or [])
+            users.extend(response.includes.get("users", []))
+            pagination_token = response.meta.get("next_token")
+            if not pagination_token:
+                break
+    cache_users(users)
+    tweets, _ = timeline.merge(fetched)
+    return tweets, users
+
+
+def index_users(users):
+    # get_users hands back {"error": ...} instead of a list on failure
+    if not isinstance(users, list):
+        return {}
+    index = dict()
+    for user in users:
+        user = getattr(user, "data", user)
+        index[str(user["id"])] = user
+    return index
+
+
+def tweet_record(tweet, user):
+    return {
+        "id": str(tweet.id),
+        "text": tweet.text,
+        "created_at": tweet.created_at,
+        "author_id": tweet.author_id,
+        "username": user.get("username"),
+        "profile_image_url": user.get("profile_image_url"),
+        "verified": user.get("verified", False),
+        "name": user.get("name"),
+    }
+
+
+def missing_authors(tweets, index):
+    return {str(tweet.author_id) for tweet in tweets} - index.keys()
+
+
+def enrich_tweets(tweets, users):
+    index = index_users(users)
+    # authors missing from includes come from the profile cache
+    missing = missing_authors(tweets, index)
+    if missing:
+        index.update(index_users(get_users(missing)))
+    return [
+        tweet_record(tweet, index.get(str(tweet.author_id), {})) for tweet in tweets
+    ]
+
+
+def cache_users(users):
+    for user in users:
+        user = getattr(user, "data", user)
+        profile_cache.set(str(user["id"]), user)
+
+
+def _fetch_users(user_ids):
     headers = {"Authorization": f"Bearer {os.getenv('bearer_token')}"}
-    response = requests.get(
-        api_url + ",".join(str(u) for u in user_ids), headers=headers
-    )
+    try:
+        response = http_client.get(
+            api_url + ",".join(user_ids), operation="users", hedge=True, headers=headers
+        )
+    except resilience.UNAVAILABLE + (requests.Timeout, requests.ConnectionError) as e:
+        # profiles are decoration; the tweets still go out without them
+        return {"error": str(e)}
 
     if response.status_code != 200:
         return {"error": response.text}
 
-    return response.json()["data"]
+    return response.json().get("data", [])
+
+
+def split_cached_users(user_ids):
+    users = list()
+    missing = list()
+    for user_id in dict.fromkeys(str(u) for u in user_ids):
+        user = profile_cache.get(user_id)
+        if user is None:
+            missing.append(user_id)
+        else:
+            users.append(user)
+    chunks = [
+        missing[i : i + USERS_LOOKUP_CHUNK]
+        for i in range(0, len(missing), USERS_LOOKUP_CHUNK)
+    ]
+    return users, chunks
+
+
+def merge_user_results(users, results):
+    errors = list()
+    for result in results:
+        if isinstance(result, dict):
+            errors.append(result["error"])
+            continue
+        cache_users(result)
+        users.extend(result)
+    if errors and not users:
+        return {"error": errors[0]}
+    return users
 
 
-def get_me(access_token, access_token_secret):
-    api, client = init(access_token, access_token_secret)
-    user = client.get_me(user_fields=["profile_image_url"])
-    user_profile_pic = user.data.profile_image_url
-    data = {
-        "profile_pic": user_profile_pic,
-        "username": user.data.username,
-        "name": user.data.name,
+def get_users(user_ids):
+    users, chunks = split_cached_users(user_ids)
+    if not chunks:
+        return users
+
+    with ThreadPoolExecutor(
+        max_workers=min(len(chunks), USERS_LOOKUP_WORKERS)
+    ) as executor:
+        futures = [resilience.submit(executor, _fetch_users, c) for c in chunks]
+        return merge_user_results(users, (f.result() for f in futures))
+
+
+def profile_data(user):
+    return {
+        "profile_pic": user.get("profile_image_url"),
+        "username": user.get("username"),
+        "name": user.get("name"),
     }
-    return data
 
 
-def post_tweet(text, access_token, access_secret, path=None):
-    api, client = init(access_token, access_secret)
-    if path:
-        media = api.media_upload(path)
-        data = client.create_tweet(text=text, media_ids=[media.media_id])
-    else:
-        data = client.create_tweet(text=text)
+def fetch_me(access_token, access_token_secret):
+    with clients_for(access_token, access_token_secret) as (api, client):
+        with resilience.guarded("twitter", "get_me"):
+            user = client.get_me(user_fields=["profile_image_url"])
+    profile_cache.set(str(user.data.id), user.data.data)
+    return profile_data(user.data.data)
+
+
+def get_me(access_token, access_token_secret):
+    key = token_hash(access_token, access_token_secret)
+    return get_or_load(
+        me_cache,
+        _me_flight,
+        key,
+        lambda: fetch_me(access_token, access_token_secret),
+    )
+
+
+def me_stats():
+    return {**me_cache.stats(), "flight": _me_flight.stats()}
+
+
+# twitter access tokens start with the user's id
+def user_id_from_token(access_token):
+    user_id, _, rest = str(access_token).partition("-")
+    return user_id if rest and user_id.isdigit() else None
+
+
+# the signed-in user's profile, from the profile cache when a timeline or
+# lookup has already brought it in
+def login_profile(access_token, access_token_secret):
+    user_id = user_id_from_token(access_token)
+    user = profile_cache.get(user_id) if user_id else None
+    if user and user.get("username") and user.get("profile_image_url"):
+        return profile_data(user)
+    return get_me(access_token, access_token_secret)
+
+
+# the same image from the same account is uploaded once per media id
+# lifetime; later posts reuse the id
+def _upload_media(api, access_token, path, stream):
+    if stream is None:
+        with open(path, "rb") as image:
+            return _upload_media(api, access_token, path, image)
+    account = hashlib.sha256(str(access_token).encode()).hexdigest()
+    key = ("twitter", account, media.content_hash(stream))
+    media_id = media.media_index.get(key)
+    if media_id is None:
+        stream, path = media.prepare_image(stream, path)
+        try:
+            with resilience.guarded("twitter", "media_upload"):
+                media_id = api.media_upload(path, file=stream).media_id
+        except (tweepy.TweepyException, requests.RequestException) as e:
+            # nothing has been tweeted yet
+            status = resilience.http_status(e)
+            if status is None or resilience.retryable_status(status):
+                raise resilience.NotPublished(f"Media upload failed: {e}") from e
+            raise
+        media.media_index.set(key, media_id, ttl=media.TWITTER_MEDIA_TTL)
+    return media_id
+
+
+# path names the image; when stream is given the bytes are read from it
+# instead of from disk
+def post_tweet(text, access_token, access_secret, path=None, stream=None):
+    with clients_for(access_token, access_secret) as (api, client):
+        if path:
+            media_id = _upload_media(api, access_token, path, stream)
+            with resilience.guarded("twitter", "create_tweet"):
+                data = client.create_tweet(text=text, media_ids=[media_id])
+        else:
+            with resilience.guarded("twitter", "create_tweet"):
+                data = client.create_tweet(text=text)
     return data
 
 
 def reply_tweet(tweet_id, text, access_token, access_secret):
     try:
-        api, client = init(access_token, access_secret)
-        data = client.create_tweet(text=text, in_reply_to_tweet_id=tweet_id)
+        with clients_for(access_token, access_secret) as (api, client):
+            with resilience.guarded("twitter", "create_tweet"):
+                data = client.create_tweet(text=text, in_reply_to_tweet_id=tweet_id)
         return data.data
     except Exception as e:
+        telemetry.log(logger, logging.WARNING, "reply failed", error=str(e))
         return {"error": "Something went wrong"}
 
 
+def reply_item_error(tweet):
+    if not isinstance(tweet, dict):
+        return "each reply must be an object"
+    if not str(tweet.get("tweet_id") or "").strip():
+        return "missing tweet_id"
+    if not isinstance(tweet.get("reply"), str) or not tweet["reply"].strip():
+        return "missing reply"
+    return None
+
+
+def _post_reply(client, key, tweet):
+    # a malformed item is reported on its own instead of failing the batch
+    error = reply_item_error(tweet)
+    if error is not None:
+        tweet_id = tweet.get("tweet_id") if isinstance(tweet, dict) else None
+        return {"tweet_id": tweet_id, "status": "error", "error": error}
+    with telemetry.span("twitter", "create_tweet") as span:
+        result = _post_reply_attempts(client, key, tweet, span)
+        if result["status"] != "posted":
+            span.status = result["status"]
+    return result
+
+
+def _post_reply_attempts(client, key, tweet, span):
+    result = {"tweet_id": tweet["tweet_id"]}
+    deadline = time.monotonic() + REPLY_MAX_WAIT
+    for attempt in range(REPLY_MAX_ATTEMPTS):
+        span.retries = attempt
+        wait = rate_limits.twitter.reserve(
+            rate_limits.endpoint(key, "POST", CREATE_TWEET_URL)
+        )
+        if time.monotonic() + wait > deadline:
+            result.update(status="deferred", retry_after=round(wait))
+            return result
+        time.sleep(wait)
+        try:
+            with resilience.guard("twitter"):
+                data = client.create_tweet(
+                    text=tweet["reply"], in_reply_to_tweet_id=tweet["tweet_id"]
+                )
+        except resilience.UNAVAILABLE as e:
+            result.update(
+                status="deferred",
+                retry_after=round(getattr(e, "retry_after", None) or 1),
+            )
+            return result
+        except tweepy.TooManyRequests:
+            # the response hook has recorded the reset time; back off a
+            # little anyway in case the headers were missing
+            time.sleep(min(2**attempt, max(deadline - time.monotonic(), 0)))
+            continue
+        except tweepy.Unauthorized as e:
+            client_cache.delete(key)
+            result.update(status="error", error=str(e))
+            return result
+        except Exception as e:
+            result.update(status="error", error=str(e))
+            return result
+        result.update(status="posted", id=data.data["id"])
+        return result
+    result.update(status="deferred", retry_after=round(REPLY_MAX_WAIT))
+    return result
+
+
 def reply_all(tweets, access_token, access_secret):
     try:
         api, client = init(access_token, access_secret)
-        for tweet in tweets:
-            client.create_tweet(
-                text=tweet["reply"], in_reply_to_tweet_id=tweet["tweet_id"]
-            )
-        return {"success": True}
     except Exception as e:
         return {"error": "Something went wrong"}
 
+    key = client_key(access_token, access_secret)
+    with ThreadPoolExecutor(max_workers=REPLY_WORKERS) as executor:
+        results = list(
+            executor.map(lambda tweet: _post_reply(client, key, tweet), tweets)
+        )
+    counts = {"posted": 0, "deferred": 0, "error": 0}
+    for result in results:
+        counts[result["status"]] += 1
+    return {
+        "success": counts["posted"] == len(results),
+        "posted": counts["posted"],
+        "deferred": counts["deferred"],
+        "failed": counts["error"],
+        "results": results,
+    }
+
 
 def get_profile_details(user_ids, access_token, access_secret):
-    api, client = init(access_token, access_secret)
-    response = client.get_users(ids=user_ids)
+    with clients_for(access_token, access_secret) as (api, client):
+        with resilience.guarded("twitter", "get_users"):
+            response = client.get_users(ids=user_ids)
     return response.data
 
 
-def send_to_gpt(tweets):
-    replies = []
-    with ThreadPoolExecutor(max_workers=10) as executor:
-        future_to_tweet = {
-            executor.submit(send_request, tweet): tweet for tweet in tweets
-        }
-        for future in as_completed(future_to_tweet):
-            result = future.result()
-            if result:
-                print(result["tweet_id"])
-                replies.append(result)
+# (replies already in the cache, tweets that still need one)
+def split_cached_replies(tweets):
+    cached = []
+    pending = []
+    for tweet in tweets:
+        reply = reply_cache.get(reply_key(tweet))
+        if reply is None:
+            pending.append(tweet)
+        else:
+            cached.append(format_reply(tweet, reply, cached=True))
+    return cached, pending
+
+
+# yields replies as they become available: cached ones first, then in
+# the order the GPT calls finish
+def iter_gpt_replies(tweets, strategy=None):
+    cached, pending = split_cached_replies(tweets)
+    yield from cached
+    if pending:
+        yield from generate_replies(pending, strategy)
+
+
+def generate_replies(tweets, strategy=None):
+    if (strategy or GPT_STRATEGY) == "batch":
+        yield from _iter_batched(tweets)
+    else:
+        yield from _iter_fanout(tweets)
+
+
+def _iter_fanout(tweets, answer=None):
+    # the limiter decides how many calls are in flight; threads past its
+    # current limit just wait for a slot
+    executor = ThreadPoolExecutor(max_workers=GPT_CONCURRENCY_MAX)
+    try:
+        futures = [
+            resilience.submit(executor, answer or generate_reply, tweet)
+            for tweet in tweets
+        ]
+        for future in as_completed(futures):
+            yield future.result()
+    finally:
+        # a disconnected stream should not keep paying for GPT calls
+        executor.shutdown(wait=False, cancel_futures=True)
+
+
+# batched tweets are claimed in reply_flight like fanned-out ones, so a
+# live request and a background pass never ask for the same reply twice
+def _iter_batched(tweets):
+    claimed = dict()
+    shared = []
+    own = []
+    for tweet in tweets:
+        key = reply_key(tweet)
+        call, leader = reply_flight.begin(key)
+        if leader:
+            claimed[key] = (tweet, call)
+            own.append(tweet)
+        else:
+            shared.append((tweet, call))
+    try:
+        for tweet, reply in _answer_batched(own):
+            key = reply_key(tweet)
+            _, call = claimed.pop(key)
+            reply_flight.finish(key, call, reply)
+            yield reply
+    finally:
+        # a closed stream leaves its tweets unanswered
+        for key, (tweet, call) in claimed.items():
+            failure = format_failure(tweet, "the request generating it went away")
+            reply_flight.finish(key, call, failure)
+    for tweet, call in shared:
+        try:
+            yield reply_flight.wait(call)
+        except Exception as e:
+            yield format_failure(tweet, str(e))
+
+
+# (tweet, reply) pairs; tweets the batches skip fall back to one call each
+def _answer_batched(tweets):
+    remaining = tweets
+    for _ in range(GPT_BATCH_RETRIES + 1):
+        if not remaining:
+            return
+        executor = ThreadPoolExecutor(max_workers=GPT_CONCURRENCY_MAX)
+        missing = []
+        try:
+            future_to_batch = {
+                resilience.submit(executor, send_batch, batch): batch
+                for batch in plan_batches(remaining)
+            }
+            for future in as_completed(future_to_batch):
+                replies = future.result()
+                for tweet in future_to_batch[future]:
+                    reply = replies.get(tweet["id"])
+                    if reply is None:
+                        missing.append(tweet)
+                        continue
+                    reply_cache.set(reply_key(tweet), reply)
+                    yield tweet, format_reply(tweet, reply)
+        finally:
+            executor.shutdown(wait=False, cancel_futures=True)
+        # only the tweets the model skipped or garbled go round again
+        remaining = missing
+    by_id = {tweet["id"]: tweet for tweet in remaining}
+    for reply in _iter_fanout(remaining, send_request):
+        yield by_id[reply["tweet_id"]], reply
+
+
+def send_to_gpt(tweets, strategy=None):
+    return list(iter_gpt_replies(tweets, strategy))
+
+
+# packs tweets into batches whose prompt plus expected replies stay within
+# the token budget, so long tweets make for smaller batches
+def plan_batches(tweets):
+    batches = []
+    current = []
+    used = base = prompts.batch_base_tokens()
+    for tweet in tweets:
+        cost = prompts.batch_item_tokens(tweet, GPT_MAX_TOKENS)
+        if current and (
+            used + cost > GPT_BATCH_TOKEN_BUDGET or len(current) >= GPT_BATCH_MAX_TWEETS
+        ):
+            batches.append(current)
+            current = []
+            used = base
+        current.append(tweet)
+        used += cost
+    if current:
+        batches.append(current)
+    return batches
+
+
+def parse_batch_replies(content, tweets):
+    expected = {tweet["id"] for tweet in tweets}
+    try:
+        items = json.loads(content)["replies"]
+    except (ValueError, KeyError, TypeError):
+        return {}
+    replies = dict()
+    if not isinstance(items, list):
+        return replies
+    for item in items:
+        if not isinstance(item, dict):
+            continue
+        tweet_id = str(item.get("id"))
+        reply = prompts.clean_reply(item.get("reply"))
+        if tweet_id in expected and reply:
+            replies[tweet_id] = reply
     return replies
 
 
-def send_request(tweet):
+def request_tokens(messages, max_tokens):
+    return prompts.count_message_tokens(messages) + max_tokens
+
+
+def retry_after(error):
+    response = getattr(error, "response", None)
     try:
-        response = gpt_client.chat.completions.create(
-            model="gpt-3.5-turbo",
-            messages=[
-                {
-                    "role": "user",
-                    "content": f"""Craft a thoughtful and engaging response to the following tweet(max 200 chars), expressing your genuine thoughts and feelings on the topic. Respond with wit and a unique perspective, ensuring humor is subtle and used sparingly. Provide clear, informative replies to necessary tweets. Adjust the tone according to the context of the tweet. Keep responses concise and relevant. Avoid using common, overused words such as 'wow,' 'amazing,' or 'incredible.' Instead, focus on providing meaningful commentary or sharing a personal perspective. Do not use word "reply" at the beginning of reply. just answer with a reply tweet. Make sure your reply does not acceed 200 character limit.
-
-                        Tweet:
-                        {tweet['text']}""",
-                },
-                {
-                    "role": "system",
-                    "content": f"""Generate a friendly and contextually relevant reply to the provided tweet. Ensure that the response is in a conversational tone and appears as a natural and informal, human reply. Additionally, after providing the reply, share your own views or opinions on the tweet. Please keep both the reply and your views concise. Make sure your reply does not acceed 200 character limit.""",
-                },
-            ],
-            max_tokens=70,
-            temperature=0.7,
+        return float(response.headers.get("retry-after"))
+    except (AttributeError, TypeError, ValueError):
+        return None
+
+
+# full jitter, so retries from many threads do not arrive together
+def backoff(attempt, retry_after=None):
+    return max(random.uniform(0, min(0.5 * 2**attempt, 8)), retry_after or 0)
+
+
+def completion_kwargs(messages, max_tokens, deadline, **kwargs):
+    return dict(
+        model=GPT_MODEL,
+        messages=messages,
+        max_tokens=max_tokens,
+        temperature=GPT_TEMPERATURE,
+        timeout=max(deadline - time.monotonic(), 1),
+        **kwargs,
+    )
+
+
+def completion_succeeded(response, started, tokens):
+    gpt_limiter.release("ok", time.monotonic() - started)
+    if response.usage is not None:
+        gpt_limiter.tokens.adjust(response.usage.total_tokens - tokens)
+
+
+# frees the limiter slot and returns how long to back off before the next
+# attempt, or None when the error is final
+def completion_failed(error, attempt, deadline):
+    retryable = (
+        openai.RateLimitError,
+        openai.APITimeoutError,
+        openai.APIConnectionError,
+        openai.InternalServerError,
+    )
+    if not isinstance(error, retryable):
+        gpt_limiter.release("error")
+        return None
+    throttled = isinstance(error, openai.RateLimitError)
+    gpt_limiter.release(
+        "throttled" if throttled else "error", retry_after=retry_after(error)
+    )
+    wait = backoff(attempt, retry_after(error))
+    if attempt + 1 == GPT_MAX_ATTEMPTS or time.monotonic() + wait > deadline:
+        return None
+    return wait
+
+
+# one chat completion through the shared limiter, retried with backoff on
+# 429s, timeouts and server errors until GPT_DEADLINE
+def _complete(operation, messages, max_tokens, **kwargs):
+    deadline = resilience.earliest(time.monotonic() + GPT_DEADLINE)
+    tokens = request_tokens(messages, max_tokens)
+    with telemetry.span("openai", operation) as span:
+        for attempt in range(GPT_MAX_ATTEMPTS):
+            span.retries = attempt
+            gpt_limiter.acquire(tokens, deadline)
+            started = time.monotonic()
+            try:
+                with resilience.guard("openai"):
+                    response = gpt_client.get().chat.completions.create(
+                        **completion_kwargs(messages, max_tokens, deadline, **kwargs)
+                    )
+            except Exception as e:
+                wait = completion_failed(e, attempt, deadline)
+                if wait is None:
+                    raise
+                time.sleep(wait)
+                continue
+            completion_succeeded(response, started, tokens)
+            return response
+
+
+def send_batch(tweets):
+    try:
+        response = _complete(
+            "chat_batch",
+            prompts.batch_messages_for(tweets),
+            GPT_MAX_TOKENS * len(tweets) + 50,
+            response_format={"type": "json_object"},
         )
-        reply = response.choices[0].message.content
-        return {
-            "tweet_id": tweet["id"],
-            "tweet": tweet["text"],
-            "reply": reply,
-            "username": tweet["username"],
-            "profile_image_url": tweet["profile_image_url"],
-            "verified": tweet["verified"],
-            "name": tweet["name"],
-        }
+        return parse_batch_replies(response.choices[0].message.content, tweets)
     except Exception as e:
-        print(e)
-        return None
+        telemetry.log(
+            logger,
+            logging.WARNING,
+            "gpt batch failed",
+            tweets=len(tweets),
+            error=str(e),
+        )
+        return {}
+
+
+def reply_key(tweet):
+    text_hash = hashlib.sha256(tweet["text"].encode()).hexdigest()
+    return (
+        str(tweet["id"]),
+        text_hash,
+        prompts.PROMPT_VERSION,
+        GPT_MODEL,
+        GPT_TEMPERATURE,
+    )
+
+
+def format_reply(tweet, reply, cached=False):
+    return {
+        "tweet_id": tweet["id"],
+        "tweet": tweet["text"],
+        "reply": reply,
+        "username": tweet["username"],
+        "profile_image_url": tweet["profile_image_url"],
+        "verified": tweet["verified"],
+        "name": tweet["name"],
+        "cached": cached,
+    }
+
+
+# a tweet whose reply could not be generated is still returned, with the
+# error in place of the reply
+def format_failure(tweet, error):
+    failure = format_reply(tweet, None)
+    failure["error"] = error
+    return failure
+
+
+# the reply as it can be posted; one cut off by max_tokens is trimmed back
+# to its last full sentence
+def reply_text(response):
+    choice = response.choices[0]
+    truncated = choice.finish_reason == "length"
+    return prompts.clean_reply(choice.message.content, truncated)
+
+
+def send_request(tweet):
+    try:
+        response = _complete("chat", prompts.messages_for(tweet), GPT_MAX_TOKENS)
+        reply = reply_text(response)
+        if reply is None:
+            return format_failure(tweet, "the model returned no usable reply")
+        reply_cache.set(reply_key(tweet), reply)
+        return format_reply(tweet, reply)
+    except Exception as e:
+        telemetry.log(
+            logger,
+            logging.WARNING,
+            "gpt call failed",
+            tweet_id=tweet["id"],
+            error=str(e),
+        )
+        return format_failure(tweet, str(e))
+
+
+# a tweet already being answered, e.g. by a background pre-generation pass
+# or another tab, waits for that reply instead of asking again
+def generate_reply(tweet):
+    return reply_flight.do(reply_key(tweet), lambda: send_request(tweet))
+
+
+# a handler per login: they carry the request token through the handshake,
+# so sharing one lets concurrent logins swap each other's tokens
+def oauth_handler():
+    handler = tweepy.OAuth1UserHandler(
+        consumer_key,
+        consumer_secret,
+        callback=os.getenv("CALLBACK_URL"),
+    )
+    if http_client.UPSTREAM_OVERRIDE:
+        # tweepy opens a new session for each oauth step, so the url itself
+        # is redirected
+        base_url = handler._get_oauth_url
+        handler._get_oauth_url = lambda endpoint: http_client.upstream_url(
+            base_url(endpoint)
+        )
+    return handler
 
 
 def oauth():
     try:
-        redirect_url = authenticator.get_authorization_url()
-        request_token = authenticator.request_token
+        handler = oauth_handler()
+        with resilience.guarded("twitter", "request_token"):
+            redirect_url = handler.get_authorization_url()
+        request_token = handler.request_token
+        oauth_tokens.set(request_token["oauth_token"], request_token)
         return {"request_token": request_token, "redirect_url": redirect_url}
     except Exception as e:
         return {"error": str(e)}
 
 
+# request tokens are single use
+def pop_request_token(oauth_token):
+    if not oauth_token:
+        return None
+    request_token = oauth_tokens.get(oauth_token)
+    if request_token is not None:
+        oauth_tokens.delete(oauth_token)
+    return request_token
+
+
 def callback(request_token, verifier):
     try:
-        authenticator.request_token = request_token
-        access_info = authenticator.get_access_token(verifier)
+        handler = oauth_handler()
+        handler.request_token = request_token
+        with resilience.guarded("twitter", "access_token"):
+            access_info = handler.get_access_token(verifier)
         access_token = access_info[0]
         access_secret = access_info[1]
         return {"access_token": access_token, "access_secret": access_secret}